@@ -0,0 +1,75 @@
+# Async_checkpoint.py
+# Keras callback that writes checkpoints through a checkpoints.CheckpointManager on a background thread
+
+import os
+import queue
+import threading
+import tensorflow as tf
+
+
+class AsyncCheckpoint(tf.keras.callbacks.Callback):
+    # Takes a copy of the weights at the end of each epoch and writes it from a background thread, through a
+    # separate checkpoint model, so training continues while the file is written. At most one copy waits in the
+    # queue: if saving falls behind by more than an epoch, the next epoch end waits for it
+
+    def __init__(self, checkpoint_manager, build_checkpoint_model):
+
+        super(AsyncCheckpoint, self).__init__()
+        self.checkpoint_manager = checkpoint_manager
+        self.build_checkpoint_model = build_checkpoint_model
+        self.checkpoint_model = None
+        self.save_queue = queue.Queue(maxsize=1)
+        self.save_thread = None
+        self.save_error = None
+
+    def on_epoch_end(self, epoch, logs=None):
+
+        self.raise_save_error()
+        if self.checkpoint_model is None:
+            # Layers are created on the training thread
+            self.checkpoint_model = self.build_checkpoint_model()
+            self.save_thread = threading.Thread(target=self.save_checkpoints, daemon=True)
+            self.save_thread.start()
+
+        val_loss = (logs or {}).get('val_loss')
+        self.save_queue.put((epoch + 1, float(val_loss) if val_loss is not None else None,
+                             self.model.get_weights()))
+
+    def on_train_end(self, logs=None):
+        self.wait()
+
+    def wait(self):
+
+        if self.save_thread is not None:
+            self.save_queue.put(None)
+            self.save_thread.join()
+            self.save_thread = None
+            self.checkpoint_model = None
+        self.raise_save_error()
+
+    def raise_save_error(self):
+
+        if self.save_error is not None:
+            save_error, self.save_error = self.save_error, None
+            raise save_error
+
+    def save_checkpoints(self):
+
+        while True:
+            item = self.save_queue.get()
+            if item is None:
+                return
+            if self.save_error is not None:
+                continue
+
+            epoch, val_loss, weights = item
+            try:
+                filename = self.checkpoint_manager.get_checkpoint_filename(epoch, val_loss)
+                checkpoint_path = os.path.join(self.checkpoint_manager.checkpoints_path, filename)
+                self.checkpoint_model.set_weights(weights)
+                # Written under a temporary name, a checkpoint file is either complete or absent
+                self.checkpoint_model.save(checkpoint_path + '.tmp.keras')
+                os.replace(checkpoint_path + '.tmp.keras', checkpoint_path)
+                self.checkpoint_manager.add(filename, epoch, val_loss)
+            except Exception as error:
+                self.save_error = error
@@ -0,0 +1,667 @@
+# Benchmark.py
+# Latency and throughput comparisons between inference and training paths of the Denoising Wavenet
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+import tensorflow as tf
+import util
+import models
+import export
+import datasets
+import denoise
+import tflite_runner
+import sharding
+import checkpoints
+import input_pipeline
+
+try:
+    from pesq import pesq
+except ImportError:
+    pesq = None
+
+
+def time_calls(function, num_calls):
+
+    latencies = []
+    for _ in range(num_calls):
+        start_time = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start_time)
+    return np.array(latencies)
+
+
+def summarize_latencies(name, latencies, num_output_samples, sample_rate):
+
+    total_time = np.sum(latencies)
+    print('%-32s mean %8.2f ms  p50 %8.2f ms  p95 %8.2f ms  %10.1f samples/s  RTF %.3f' % (
+        name, 1000 * np.mean(latencies), 1000 * np.percentile(latencies, 50), 1000 * np.percentile(latencies, 95),
+        num_output_samples / total_time, total_time / (num_output_samples / float(sample_rate))))
+
+
+def get_random_batch(model, batch_size):
+
+    return {'data_input': np.random.uniform(-0.1, 0.1, (batch_size, model.input_length)).astype('float32'),
+            'condition_input': np.zeros((batch_size, model.condition_input_length), dtype='float32')}
+
+
+def benchmark_compiled_inference(config, cla, batch_size, num_batches):
+
+    model = models.DenoisingWavenet(config, target_field_length=cla.target_field_length,
+                                    load_checkpoint=cla.load_checkpoint)
+    batch = get_random_batch(model, batch_size)
+    num_output_samples = num_batches * batch_size * model.target_field_length
+    sample_rate = config['dataset']['sample_rate']
+
+    model.denoise_batch(batch)
+    summarize_latencies('predict_on_batch', time_calls(lambda: model.denoise_batch(batch), num_batches),
+                        num_output_samples, sample_rate)
+
+    for jit_compile in [False, True]:
+        start_time = time.perf_counter()
+        model.compile_inference(batch_size, jit_compile=jit_compile)
+        print('Compile and warm-up (jit_compile=%s): %.2f s' % (jit_compile, time.perf_counter() - start_time))
+        summarize_latencies('tf.function (jit_compile=%s)' % jit_compile,
+                            time_calls(lambda: model.denoise_batch(batch), num_batches),
+                            num_output_samples, sample_rate)
+
+
+# Serving measurements run in a fresh process, so startup time and peak RSS include the imports each path needs
+SERVING_MEASUREMENT_CODE = """
+import time
+start_time = time.perf_counter()
+%s
+import json
+import numpy as np
+
+batch = {'data_input': np.random.uniform(-0.1, 0.1, (batch_size, model.input_length)).astype('float32'),
+         'condition_input': np.zeros((batch_size, model.condition_input_length), dtype='float32')}
+model.denoise_batch(batch)
+startup_time = time.perf_counter() - start_time
+
+start_time = time.perf_counter()
+for _ in range(%d):
+    model.denoise_batch(batch)
+print(json.dumps({
+    'startup_s': startup_time,
+    'peak_rss_mb': [int(line.split()[1]) / 1024.0 for line in open('/proc/self/status') if line.startswith('VmHWM')][0],
+    'samples_per_s': %d * batch_size * model.target_field_length / (time.perf_counter() - start_time)
+}))
+"""
+
+KERAS_SERVING_SETUP_CODE = """
+import json
+import models
+config = json.load(open(%r, 'r'))
+model = models.DenoisingWavenet(config, load_checkpoint=%r, target_field_length=%d)
+batch_size = config['training']['batch_size']
+"""
+
+CONDITION_FOLDED_SERVING_SETUP_CODE = KERAS_SERVING_SETUP_CODE + """
+model.fold_condition([0] * model.condition_input_length)
+"""
+
+TFLITE_SERVING_SETUP_CODE = """
+import tflite_runner
+model = tflite_runner.TFLiteModel(%r)
+batch_size = model.batch_size
+"""
+
+
+# Training steps in a fresh process, so peak RSS is not inflated by the other graph variant
+TRAINING_MEASUREMENT_CODE = """
+import json
+import time
+import models
+import numpy as np
+config = json.load(open(%r, 'r'))
+model = models.DenoisingWavenet(config, load_checkpoint=%r)
+batch_size = config['training']['batch_size']
+inputs = {'data_input': np.random.uniform(-0.1, 0.1, (batch_size, model.input_length)).astype('float32'),
+          'condition_input': np.zeros((batch_size, model.condition_input_length), dtype='float32')}
+targets = {'data_output_1': np.zeros((batch_size, model.padded_target_field_length), dtype='float32'),
+           'data_output_2': np.zeros((batch_size, model.padded_target_field_length), dtype='float32')}
+model.model.train_on_batch(inputs, targets)
+start_time = time.perf_counter()
+for _ in range(%d):
+    model.model.train_on_batch(inputs, targets)
+print(json.dumps({
+    'peak_rss_mb': [int(line.split()[1]) / 1024.0 for line in open('/proc/self/status') if line.startswith('VmHWM')][0],
+    'step_ms': 1000 * (time.perf_counter() - start_time) / %d
+}))
+"""
+
+
+def run_measurement_process(code):
+
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+    return json.loads(output.decode().strip().split('\n')[-1])
+
+
+def benchmark_export(config, cla, batch_size, num_batches):
+
+    config['training']['batch_size'] = batch_size
+    model = models.DenoisingWavenet(config, target_field_length=cla.target_field_length,
+                                    load_checkpoint=cla.load_checkpoint)
+
+    with tempfile.TemporaryDirectory() as export_path:
+        tflite_path = export.export_model(model, export_path, batch_size)[0]
+        config_path = os.path.join(export_path, 'config.json')
+        with open(config_path, 'w') as config_file:
+            json.dump(config, config_file)
+
+        results = {
+            'keras': run_measurement_process(SERVING_MEASUREMENT_CODE % (KERAS_SERVING_SETUP_CODE % (
+                config_path, cla.load_checkpoint, model.target_field_length), num_batches, num_batches)),
+            'tflite': run_measurement_process(SERVING_MEASUREMENT_CODE % (TFLITE_SERVING_SETUP_CODE % tflite_path,
+                                                                          num_batches, num_batches))
+        }
+
+    for name, result in results.items():
+        print('%-8s startup %8.2f s  peak RSS %8.1f MB  %10.1f samples/s' % (
+            name, result['startup_s'], result['peak_rss_mb'], result['samples_per_s']))
+
+
+def evaluate_denoising(model, dataset, num_eval_files, condition_input, sample_rate):
+
+    snrs = []
+    pesqs = []
+    num_output_samples = 0
+    total_time = 0
+    for sequence_num in range(min(num_eval_files, len(dataset.sequences['test']['clean']))):
+        clean = dataset.retrieve_sequence('test', 'clean', sequence_num)
+        noisy = dataset.retrieve_sequence('test', 'noisy', sequence_num)
+        if len(noisy) < model.receptive_field_length:
+            continue
+
+        start_time = time.perf_counter()
+        denoised_output, _ = tflite_runner.denoise_signal(model, noisy, condition_input)
+        total_time += time.perf_counter() - start_time
+        num_output_samples += len(denoised_output)
+
+        valid_clean_signal = clean[model.half_receptive_field_length:
+                                   model.half_receptive_field_length + len(denoised_output)]
+        snrs.append(util.snr_db(util.rms(valid_clean_signal), util.rms(denoised_output - valid_clean_signal)))
+        if pesq is not None:
+            try:
+                pesqs.append(pesq(sample_rate, valid_clean_signal, denoised_output.astype('float64'), 'wb'))
+            except Exception:
+                pass
+
+    return {
+        'snr_db': float(np.mean(snrs)),
+        'pesq': float(np.mean(pesqs)) if len(pesqs) > 0 else None,
+        'samples_per_s': num_output_samples / total_time
+    }
+
+
+def benchmark_quantization(config, cla, batch_size, num_batches):
+
+    model = models.DenoisingWavenet(config, target_field_length=cla.target_field_length,
+                                    load_checkpoint=cla.load_checkpoint)
+    dataset = datasets.NSDTSEADataset(config, model).load_dataset()
+    condition_input = util.get_condition_input_encode_func(config['model']['condition_encoding'])(
+        int(cla.condition_value), model.num_condition_classes)[0]
+    sample_rate = config['dataset']['sample_rate']
+
+    report = {}
+    with tempfile.TemporaryDirectory() as export_path:
+        tflite_paths = export.export_model(model, export_path, batch_size, export.QUANTIZATIONS, dataset,
+                                           int(cla.num_calibration_batches))
+        for quantization, tflite_path in zip(export.QUANTIZATIONS, tflite_paths):
+            name = 'float32' if quantization is None else quantization
+            print('Evaluating: ' + name)
+            # --num_batches sets the number of test files to denoise
+            report[name] = evaluate_denoising(tflite_runner.TFLiteModel(tflite_path), dataset, num_batches,
+                                              condition_input, sample_rate)
+            report[name]['size_mb'] = os.path.getsize(tflite_path) / (1024.0 * 1024.0)
+
+    for name, result in report.items():
+        result['snr_db_delta'] = result['snr_db'] - report['float32']['snr_db']
+        result['pesq_delta'] = None if result['pesq'] is None else result['pesq'] - report['float32']['pesq']
+        result['speedup'] = result['samples_per_s'] / report['float32']['samples_per_s']
+        print('%-8s size %7.2f MB  %10.1f samples/s (x%.2f)  SNR %6.2f dB (%+.2f)  PESQ %s' % (
+            name, result['size_mb'], result['samples_per_s'], result['speedup'], result['snr_db'],
+            result['snr_db_delta'], 'n/a' if result['pesq'] is None else '%.2f (%+.2f)' % (
+                result['pesq'], result['pesq_delta'])))
+
+    report_path = os.path.join(config['training']['path'], 'quantization_report.json')
+    util.pretty_json_dump(report, report_path)
+    print('Quantization report written to: ' + report_path)
+
+
+def benchmark_speech_gating(config, cla, batch_size, num_batches):
+
+    model = models.DenoisingWavenet(config, target_field_length=cla.target_field_length,
+                                    load_checkpoint=cla.load_checkpoint)
+    dataset = datasets.NSDTSEADataset(config, model).load_dataset()
+    condition_input = util.get_condition_input_encode_func(config['model']['condition_encoding'])(
+        int(cla.condition_value), model.num_condition_classes)[0]
+
+    # --num_batches sets the number of test files to denoise
+    for speech_gating in [None, 'attenuate', 'wiener']:
+        snrs = []
+        num_model_fragments = 0
+        num_fragments = 0
+        start_time = time.perf_counter()
+        for sequence_num in range(min(num_batches, len(dataset.sequences['test']['clean']))):
+            clean = dataset.retrieve_sequence('test', 'clean', sequence_num)
+            noisy = dataset.retrieve_sequence('test', 'noisy', sequence_num)
+            if len(noisy) < model.receptive_field_length:
+                continue
+
+            denoised_output, _, file_model_fragments, file_fragments = denoise.denoise_signal(
+                model, noisy, condition_input, batch_size, speech_gating, float(cla.gating_attenuation),
+                show_progress=False)
+            num_model_fragments += file_model_fragments
+            num_fragments += file_fragments
+
+            valid_clean_signal = clean[model.half_receptive_field_length:
+                                       model.half_receptive_field_length + len(denoised_output)]
+            snrs.append(util.snr_db(util.rms(valid_clean_signal), util.rms(denoised_output - valid_clean_signal)))
+
+        print('%-10s model fragments %6d/%-6d (%5.1f%% of FLOPs)  %8.2f s  SNR %6.2f dB' % (
+            'ungated' if speech_gating is None else speech_gating, num_model_fragments, num_fragments,
+            100.0 * num_model_fragments / max(num_fragments, 1), time.perf_counter() - start_time, np.mean(snrs)))
+
+
+def get_activation_bytes(function, *args):
+
+    # Bytes of all intermediate tensors in the traced graph, weights excluded: what a batch allocates at most
+    graph = tf.function(function).get_concrete_function(*args).graph
+    num_bytes = 0
+    for operation in graph.get_operations():
+        if operation.type in ['Const', 'ReadVariableOp', 'VarHandleOp', 'Placeholder']:
+            continue
+        for output in operation.outputs:
+            if output.shape.is_fully_defined() and output.dtype.is_floating:
+                num_bytes += output.shape.num_elements() * output.dtype.size
+    return num_bytes
+
+
+def benchmark_condition_folding(config, cla, batch_size, num_batches):
+
+    config['training']['batch_size'] = batch_size
+    model = models.DenoisingWavenet(config, target_field_length=cla.target_field_length,
+                                    load_checkpoint=cla.load_checkpoint)
+    condition_input = util.get_condition_input_encode_func(config['model']['condition_encoding'])(
+        int(cla.condition_value), model.num_condition_classes)[0]
+    batch = get_random_batch(model, batch_size)
+    batch['condition_input'][:] = condition_input
+    num_output_samples = num_batches * batch_size * model.target_field_length
+    sample_rate = config['dataset']['sample_rate']
+
+    outputs = model.denoise_batch(batch)
+    unfolded_activation_bytes = get_activation_bytes(
+        lambda data_input, condition_input: model.model([data_input, condition_input], training=False),
+        tf.TensorSpec((batch_size, model.input_length), tf.float32),
+        tf.TensorSpec((batch_size, model.condition_input_length), tf.float32))
+    unfolded_latencies = time_calls(lambda: model.denoise_batch(batch), num_batches)
+
+    model.fold_condition(condition_input)
+    folded_outputs = model.denoise_batch(batch)
+    folded_activation_bytes = get_activation_bytes(
+        lambda data_input: model.folded_model(data_input, training=False),
+        tf.TensorSpec((batch_size, model.input_length), tf.float32))
+
+    print('Max absolute output difference: %g' % max(
+        np.max(np.abs(output - folded_output)) for output, folded_output in zip(outputs, folded_outputs)))
+    print('Intermediate tensors per batch: %.1f MB unfolded, %.1f MB folded' % (
+        unfolded_activation_bytes / 2.0 ** 20, folded_activation_bytes / 2.0 ** 20))
+    summarize_latencies('predict_on_batch', unfolded_latencies, num_output_samples, sample_rate)
+    summarize_latencies('predict_on_batch (folded)', time_calls(lambda: model.denoise_batch(batch), num_batches),
+                        num_output_samples, sample_rate)
+
+    model.compile_inference(batch_size)
+    summarize_latencies('tf.function (folded)', time_calls(lambda: model.denoise_batch(batch), num_batches),
+                        num_output_samples, sample_rate)
+
+    with tempfile.TemporaryDirectory() as config_folder_path:
+        config_path = os.path.join(config_folder_path, 'config.json')
+        with open(config_path, 'w') as config_file:
+            json.dump(config, config_file)
+
+        for name, setup_code in [('keras', KERAS_SERVING_SETUP_CODE),
+                                 ('folded', CONDITION_FOLDED_SERVING_SETUP_CODE)]:
+            result = run_measurement_process(SERVING_MEASUREMENT_CODE % (setup_code % (
+                config_path, cla.load_checkpoint, model.target_field_length), num_batches, num_batches))
+            print('%-8s startup %8.2f s  peak RSS %8.1f MB  %10.1f samples/s' % (
+                name, result['startup_s'], result['peak_rss_mb'], result['samples_per_s']))
+
+
+def get_training_activation_bytes(model, batch_size):
+
+    # Forward and backward pass of one training step, as traced by tf.function
+    def training_step(data_input, condition_input):
+        with tf.GradientTape() as tape:
+            outputs = model.model([data_input, condition_input], training=True)
+            loss = tf.reduce_sum(outputs[0]) + tf.reduce_sum(outputs[1])
+        return tape.gradient(loss, model.model.trainable_variables)
+
+    return get_activation_bytes(training_step, tf.TensorSpec((batch_size, model.input_length), tf.float32),
+                                tf.TensorSpec((batch_size, model.condition_input_length), tf.float32))
+
+
+def benchmark_memory_lean(config, cla, batch_size, num_batches):
+
+    config['training']['batch_size'] = batch_size
+    results = {}
+    with tempfile.TemporaryDirectory() as config_folder_path:
+        for memory_lean in [False, True]:
+            config['model']['memory_lean'] = memory_lean
+            model = models.DenoisingWavenet(config, target_field_length=cla.target_field_length,
+                                            load_checkpoint=cla.load_checkpoint)
+            config_path = os.path.join(config_folder_path, 'config_%s.json' % memory_lean)
+            with open(config_path, 'w') as config_file:
+                json.dump(model.config, config_file)
+
+            result = run_measurement_process(TRAINING_MEASUREMENT_CODE % (
+                config_path, cla.load_checkpoint, num_batches, num_batches))
+            result['activation_mb'] = get_training_activation_bytes(model, batch_size) / 2.0 ** 20
+            results['memory_lean' if memory_lean else 'standard'] = result
+
+    for name, result in results.items():
+        print('%-12s training step %8.2f ms  peak RSS %8.1f MB  step tensors %8.1f MB' % (
+            name, result['step_ms'], result['peak_rss_mb'], result['activation_mb']))
+    print('memory_lean saves %.1f MB peak RSS (%.1f MB of step tensors) and %.1f%% step time' % (
+        results['standard']['peak_rss_mb'] - results['memory_lean']['peak_rss_mb'],
+        results['standard']['activation_mb'] - results['memory_lean']['activation_mb'],
+        100.0 * (1 - results['memory_lean']['step_ms'] / results['standard']['step_ms'])))
+
+
+def get_model_flops(keras_model):
+
+    # Multiply-adds of the convolution and dense layers, two FLOPs each. Elementwise layers are left out
+    flops = 0
+    for layer in keras_model.layers:
+        if isinstance(layer, tf.keras.layers.Conv1D):
+            flops += 2 * np.prod(layer.output.shape[1:]) * layer.kernel_size[0] * layer.input.shape[-1]
+        elif isinstance(layer, tf.keras.layers.Dense):
+            flops += 2 * layer.input.shape[-1] * layer.units
+    return flops
+
+
+def benchmark_progressive_cropping(config, cla, batch_size, num_batches):
+
+    config['training']['batch_size'] = batch_size
+    sample_rate = config['dataset']['sample_rate']
+    results = {}
+    outputs = {}
+    with tempfile.TemporaryDirectory() as config_folder_path:
+        weights_path = os.path.join(config_folder_path, 'standard.weights.h5')
+        for progressive_cropping in [False, True]:
+            name = 'cropped' if progressive_cropping else 'standard'
+            config['model']['progressive_cropping'] = progressive_cropping
+            model = models.DenoisingWavenet(config, target_field_length=cla.target_field_length,
+                                            load_checkpoint=cla.load_checkpoint)
+            # The cropped model loads the standard model's weights file, as it would a checkpoint
+            if progressive_cropping:
+                model.model.load_weights(weights_path)
+            else:
+                model.model.save_weights(weights_path)
+            config_path = os.path.join(config_folder_path, 'config_%s.json' % name)
+            with open(config_path, 'w') as config_file:
+                json.dump(model.config, config_file)
+
+            np.random.seed(0)
+            batch = get_random_batch(model, batch_size)
+            outputs[name] = model.denoise_batch(batch)
+            results[name] = run_measurement_process(TRAINING_MEASUREMENT_CODE % (
+                config_path, cla.load_checkpoint, num_batches, num_batches))
+            # Per batch; a training step costs about three forward passes
+            results[name]['inference_gflops'] = get_model_flops(model.model) * batch_size / 1e9
+            results[name]['training_gflops'] = 3 * results[name]['inference_gflops']
+            summarize_latencies('denoise_batch (%s)' % name, time_calls(lambda: model.denoise_batch(batch),
+                                                                        num_batches),
+                                num_batches * batch_size * model.target_field_length, sample_rate)
+
+    print('Max absolute output difference: %g' % max(
+        np.max(np.abs(output - cropped_output)) for output, cropped_output in zip(outputs['standard'],
+                                                                                 outputs['cropped'])))
+    for name, result in results.items():
+        print('%-10s inference %8.3f GFLOPs/batch  training %8.3f GFLOPs/batch  step %8.2f ms  peak RSS %8.1f MB' % (
+            name, result['inference_gflops'], result['training_gflops'], result['step_ms'], result['peak_rss_mb']))
+    print('Progressive cropping saves %.1f%% of FLOPs and %.1f%% training step time' % (
+        100.0 * (1 - results['cropped']['inference_gflops'] / results['standard']['inference_gflops']),
+        100.0 * (1 - results['cropped']['step_ms'] / results['standard']['step_ms'])))
+
+
+def benchmark_mixed_precision(config, cla, batch_size, num_batches):
+
+    # Same weights under each policy: step time and peak RSS from fresh training processes, validation MAE from
+    # num_batches test batches drawn with the same seed
+    config['training']['batch_size'] = batch_size
+    results = {}
+    with tempfile.TemporaryDirectory() as config_folder_path:
+        weights_path = os.path.join(config_folder_path, 'float32.weights.h5')
+        for mixed_precision in [None, 'mixed_bfloat16']:
+            name = mixed_precision or 'float32'
+            config['model']['mixed_precision'] = mixed_precision
+            model = models.DenoisingWavenet(config, target_field_length=cla.target_field_length,
+                                            load_checkpoint=cla.load_checkpoint)
+            if mixed_precision is None:
+                model.model.save_weights(weights_path)
+            else:
+                model.model.load_weights(weights_path)
+            config_path = os.path.join(config_folder_path, 'config_%s.json' % name)
+            with open(config_path, 'w') as config_file:
+                json.dump(model.config, config_file)
+
+            results[name] = run_measurement_process(TRAINING_MEASUREMENT_CODE % (
+                config_path, cla.load_checkpoint, num_batches, num_batches))
+
+            np.random.seed(0)
+            dataset = datasets.NSDTSEADataset(config, model).load_dataset()
+            metrics = model.model.evaluate(dataset.get_random_batch_generator('test'), steps=num_batches,
+                                           verbose=0, return_dict=True)
+            results[name]['val_mae'] = [value for key, value in sorted(metrics.items())
+                                        if key.endswith('mean_absolute_error')][0]
+
+    for name, result in results.items():
+        print('%-16s training step %8.2f ms  peak RSS %8.1f MB  validation MAE %.5f' % (
+            name, result['step_ms'], result['peak_rss_mb'], result['val_mae']))
+
+
+def benchmark_gradient_accumulation(config, cla, batch_size, num_batches):
+
+    # Micro-batches of batch_size accumulated K times, against one batch of K * batch_size, which has the same
+    # effective batch but needs K times the activation memory
+    results = []
+    with tempfile.TemporaryDirectory() as config_folder_path:
+        for accumulation_steps in [1, 2, 4, 8]:
+            for name, micro_batch_size in [('accumulated', batch_size),
+                                           ('full batch', accumulation_steps * batch_size)]:
+                if accumulation_steps == 1 and name == 'full batch':
+                    continue
+                config['training']['batch_size'] = micro_batch_size
+                config['training']['effective_batch_size'] = accumulation_steps * batch_size
+                config_path = os.path.join(config_folder_path, 'config.json')
+                with open(config_path, 'w') as config_file:
+                    json.dump(config, config_file)
+
+                result = run_measurement_process(TRAINING_MEASUREMENT_CODE % (
+                    config_path, cla.load_checkpoint, num_batches, num_batches))
+                results.append((name, accumulation_steps, micro_batch_size, result))
+
+    for name, accumulation_steps, micro_batch_size, result in results:
+        print('%-12s effective batch %4d  micro-batch %4d  %10.1f samples/s  peak RSS %8.1f MB' % (
+            name, accumulation_steps * batch_size, micro_batch_size,
+            1000.0 * micro_batch_size / result['step_ms'], result['peak_rss_mb']))
+
+
+def benchmark_fast_start(config, cla, batch_size, num_batches):
+
+    # Wall time of whole inference runs from process start until the outputs are written, which for a short
+    # input is dominated by startup
+    if cla.noisy_input_path is None:
+        raise ValueError('The fast_start benchmark needs --noisy_input_path, ideally a single short wav file')
+
+    checkpoint_path, _ = checkpoints.get_checkpoint_path(
+        os.path.join(config['training']['path'], 'checkpoints'), cla.load_checkpoint)
+    if checkpoint_path is None:
+        raise ValueError('The fast_start benchmark needs a trained checkpoint')
+
+    # A scratch session holding a copy of the checkpoint, so the first fast-start run misses the cache and no
+    # outputs are written to the real session
+    with tempfile.TemporaryDirectory() as session_path:
+        config['training']['path'] = session_path
+        os.makedirs(os.path.join(session_path, 'checkpoints'))
+        shutil.copy(checkpoint_path, os.path.join(session_path, 'checkpoints'))
+        config_path = os.path.join(session_path, 'config.json')
+        with open(config_path, 'w') as config_file:
+            json.dump(config, config_file)
+
+        command = [sys.executable, 'main.py', '--mode', 'inference', '--config', config_path,
+                   '--batch_size', str(batch_size), '--noisy_input_path', os.path.abspath(cla.noisy_input_path)]
+        if cla.target_field_length is not None:
+            command += ['--target_field_length', str(cla.target_field_length)]
+
+        for name, options in [('keras', []), ('fast_start, cache miss', ['--fast_start', '1']),
+                              ('fast_start, cached', ['--fast_start', '1'])]:
+            start_time = time.perf_counter()
+            subprocess.run(command + options, cwd=os.path.dirname(os.path.abspath(__file__)),
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            print('%-24s %8.2f s' % (name, time.perf_counter() - start_time))
+
+
+def benchmark_distillation(config, cla, batch_size, num_batches):
+
+    # config is the student, --teacher_config its teacher. Both denoise the same test files through compiled
+    # Keras inference
+    if cla.teacher_config is None:
+        raise ValueError('The distillation benchmark needs the teacher config in --teacher_config')
+    with open(cla.teacher_config, 'r') as teacher_config_file:
+        teacher_config = json.load(teacher_config_file)
+
+    student = models.DenoisingWavenet(config, target_field_length=cla.target_field_length,
+                                      load_checkpoint=cla.load_checkpoint, inference_only=True)
+    teacher = models.DenoisingWavenet(teacher_config, target_field_length=cla.target_field_length,
+                                      inference_only=True)
+    dataset = datasets.NSDTSEADataset(config, student).load_dataset()
+    condition_input = util.get_condition_input_encode_func(config['model']['condition_encoding'])(
+        int(cla.condition_value), student.num_condition_classes)[0]
+    sample_rate = config['dataset']['sample_rate']
+
+    report = {}
+    for name, model in [('teacher', teacher), ('student', student)]:
+        print('Evaluating: ' + name)
+        model.compile_inference(batch_size)
+        # --num_batches sets the number of test files to denoise
+        report[name] = evaluate_denoising(model, dataset, num_batches, condition_input, sample_rate)
+        report[name]['num_params'] = model.model.count_params()
+        report[name]['receptive_field_length'] = model.receptive_field_length
+
+    for name, result in report.items():
+        result['snr_db_delta'] = result['snr_db'] - report['teacher']['snr_db']
+        result['pesq_delta'] = None if result['pesq'] is None else result['pesq'] - report['teacher']['pesq']
+        result['speedup'] = result['samples_per_s'] / report['teacher']['samples_per_s']
+        print('%-8s %9d params  receptive field %6d  %10.1f samples/s (x%.2f, %.2fx real time)  SNR %6.2f dB (%+.2f)'
+              '  PESQ %s' % (name, result['num_params'], result['receptive_field_length'], result['samples_per_s'],
+                             result['speedup'], result['samples_per_s'] / sample_rate, result['snr_db'],
+                             result['snr_db_delta'], 'n/a' if result['pesq'] is None else '%.2f (%+.2f)' % (
+                                 result['pesq'], result['pesq_delta'])))
+
+    report_path = os.path.join(config['training']['path'], 'distillation_report.json')
+    util.pretty_json_dump(report, report_path)
+    print('Distillation report written to: ' + report_path)
+
+
+def benchmark_input_pipeline(config, cla, batch_size, num_batches):
+
+    # Training steps fed by the per-sample and the fragment table batch generators and by the tf.data pipeline.
+    # Stall time is how long each step waits for its batch: the generators build it on the training thread, tf.data
+    # has it prefetched
+    config['training']['batch_size'] = batch_size
+    model = models.DenoisingWavenet(config, load_checkpoint=cla.load_checkpoint)
+    dataset = datasets.NSDTSEADataset(config, model).load_dataset()
+
+    for name, batches in [('per-sample', dataset.get_per_sample_batch_generator('train')),
+                          ('fragment', dataset.get_fragment_batch_generator('train')),
+                          ('tf.data', input_pipeline.get_batch_dataset(dataset, 'train'))]:
+        iterator = iter(batches)
+        loader_latencies = time_calls(lambda: next(iterator), num_batches)
+        model.model.train_on_batch(*next(iterator))
+
+        stall_latencies = []
+        start_time = time.perf_counter()
+        for _ in range(num_batches):
+            batch_start_time = time.perf_counter()
+            inputs, targets = next(iterator)
+            stall_latencies.append(time.perf_counter() - batch_start_time)
+            model.model.train_on_batch(inputs, targets)
+        step_time = (time.perf_counter() - start_time) / num_batches
+
+        print('%-10s loader alone %8.2f ms/batch  training step %8.2f ms  stall %8.2f ms/step (%5.1f%%)' % (
+            name, 1000 * np.mean(loader_latencies), 1000 * step_time, 1000 * np.mean(stall_latencies),
+            100 * np.mean(stall_latencies) / step_time))
+
+
+def benchmark_dataset_loading(config, cla, batch_size, num_batches):
+
+    # Decoding every WAV file of the dataset serially and on thread and process pools of growing size. The
+    # preprocessed shards are bypassed, and every parallel load is checked against the serial one. A first,
+    # unreported load warms the page cache, so all loads read the files from memory
+    config['dataset']['preprocessed_path'] = tempfile.mkdtemp()
+    os.rmdir(config['dataset']['preprocessed_path'])
+    num_cores = len(sharding.get_available_cores())
+    worker_counts = sorted(set([2, 4, num_cores]) - set([1]))
+
+    config['dataset']['num_loading_workers'] = 1
+    datasets.NSDTSEADataset(config, None).load_dataset()
+    serial_dataset = None
+    for loading_pool, num_loading_workers in [('serial', 1)] + [(loading_pool, num_loading_workers) for loading_pool
+                                                               in ['thread', 'process']
+                                                               for num_loading_workers in worker_counts]:
+        config['dataset']['loading_pool'] = loading_pool
+        config['dataset']['num_loading_workers'] = num_loading_workers
+        start_time = time.perf_counter()
+        dataset = datasets.NSDTSEADataset(config, None).load_dataset()
+        load_time = time.perf_counter() - start_time
+
+        if serial_dataset is None:
+            serial_dataset, serial_load_time = dataset, load_time
+        identical = dataset.speaker_mapping == serial_dataset.speaker_mapping and all(
+            dataset.file_paths[set] == serial_dataset.file_paths[set] and
+            dataset.regain_factors[set] == serial_dataset.regain_factors[set] and
+            dataset.voice_indices[set] == serial_dataset.voice_indices[set] for set in ['train', 'test'])
+        print('%-8s %3d workers  %8.2f s (x%.2f)  identical to serial: %s  (%d available cores)' % (
+            loading_pool, num_loading_workers, load_time, serial_load_time / load_time, identical, num_cores))
+
+
+BENCHMARKS = {
+    'compiled_inference': benchmark_compiled_inference,
+    'export': benchmark_export,
+    'quantization': benchmark_quantization,
+    'speech_gating': benchmark_speech_gating,
+    'condition_folding': benchmark_condition_folding,
+    'memory_lean': benchmark_memory_lean,
+    'progressive_cropping': benchmark_progressive_cropping,
+    'mixed_precision': benchmark_mixed_precision,
+    'gradient_accumulation': benchmark_gradient_accumulation,
+    'fast_start': benchmark_fast_start,
+    'distillation': benchmark_distillation,
+    'input_pipeline': benchmark_input_pipeline,
+    'dataset_loading': benchmark_dataset_loading,
+}
+
+
+def run_benchmark(config, cla):
+
+    if cla.benchmark not in BENCHMARKS:
+        raise ValueError('Unknown benchmark: %s, choose one of %s' % (cla.benchmark, ', '.join(BENCHMARKS)))
+
+    if cla.target_field_length is not None:
+        cla.target_field_length = int(cla.target_field_length)
+
+    if cla.batch_size is not None:
+        batch_size = int(cla.batch_size)
+    else:
+        batch_size = config['training']['batch_size']
+
+    BENCHMARKS[cla.benchmark](config, cla, batch_size, int(cla.num_batches))
@@ -0,0 +1,120 @@
+# Checkpoints.py
+# Checkpoint manager: a manifest of saved epochs for constant-time latest and best lookup and a retention policy.
+# Needs no TensorFlow, so inference can find its checkpoint before deciding whether to import it
+
+import os
+import re
+import json
+import math
+
+MANIFEST_FILENAME = 'checkpoints.json'
+
+
+class CheckpointManager():
+
+    def __init__(self, checkpoints_path, max_to_keep=5):
+
+        self.checkpoints_path = checkpoints_path
+        self.manifest_path = os.path.join(checkpoints_path, MANIFEST_FILENAME)
+        self.max_to_keep = max_to_keep
+        self.checkpoints = []
+
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as manifest_file:
+                self.checkpoints = json.load(manifest_file)['checkpoints']
+
+    def has_manifest(self):
+        return os.path.exists(self.manifest_path)
+
+    def get_checkpoint_filename(self, epoch, val_loss):
+        return 'checkpoint.%05d-%.3f.keras' % (epoch, val_loss if val_loss is not None else float('nan'))
+
+    def get_latest(self):
+
+        # (path, epoch) of the last saved checkpoint, or (None, 0)
+        if len(self.checkpoints) == 0:
+            return None, 0
+        checkpoint = self.checkpoints[-1]
+        return os.path.join(self.checkpoints_path, checkpoint['filename']), checkpoint['epoch']
+
+    def get_best(self):
+
+        # (path, epoch) of the checkpoint with the lowest validation loss, or (None, 0)
+        checkpoints = [checkpoint for checkpoint in self.checkpoints if checkpoint['val_loss'] is not None]
+        if len(checkpoints) == 0:
+            return None, 0
+        checkpoint = min(checkpoints, key=lambda checkpoint: checkpoint['val_loss'])
+        return os.path.join(self.checkpoints_path, checkpoint['filename']), checkpoint['epoch']
+
+    def add(self, filename, epoch, val_loss):
+
+        # Records a checkpoint that is already on disk, then removes the ones the retention policy drops
+        self.checkpoints = [checkpoint for checkpoint in self.checkpoints if checkpoint['filename'] != filename]
+        self.checkpoints.append({'filename': filename, 'epoch': epoch, 'val_loss': val_loss})
+
+        # The last max_to_keep checkpoints and the best one are kept
+        best_path, _ = self.get_best()
+        latest = self.checkpoints[-self.max_to_keep:]
+        removed = [checkpoint for checkpoint in self.checkpoints if checkpoint not in latest and
+                   os.path.join(self.checkpoints_path, checkpoint['filename']) != best_path]
+        self.checkpoints = [checkpoint for checkpoint in self.checkpoints if checkpoint not in removed]
+        self.save()
+
+        # Files go only after the manifest no longer lists them
+        for checkpoint in removed:
+            checkpoint_path = os.path.join(self.checkpoints_path, checkpoint['filename'])
+            if os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+
+    def save(self):
+
+        temporary_manifest_path = self.manifest_path + '.tmp'
+        with open(temporary_manifest_path, 'w') as manifest_file:
+            json.dump({'checkpoints': self.checkpoints}, manifest_file, indent=4)
+        os.replace(temporary_manifest_path, self.manifest_path)
+
+
+def get_legacy_checkpoints(checkpoints_path):
+
+    # (filename, epoch, val_loss) of the checkpoints of a session from before the checkpoint manifest, oldest first.
+    # Unfinished saves (*.tmp.keras) are left out
+    checkpoints = []
+    for filename in os.listdir(checkpoints_path):
+        match = re.match(r'checkpoint\.(\d+)-(-?[0-9.]+|nan)\.keras$', filename)
+        if match is not None and not filename.endswith('.tmp.keras'):
+            val_loss = float(match.group(2))
+            checkpoints.append((filename, int(match.group(1)), None if math.isnan(val_loss) else val_loss))
+    checkpoints.sort(key=lambda checkpoint: os.stat(os.path.join(checkpoints_path, checkpoint[0])).st_mtime)
+    return checkpoints
+
+
+def get_checkpoint_path(checkpoints_path, load_checkpoint=None):
+
+    # The checkpoint setup_model loads and its epoch number, or None for a new model. load_checkpoint is the path of
+    # a checkpoint, 'best' for the one with the lowest validation loss, or None for the latest. 'best' falls back to
+    # the latest when no checkpoint has a validation loss
+    if not os.path.exists(checkpoints_path):
+        return None, 0
+
+    checkpoint_manager = CheckpointManager(checkpoints_path)
+    if checkpoint_manager.has_manifest():
+        if load_checkpoint == 'best' and checkpoint_manager.get_best()[0] is not None:
+            return checkpoint_manager.get_best()
+        if load_checkpoint is not None and load_checkpoint != 'best':
+            return load_checkpoint, 0
+        return checkpoint_manager.get_latest()
+
+    # Sessions from before the checkpoint manifest
+    checkpoints = get_legacy_checkpoints(checkpoints_path)
+    if len(checkpoints) == 0:
+        return None, 0
+    if load_checkpoint == 'best':
+        scored_checkpoints = [checkpoint for checkpoint in checkpoints if checkpoint[2] is not None]
+        if len(scored_checkpoints) > 0:
+            filename, epoch, _ = min(scored_checkpoints, key=lambda checkpoint: checkpoint[2])
+            return os.path.join(checkpoints_path, filename), epoch
+    elif load_checkpoint is not None:
+        return load_checkpoint, 0
+
+    filename, epoch, _ = checkpoints[-1]
+    return os.path.join(checkpoints_path, filename), epoch
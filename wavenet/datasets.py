@@ -5,6 +5,25 @@ import util
 import os
 import numpy as np
 import logging
+import sharding
+import preprocessing
+import contextlib
+import multiprocessing
+import concurrent.futures
+
+
+def load_file(filepath, condition, sample_rate, regain, extract_voice):
+
+    # The decoded sequence and, for clean files, its regain factor and speech onset and offset indices. A module
+    # function, so process pool workers run it without the dataset
+    sequence = util.load_wav(filepath, sample_rate)
+    if condition != 'clean':
+        return sequence, None, None
+
+    speech_onset_offset_indices = None
+    if extract_voice:
+        speech_onset_offset_indices = util.get_subsequence_with_speech_indices(sequence)
+    return sequence, regain / util.rms(sequence), speech_onset_offset_indices
 
 
 class NSDTSEADataset():
@@ -22,80 +41,169 @@ class NSDTSEADataset():
         self.regain_factors = {'train': [], 'test': []}
         self.speakers = {'train': [], 'test': []}
         self.speaker_mapping = {}
+        # Set by load_preprocessed_dataset: the memory-mapped shards and where each sequence starts in them
+        self.shards = {'train': {}, 'test': {}}
+        self.shard_offsets = {'train': {}, 'test': {}}
         self.batch_size = config['training']['batch_size']
         self.noise_only_percent = config['dataset']['noise_only_percent']
         self.regain = config['dataset']['regain']
         self.extract_voice = config['dataset']['extract_voice']
         self.in_memory_percentage = config['dataset']['in_memory_percentage']
         self.num_sequences_in_memory = 0
+        # 1 loads the files one after another, 0 uses a worker per available core
+        self.num_loading_workers = config['dataset'].get('num_loading_workers', 1) or len(
+            sharding.get_available_cores())
+        self.loading_pool = config['dataset'].get('loading_pool', 'process')
         self.condition_encode_function = util.get_condition_input_encode_func(
             config['model']['condition_encoding'])
+        self.preprocessed_path = preprocessing.get_preprocessed_path(config)
+        self.preprocessing_key = preprocessing.get_index_key(config)
 
     def load_dataset(self):
 
+        index = preprocessing.load_index(self.preprocessed_path, self)
+        if index is not None:
+            return self.load_preprocessed_dataset(index)
+
         print('Loading NSDTSEA dataset...')
 
+        with self.get_loading_pool() as loading_pool:
+            for set in ['train', 'test']:
+                for condition in ['clean', 'noisy']:
+                    current_directory = self.get_directory_path(set, condition)
+
+                    sequences, file_paths, speakers, speech_onset_offset_indices, regain_factors = \
+                        self.load_directory(current_directory, condition, loading_pool)
+
+                    self.file_paths[set][condition] = file_paths
+                    self.speakers[set] = speakers
+                    self.sequences[set][condition] = sequences
+
+                    if condition == 'clean':
+                        self.voice_indices[set] = speech_onset_offset_indices
+                        self.regain_factors[set] = regain_factors
+
+        return self
+
+    def load_preprocessed_dataset(self, index):
+
+        # Sequences are views into the memory-mapped shards, pages are only read when a batch touches them
+        print('Loading preprocessed NSDTSEA dataset from %s...' % self.preprocessed_path)
+
         for set in ['train', 'test']:
             for condition in ['clean', 'noisy']:
-                current_directory = os.path.join(
-                    self.path, condition+'_'+set+'set_wav')
+                shard = preprocessing.open_shard(self.preprocessed_path, set, condition, index)
+                entry = index['sets'][set][condition]
+                self.sequences[set][condition] = [shard[offset:offset + length] for offset, length in
+                                                  zip(entry['offsets'], entry['lengths'])]
+                self.shards[set][condition] = shard
+                self.shard_offsets[set][condition] = entry['offsets']
+                self.file_paths[set][condition] = [os.path.join(self.get_directory_path(set, condition), filename)
+                                                   for filename in entry['filenames']]
+                self.num_sequences_in_memory += len(entry['filenames'])
+
+            self.speakers[set] = index['sets'][set]['speakers']
+            self.voice_indices[set] = index['sets'][set]['clean']['voice_indices']
+            self.regain_factors[set] = index['sets'][set]['clean']['regain_factors']
+
+        self.speaker_mapping = dict(index['speaker_mapping'])
+        return self
 
-                sequences, file_paths, speakers, speech_onset_offset_indices, regain_factors = \
-                    self.load_directory(current_directory, condition)
+    def get_directory_path(self, set, condition):
+        return os.path.join(self.path, condition + '_' + set + 'set_wav')
 
-                self.file_paths[set][condition] = file_paths
-                self.speakers[set] = speakers
-                self.sequences[set][condition] = sequences
+    def get_wav_filenames(self, directory_path):
+        return [filename for filename in os.listdir(directory_path) if filename.endswith('.wav')]
 
-                if condition == 'clean':
-                    self.voice_indices[set] = speech_onset_offset_indices
-                    self.regain_factors[set] = regain_factors
+    def load_file(self, filepath, condition):
+        return load_file(filepath, condition, self.sample_rate, self.regain, self.extract_voice)
 
-        return self
+    def get_loading_pool(self):
+
+        # A pool shared by every directory of a load, so each worker starts once. Processes are spawned rather than
+        # forked from a process that may already run TensorFlow
+        if self.num_loading_workers <= 1:
+            return contextlib.nullcontext()
+        if self.loading_pool == 'process':
+            return concurrent.futures.ProcessPoolExecutor(self.num_loading_workers,
+                                                          mp_context=multiprocessing.get_context('spawn'))
+        if self.loading_pool == 'thread':
+            return concurrent.futures.ThreadPoolExecutor(self.num_loading_workers)
+        raise ValueError("dataset.loading_pool must be either 'process' or 'thread'")
+
+    def load_files(self, filepaths, condition, loading_pool=None):
+
+        # load_file for every path, yielded in the order of filepaths whatever order the workers finish in
+        if loading_pool is None:
+            for filepath in filepaths:
+                yield self.load_file(filepath, condition)
+            return
 
-    def load_directory(self, directory_path, condition):
+        num_files = len(filepaths)
+        for result in loading_pool.map(load_file, filepaths, [condition] * num_files, [self.sample_rate] * num_files,
+                                       [self.regain] * num_files, [self.extract_voice] * num_files,
+                                       chunksize=max(1, num_files // (4 * self.num_loading_workers))):
+            yield result
 
-        filenames = [filename for filename in os.listdir(
-            directory_path) if filename.endswith('.wav')]
+    def add_speaker(self, speaker_name):
+
+        if speaker_name not in self.speaker_mapping:
+            self.speaker_mapping[speaker_name] = len(self.speaker_mapping) + 1
+
+    def load_directory(self, directory_path, condition, loading_pool=None):
+
+        filenames = self.get_wav_filenames(directory_path)
 
         speakers = []
         file_paths = []
         speech_onset_offset_indices = []
         regain_factors = []
         sequences = []
-        for filename in filenames:
 
-            speaker_name = filename[0:4]
-            speakers.append(speaker_name)
+        # Which noisy files to keep in memory is drawn up front, in file order, so the loaded files can be decoded
+        # in parallel. Speakers are mapped here in file order, whatever order the workers finish in
+        filepaths = [os.path.join(directory_path, filename) for filename in filenames]
+        in_memory = [condition == 'clean' or self.in_memory_percentage == 1 or
+                     np.random.uniform(0, 1) <= (self.in_memory_percentage-0.5)*2 for _ in filenames]
+        loaded_files = self.load_files([filepath for filepath, is_in_memory in zip(filepaths, in_memory)
+                                        if is_in_memory], condition, loading_pool)
 
-            filepath = os.path.join(directory_path, filename)
+        for filename, filepath, is_in_memory in zip(filenames, filepaths, in_memory):
 
-            if condition == 'clean':
+            speaker_name = filename[0:4]
+            speakers.append(speaker_name)
 
-                sequence = util.load_wav(filepath, self.sample_rate)
+            if is_in_memory:
+                sequence, regain_factor, speech_onset_offset_index = next(loaded_files)
                 sequences.append(sequence)
                 self.num_sequences_in_memory += 1
-                regain_factors.append(self.regain / util.rms(sequence))
 
-                if self.extract_voice:
-                    speech_onset_offset_indices.append(
-                        util.get_subsequence_with_speech_indices(sequence))
+                if condition == 'clean':
+                    regain_factors.append(regain_factor)
+                    if self.extract_voice:
+                        speech_onset_offset_indices.append(speech_onset_offset_index)
             else:
-                if self.in_memory_percentage == 1 or np.random.uniform(0, 1) <= (self.in_memory_percentage-0.5)*2:
-                    sequence = util.load_wav(filepath, self.sample_rate)
-                    sequences.append(sequence)
-                    self.num_sequences_in_memory += 1
-                else:
-                    sequences.append([-1])
+                sequences.append([-1])
 
-            if speaker_name not in self.speaker_mapping:
-                self.speaker_mapping[speaker_name] = len(
-                    self.speaker_mapping) + 1
+            self.add_speaker(speaker_name)
 
             file_paths.append(filepath)
 
         return sequences, file_paths, speakers, speech_onset_offset_indices, regain_factors
 
+    def shard(self, shard_i, num_shards):
+
+        # Keeps every num_shards-th training file, starting at shard_i, e.g. one shard per training worker
+        for condition in ['clean', 'noisy']:
+            self.file_paths['train'][condition] = self.file_paths['train'][condition][shard_i::num_shards]
+            self.sequences['train'][condition] = self.sequences['train'][condition][shard_i::num_shards]
+            if condition in self.shard_offsets['train']:
+                self.shard_offsets['train'][condition] = self.shard_offsets['train'][condition][shard_i::num_shards]
+        self.voice_indices['train'] = self.voice_indices['train'][shard_i::num_shards]
+        self.regain_factors['train'] = self.regain_factors['train'][shard_i::num_shards]
+        self.speakers['train'] = self.speakers['train'][shard_i::num_shards]
+        return self
+
     def get_num_sequences_in_dataset(self):
         return len(self.sequences['train']['clean']) + len(self.sequences['train']['noisy']) + len(self.sequences['test']['clean']) + len(self.sequences['test']['noisy'])
 
@@ -113,11 +221,104 @@ class NSDTSEADataset():
 
         return np.array(sequence)
 
+    def get_fragment_table(self, set):
+
+        # The clean and noisy sequences of a set as one float32 buffer each, and per file that is long enough for a
+        # fragment: where it starts in the buffers, where its voice region starts within it, how many fragment
+        # offsets the voice region allows, its regain factor and its condition class. A preprocessed dataset's
+        # memory-mapped shards already are these buffers and are used as they are, otherwise the sequences are
+        # concatenated
+        num_files = len(self.sequences[set]['clean'])
+        table = {'file_offsets': [], 'speech_starts': [], 'num_offsets': [], 'regain_factors': [],
+                 'condition_classes': []}
+
+        if self.shards[set] and self.shard_offsets[set]['clean'] == self.shard_offsets[set]['noisy']:
+            buffers = self.shards[set]
+            file_offsets = self.shard_offsets[set]['clean']
+            sequence_lengths = [len(sequence) for sequence in self.sequences[set]['clean']]
+        else:
+            buffers = {'clean': [], 'noisy': []}
+            for sequence_num in range(num_files):
+                for condition in ['clean', 'noisy']:
+                    buffers[condition].append(np.asarray(self.retrieve_sequence(set, condition, sequence_num),
+                                                         dtype='float32'))
+            sequence_lengths = [len(sequence) for sequence in buffers['clean']]
+            file_offsets = np.concatenate([[0], np.cumsum(sequence_lengths)[:-1]]).astype('int64')
+            buffers = dict((condition, np.concatenate(sequences)) for condition, sequences in buffers.items())
+
+        for sequence_num in range(num_files):
+            sequence_length = sequence_lengths[sequence_num]
+
+            speech_start, speech_end = 0, sequence_length
+            if self.extract_voice:
+                speech_start = min(self.voice_indices[set][sequence_num][0], sequence_length)
+                speech_end = min(self.voice_indices[set][sequence_num][1], sequence_length)
+
+            # get_random_batch_generator draws offsets below len(speech) - input_length
+            if speech_end - speech_start > self.model.input_length:
+                table['file_offsets'].append(file_offsets[sequence_num])
+                table['speech_starts'].append(speech_start)
+                table['num_offsets'].append(speech_end - speech_start - self.model.input_length)
+                table['regain_factors'].append(self.regain_factors[set][sequence_num])
+                condition_class = self.speaker_mapping[self.speakers[set][sequence_num]]
+                table['condition_classes'].append(condition_class if condition_class <= 28 else 0)
+
+        if len(table['file_offsets']) == 0:
+            raise ValueError('No %s file is longer than the model input length (%d)' % (set, self.model.input_length))
+
+        table = dict((name, np.array(values, dtype='float32' if name == 'regain_factors' else 'int64'))
+                     for name, values in table.items())
+        table.update(buffers)
+        return table
+
     def get_random_batch_generator(self, set):
 
         if set not in ['train', 'test']:
             raise ValueError("Argument SET must be either 'train' or 'test'")
 
+        # The fragment table holds the whole set in memory, which in_memory_percentage below 1 is meant to avoid
+        if self.in_memory_percentage == 1:
+            return self.get_fragment_batch_generator(set)
+        return self.get_per_sample_batch_generator(set)
+
+    def get_fragment_batch_generator(self, set):
+
+        # Same sampling as get_per_sample_batch_generator, drawn for the whole batch at once and gathered from the
+        # fragment table, so building a batch costs the same however long the files are. Drawing only among files
+        # long enough for a fragment is what the per-sample retries amount to. As there, the noise fragment starts
+        # at the offset from the start of the file, not from the voice region
+        table = self.get_fragment_table(set)
+        num_files = len(table['file_offsets'])
+        sample_range = np.arange(self.model.input_length)
+        target_indices = self.model.get_padded_target_field_indices()
+
+        while True:
+            files = np.random.randint(0, num_files, self.batch_size)
+            offsets = np.random.randint(0, table['num_offsets'][files])
+
+            noise_indices = (table['file_offsets'][files] + offsets)[:, None] + sample_range
+            speech_indices = noise_indices + table['speech_starts'][files][:, None]
+            regain_factors = table['regain_factors'][files][:, None]
+            speech = table['clean'][speech_indices] * regain_factors
+            noise = (table['noisy'][noise_indices] - table['clean'][noise_indices]) * regain_factors
+
+            batch_inputs = speech + noise
+            if self.noise_only_percent > 0:
+                noise_only = np.random.uniform(0, 1, self.batch_size) <= self.noise_only_percent
+                batch_inputs[noise_only] = noise[noise_only]
+                speech[noise_only] = 0
+
+            condition_inputs = np.where(
+                np.random.uniform(0, 1, self.batch_size) <= 1.0 / self.get_num_condition_classes(), 0,
+                table['condition_classes'][files])
+            condition_inputs = self.condition_encode_function(condition_inputs.astype('uint8'),
+                                                              self.model.num_condition_classes)
+
+            yield {'data_input': batch_inputs, 'condition_input': condition_inputs}, {
+                'data_output_1': speech[:, target_indices], 'data_output_2': noise[:, target_indices]}
+
+    def get_per_sample_batch_generator(self, set):
+
         while True:
             sample_indices = np.random.randint(
                 0, len(self.sequences[set]['clean']), self.batch_size)
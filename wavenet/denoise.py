@@ -5,79 +5,105 @@ from __future__ import division
 import os
 import util
 import tqdm
+import telemetry as telemetry_module
 import numpy as np
+import soundfile as sf
 
 
-def denoise_sample(model, input, condition_input, batch_size, output_filename_prefix, sample_rate, output_path):
+def get_fallback_output(noisy, speech_mask, speech_gating, gating_attenuation):
 
-    if len(input['noisy']) < model.receptive_field_length:
+    # Cheap estimate used wherever the model does not run
+    if speech_gating == 'wiener' and np.sum(~speech_mask) >= 1024:
+        return util.wiener_filter(noisy, noisy[~speech_mask])
+    return gating_attenuation * noisy
+
+
+def get_speech_fragment_indices(model, speech_mask, num_fragments):
+
+    # A fragment runs through the model if any sample in its receptive field is speech
+    speech_samples_before = np.concatenate(([0], np.cumsum(speech_mask)))
+    fragment_starts = np.arange(num_fragments) * model.target_field_length
+    fragment_ends = np.minimum(fragment_starts + model.input_length, len(speech_mask))
+    has_speech = speech_samples_before[fragment_ends] - speech_samples_before[fragment_starts] > 0
+    return list(np.nonzero(has_speech)[0])
+
+
+def denoise_signal(model, noisy, condition_input, batch_size, speech_gating=None, gating_attenuation=0.1,
+                   show_progress=True, telemetry=None):
+
+    if telemetry is None:
+        telemetry = telemetry_module.InferenceTelemetry()
+
+    if len(noisy) < model.receptive_field_length:
         raise ValueError(
             'Input is not long enough to be used with this model.')
 
-    num_output_samples = input['noisy'].shape[0] - \
+    num_output_samples = noisy.shape[0] - \
         (model.receptive_field_length - 1)
     num_fragments = int(
         np.ceil(num_output_samples / model.target_field_length))
-    num_batches = int(np.ceil(num_fragments / batch_size))
 
-    denoised_output = []
-    noise_output = []
-    num_pad_values = 0
-    fragment_i = 0
-    for batch_i in tqdm.tqdm(range(0, num_batches)):
+    denoised_output = np.zeros(num_fragments * model.target_field_length)
+    noise_output = np.zeros(num_fragments * model.target_field_length)
+
+    if speech_gating is None:
+        fragment_indices = list(range(num_fragments))
+    else:
+        speech_mask = util.get_speech_mask(noisy)
+        fragment_indices = get_speech_fragment_indices(model, speech_mask, num_fragments)
 
-        if batch_i == num_batches-1:  # If its the last batch'
-            batch_size = num_fragments - batch_i*batch_size
+        valid_noisy_signal = noisy[model.half_receptive_field_length:
+                                   model.half_receptive_field_length + num_output_samples]
+        fallback_output = get_fallback_output(noisy, speech_mask, speech_gating, gating_attenuation)[
+            model.half_receptive_field_length:model.half_receptive_field_length + num_output_samples]
+        denoised_output[:num_output_samples] = fallback_output
+        noise_output[:num_output_samples] = valid_noisy_signal - fallback_output
 
-        condition_batch = np.array(
-            [condition_input, ] * batch_size, dtype='uint8')
-        input_batch = np.zeros((batch_size, model.input_length))
+    num_batches = int(np.ceil(len(fragment_indices) / batch_size))
+    for batch_i in tqdm.tqdm(range(0, num_batches), disable=not show_progress):
 
-        # Assemble batch
-        for batch_fragment_i in range(0, batch_size):
+        batch_fragment_indices = fragment_indices[batch_i * batch_size:(batch_i + 1) * batch_size]
+        telemetry.record_batch(len(batch_fragment_indices), batch_size)
 
-            if fragment_i + model.target_field_length > num_output_samples:
-                remainder = input['noisy'][fragment_i:]
-                current_fragment = np.zeros((model.input_length,))
-                current_fragment[:remainder.shape[0]] = remainder
-                num_pad_values = model.input_length - remainder.shape[0]
-            else:
-                current_fragment = input['noisy'][fragment_i:fragment_i +
-                                                  model.input_length]
+        with telemetry.stage('batch_assembly'):
+            condition_batch = np.array(
+                [condition_input, ] * len(batch_fragment_indices), dtype='uint8')
+            input_batch = np.zeros((len(batch_fragment_indices), model.input_length))
 
-            input_batch[batch_fragment_i, :] = current_fragment
-            fragment_i += model.target_field_length
+            # Assemble batch, the last fragment is zero-padded to the model input length
+            for batch_fragment_i, fragment_i in enumerate(batch_fragment_indices):
+                fragment_start = fragment_i * model.target_field_length
+                current_fragment = noisy[fragment_start:fragment_start + model.input_length]
+                input_batch[batch_fragment_i, :current_fragment.shape[0]] = current_fragment
 
-        denoised_output_fragments = model.denoise_batch(
-            {'data_input': input_batch, 'condition_input': condition_batch})
+        with telemetry.stage('denoise_batch'):
+            denoised_output_fragments, noise_output_fragments = model.denoise_batch(
+                {'data_input': input_batch, 'condition_input': condition_batch})
 
-        if type(denoised_output_fragments) is list:
-            noise_output_fragment = denoised_output_fragments[1]
-            denoised_output_fragment = denoised_output_fragments[0]
+        with telemetry.stage('output_assembly'):
+            for batch_fragment_i, fragment_i in enumerate(batch_fragment_indices):
+                output_start = fragment_i * model.target_field_length
+                denoised_output[output_start:output_start + model.target_field_length] = denoised_output_fragments[
+                    batch_fragment_i, model.target_padding:model.target_padding + model.target_field_length]
+                noise_output[output_start:output_start + model.target_field_length] = noise_output_fragments[
+                    batch_fragment_i, model.target_padding:model.target_padding + model.target_field_length]
 
-        denoised_output_fragment = denoised_output_fragment[:,
-                                                            model.target_padding: model.target_padding + model.target_field_length]
-        denoised_output_fragment = denoised_output_fragment.flatten().tolist()
+    return denoised_output[:num_output_samples], noise_output[:num_output_samples], len(fragment_indices), \
+        num_fragments
 
-        if noise_output_fragment is not None:
-            noise_output_fragment = noise_output_fragment[:,
-                                                          model.target_padding: model.target_padding + model.target_field_length]
-            noise_output_fragment = noise_output_fragment.flatten().tolist()
 
-        if type(denoised_output_fragments) is float:
-            denoised_output_fragment = [denoised_output_fragment]
-        if type(noise_output_fragment) is float:
-            noise_output_fragment = [noise_output_fragment]
+def denoise_sample(model, input, condition_input, batch_size, output_filename_prefix, sample_rate, output_path,
+                   show_progress=True, speech_gating=None, gating_attenuation=0.1, telemetry=None):
 
-        denoised_output = denoised_output + denoised_output_fragment
-        noise_output = noise_output + noise_output_fragment
+    if telemetry is None:
+        telemetry = telemetry_module.InferenceTelemetry()
 
-    denoised_output = np.array(denoised_output)
-    noise_output = np.array(noise_output)
+    denoised_output, noise_output, num_model_fragments, num_fragments = denoise_signal(
+        model, input['noisy'], condition_input, batch_size, speech_gating, gating_attenuation, show_progress,
+        telemetry)
 
-    if num_pad_values != 0:
-        denoised_output = denoised_output[:-num_pad_values]
-        noise_output = noise_output[:-num_pad_values]
+    if speech_gating is not None:
+        print('Speech gating: model ran on %d of %d fragments' % (num_model_fragments, num_fragments))
 
     valid_noisy_signal = input['noisy'][
         model.half_receptive_field_length:model.half_receptive_field_length + len(denoised_output)]
@@ -100,7 +126,8 @@ def denoise_sample(model, input, condition_input, batch_size, output_filename_pr
         output_clean_filename = output_filename_prefix + 'clean.wav'
         output_clean_filepath = os.path.join(
             output_path, output_clean_filename)
-        util.write_wav(valid_clean_signal, output_clean_filepath, sample_rate)
+        with telemetry.stage('wav_writing'):
+            util.write_wav(valid_clean_signal, output_clean_filepath, sample_rate)
 
         output_denoised_filename = output_filename_prefix + f"denoised_{new_snr_db}dB.wav"
         output_noisy_filename = output_filename_prefix + f"noisy_{initial_snr_db}dB.wav"
@@ -115,6 +142,164 @@ def denoise_sample(model, input, condition_input, batch_size, output_filename_pr
     output_noisy_filepath = os.path.join(output_path, output_noisy_filename)
     output_noise_filepath = os.path.join(output_path, output_noise_filename)
 
-    util.write_wav(denoised_output, output_denoised_filepath, sample_rate)
-    util.write_wav(valid_noisy_signal, output_noisy_filepath, sample_rate)
-    util.write_wav(noise_output, output_noise_filepath, sample_rate)
+    with telemetry.stage('wav_writing'):
+        util.write_wav(denoised_output, output_denoised_filepath, sample_rate)
+        util.write_wav(valid_noisy_signal, output_noisy_filepath, sample_rate)
+        util.write_wav(noise_output, output_noise_filepath, sample_rate)
+
+    output_filepaths = [output_denoised_filepath, output_noisy_filepath, output_noise_filepath]
+    if input['clean'] is not None:
+        output_filepaths.append(output_clean_filepath)
+    return output_filepaths
+
+
+class StreamReader():
+    # Reads a wav file block by block and keeps only the samples that are still needed
+
+    def __init__(self, file_path, sample_rate, block_length=65536):
+
+        self.file = sf.SoundFile(file_path)
+        if self.file.samplerate != sample_rate:
+            raise ValueError('Streaming needs %s at %d Hz, it is at %d Hz' % (
+                file_path, sample_rate, self.file.samplerate))
+        self.num_samples = self.file.frames
+        self.block_length = block_length
+        self.buffer = np.zeros(0)
+        self.buffer_start = 0
+
+    def read_span(self, start, end):
+
+        # Samples [start, end), zero-padded past the end of the file
+        while self.buffer_start + len(self.buffer) < min(end, self.num_samples):
+            block = self.file.read(self.block_length, dtype='float64')
+            if len(block) == 0:
+                # A truncated or corrupt file ends before the frame count in its header
+                raise ValueError('%s ended after %d of %d samples' % (
+                    self.file.name, self.buffer_start + len(self.buffer), self.num_samples))
+            if block.ndim > 1:
+                block = block[:, 0]
+            self.buffer = np.concatenate((self.buffer, block))
+
+        span = np.zeros(end - start)
+        available = self.buffer[start - self.buffer_start:end - self.buffer_start]
+        span[:len(available)] = available
+        return span
+
+    def discard_before(self, position):
+
+        self.buffer = self.buffer[max(position - self.buffer_start, 0):]
+        self.buffer_start = max(position, self.buffer_start)
+
+    def close(self):
+        self.file.close()
+
+
+def denoise_file_streaming(model, noisy_path, clean_path, condition_input, batch_size, output_filename_prefix,
+                           sample_rate, output_path, show_progress=True, telemetry=None):
+
+    # Same outputs as denoise_sample, but memory stays bounded by one batch of fragments plus the receptive field:
+    # the input is read in blocks, outputs are appended to open wav files and SNR is accumulated as it goes
+
+    if telemetry is None:
+        telemetry = telemetry_module.InferenceTelemetry()
+
+    noisy_reader = StreamReader(noisy_path, sample_rate)
+    clean_reader = StreamReader(clean_path, sample_rate) if clean_path is not None else None
+
+    if noisy_reader.num_samples < model.receptive_field_length:
+        raise ValueError(
+            'Input is not long enough to be used with this model.')
+
+    num_output_samples = noisy_reader.num_samples - (model.receptive_field_length - 1)
+    num_fragments = int(np.ceil(num_output_samples / model.target_field_length))
+    num_batches = int(np.ceil(num_fragments / batch_size))
+
+    output_names = ['denoised', 'noise', 'noisy'] + (['clean'] if clean_reader is not None else [])
+    output_filepaths = dict((name, os.path.join(output_path, output_filename_prefix + name + '.wav'))
+                            for name in output_names)
+    output_files = dict((name, sf.SoundFile(output_filepaths[name], 'w', sample_rate, 1))
+                        for name in output_names)
+
+    sum_squares = {'clean': 0.0, 'noise_out': 0.0, 'noise_in': 0.0}
+    noise_in_accumulated_until = 0
+
+    for batch_i in tqdm.tqdm(range(0, num_batches), disable=not show_progress):
+
+        first_fragment_i = batch_i * batch_size
+        num_batch_fragments = min(batch_size, num_fragments - first_fragment_i)
+        span_start = first_fragment_i * model.target_field_length
+        span_end = span_start + (num_batch_fragments - 1) * model.target_field_length + model.input_length
+
+        telemetry.record_batch(num_batch_fragments, batch_size)
+
+        with telemetry.stage('wav_reading'):
+            noisy_span = noisy_reader.read_span(span_start, span_end)
+            if clean_reader is not None:
+                clean_span = clean_reader.read_span(span_start, span_end)
+
+        with telemetry.stage('batch_assembly'):
+            fragment_starts = np.arange(num_batch_fragments) * model.target_field_length
+            input_batch = noisy_span[fragment_starts[:, None] + np.arange(model.input_length)]
+            condition_batch = np.array([condition_input, ] * num_batch_fragments, dtype='uint8')
+
+        with telemetry.stage('denoise_batch'):
+            denoised_output_fragments, noise_output_fragments = model.denoise_batch(
+                {'data_input': input_batch, 'condition_input': condition_batch})
+
+        with telemetry.stage('output_assembly'):
+            num_batch_output_samples = min(num_batch_fragments * model.target_field_length,
+                                           num_output_samples - span_start)
+            denoised_output = denoised_output_fragments[
+                :, model.target_padding:model.target_padding + model.target_field_length].flatten()[
+                :num_batch_output_samples]
+            noise_output = noise_output_fragments[
+                :, model.target_padding:model.target_padding + model.target_field_length].flatten()[
+                :num_batch_output_samples]
+            valid_noisy_signal = noisy_span[model.half_receptive_field_length:
+                                            model.half_receptive_field_length + num_batch_output_samples]
+
+        with telemetry.stage('wav_writing'):
+            output_files['denoised'].write(denoised_output)
+            output_files['noise'].write(noise_output)
+            output_files['noisy'].write(valid_noisy_signal)
+
+        if clean_reader is not None:
+            valid_clean_signal = clean_span[model.half_receptive_field_length:
+                                            model.half_receptive_field_length + num_batch_output_samples]
+            with telemetry.stage('wav_writing'):
+                output_files['clean'].write(valid_clean_signal)
+
+            sum_squares['clean'] += np.sum(np.square(valid_clean_signal))
+            sum_squares['noise_out'] += np.sum(np.square(denoised_output - valid_clean_signal))
+
+            # The input noise is measured over the whole input, each sample counted once
+            noise_in_end = min(span_end, noisy_reader.num_samples)
+            sum_squares['noise_in'] += np.sum(np.square(
+                noisy_span[noise_in_accumulated_until - span_start:noise_in_end - span_start] -
+                clean_span[noise_in_accumulated_until - span_start:noise_in_end - span_start]))
+            noise_in_accumulated_until = noise_in_end
+            clean_reader.discard_before(span_start + num_batch_fragments * model.target_field_length)
+
+        noisy_reader.discard_before(span_start + num_batch_fragments * model.target_field_length)
+
+    for output_file in output_files.values():
+        output_file.close()
+    noisy_reader.close()
+
+    if clean_reader is not None:
+        clean_reader.close()
+
+        rms_clean = np.sqrt(sum_squares['clean'] / num_output_samples)
+        rms_noise_out = np.sqrt(sum_squares['noise_out'] / num_output_samples)
+        rms_noise_in = np.sqrt(sum_squares['noise_in'] / noisy_reader.num_samples)
+
+        new_snr_db = int(np.round(util.snr_db(rms_clean, rms_noise_out)))
+        initial_snr_db = int(np.round(util.snr_db(rms_clean, rms_noise_in)))
+
+        snr_filenames = {'denoised': f"denoised_{new_snr_db}dB.wav", 'noisy': f"noisy_{initial_snr_db}dB.wav"}
+        for name, snr_filename in snr_filenames.items():
+            snr_filepath = os.path.join(output_path, output_filename_prefix + snr_filename)
+            os.replace(output_filepaths[name], snr_filepath)
+            output_filepaths[name] = snr_filepath
+
+    return noisy_reader.num_samples, list(output_filepaths.values())
@@ -0,0 +1,105 @@
+# Distillation.py
+# Trains a compact student Denoising Wavenet on the outputs of a trained teacher. Teacher outputs are computed once
+# on NSDTSEADataset batches and cached next to the student session, so the student's epochs cost no teacher passes
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+CACHE_FOLDER_NAME = 'teacher_targets'
+ARRAY_NAMES = ['data_input', 'condition_input', 'data_output_1', 'data_output_2']
+
+
+def check_models(teacher, student):
+
+    # The student sees the centre of each teacher input and learns the teacher's outputs for the same samples
+    if student.receptive_field_length > teacher.receptive_field_length:
+        raise ValueError('The student receptive field (%d) must not exceed the teacher receptive field (%d)' % (
+            student.receptive_field_length, teacher.receptive_field_length))
+    if student.target_field_length != teacher.target_field_length or student.target_padding != teacher.target_padding:
+        raise ValueError('Student and teacher must share target_field_length and target_padding')
+    if student.condition_input_length != teacher.condition_input_length:
+        raise ValueError('Student and teacher must use the same condition encoding')
+
+
+def get_student_input_offset(teacher, student):
+
+    # Both receptive fields are odd and centred on the target field
+    return (teacher.input_length - student.input_length) // 2
+
+
+def get_cache_path(student_config, teacher, student, num_batches):
+
+    # A new teacher checkpoint, student geometry or dataset gives a new cache
+    key = {
+        'teacher_model': teacher.config['model'],
+        'teacher_checkpoint': None,
+        'student_input_length': int(student.input_length),
+        'dataset': student_config['dataset'],
+        'batch_size': student_config['training']['batch_size'],
+        'num_batches': int(num_batches)
+    }
+    if teacher.checkpoint_path is not None:
+        checkpoint_stat = os.stat(teacher.checkpoint_path)
+        key['teacher_checkpoint'] = [os.path.abspath(teacher.checkpoint_path), checkpoint_stat.st_size,
+                                     checkpoint_stat.st_mtime_ns]
+    cache_key = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(student_config['training']['path'], CACHE_FOLDER_NAME, cache_key)
+
+
+def build_teacher_target_cache(cache_path, teacher, student, batch_generator, num_batches):
+
+    # batch_generator yields batches shaped for the teacher. The cache holds the student's crop of each input, the
+    # condition and the teacher's two outputs, one .npy file per array with all batches stacked on the first axis
+    offset = get_student_input_offset(teacher, student)
+    temporary_cache_path = cache_path + '.tmp%d' % os.getpid()
+    os.makedirs(temporary_cache_path)
+
+    arrays = None
+    for batch_i in range(num_batches):
+        inputs, _ = next(batch_generator)
+        data_output_1, data_output_2 = teacher.denoise_batch(inputs)
+        batch = {'data_input': inputs['data_input'][:, offset:offset + student.input_length],
+                 'condition_input': inputs['condition_input'],
+                 'data_output_1': data_output_1,
+                 'data_output_2': data_output_2}
+
+        if arrays is None:
+            arrays = dict((name, np.lib.format.open_memmap(
+                os.path.join(temporary_cache_path, name + '.npy'), mode='w+', dtype='float32',
+                shape=(num_batches,) + batch[name].shape)) for name in ARRAY_NAMES)
+        for name in ARRAY_NAMES:
+            arrays[name][batch_i] = batch[name]
+
+        if (batch_i + 1) % 100 == 0 or batch_i + 1 == num_batches:
+            print('Computed teacher targets for %d of %d batches' % (batch_i + 1, num_batches))
+
+    for array in arrays.values():
+        array.flush()
+    del arrays
+
+    # A cache appears complete or not at all
+    try:
+        os.rename(temporary_cache_path, cache_path)
+    except OSError:
+        shutil.rmtree(temporary_cache_path)
+
+
+def load_teacher_target_cache(cache_path):
+
+    # Memory-mapped, so a large cache is paged in as batches are drawn
+    return dict((name, np.load(os.path.join(cache_path, name + '.npy'), mmap_mode='r')) for name in ARRAY_NAMES)
+
+
+def get_random_batch_generator(teacher_targets):
+
+    # Cached batches in a new random order every pass, in the format of NSDTSEADataset batches
+    num_batches = len(teacher_targets['data_input'])
+    while True:
+        for batch_i in np.random.permutation(num_batches):
+            yield {'data_input': np.array(teacher_targets['data_input'][batch_i]),
+                   'condition_input': np.array(teacher_targets['condition_input'][batch_i])}, {
+                'data_output_1': np.array(teacher_targets['data_output_1'][batch_i]),
+                'data_output_2': np.array(teacher_targets['data_output_2'][batch_i])}
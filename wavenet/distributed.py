@@ -0,0 +1,84 @@
+# Distributed.py
+# Multi-worker synchronous data-parallel training: cluster setup from TF_CONFIG, local worker launching and
+# per-worker input pipelines
+
+import os
+import sys
+import json
+import socket
+import subprocess
+import tensorflow as tf
+
+
+def get_task():
+
+    # (worker index, number of workers) of this process, (0, 1) outside a cluster
+    if 'TF_CONFIG' not in os.environ:
+        return 0, 1
+    tf_config = json.loads(os.environ['TF_CONFIG'])
+    return tf_config['task']['index'], len(tf_config['cluster']['worker'])
+
+
+def is_chief():
+    # Worker 0 writes checkpoints and logs
+    return get_task()[0] == 0
+
+
+def get_strategy():
+
+    # MultiWorkerMirroredStrategy has to be created before any other TensorFlow op runs in the process
+    if 'TF_CONFIG' not in os.environ:
+        return None
+    return tf.distribute.MultiWorkerMirroredStrategy()
+
+
+def get_free_ports(num_ports):
+
+    sockets = [socket.socket() for _ in range(num_ports)]
+    for port_socket in sockets:
+        port_socket.bind(('localhost', 0))
+    ports = [port_socket.getsockname()[1] for port_socket in sockets]
+    for port_socket in sockets:
+        port_socket.close()
+    return ports
+
+
+def run_local_workers(num_workers, argv):
+
+    # Runs the same command line in num_workers processes on this machine, each with its own TF_CONFIG
+    workers = ['localhost:%d' % port for port in get_free_ports(num_workers)]
+    processes = []
+    for worker_i in range(num_workers):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({'cluster': {'worker': workers}, 'task': {'type': 'worker', 'index': worker_i}})
+        processes.append(subprocess.Popen([sys.executable] + argv, env=env))
+
+    return_codes = [process.wait() for process in processes]
+    if any(return_codes):
+        raise RuntimeError('Training workers exited with codes %s' % return_codes)
+
+
+def get_distributed_dataset(strategy, batches):
+
+    # batches is a batch generator or a tf.data dataset. Every worker feeds its own, so tf.data must not shard the
+    # batches again
+    if isinstance(batches, tf.data.Dataset):
+        dataset = batches
+    else:
+        dataset = get_generator_dataset(batches)
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    return strategy.experimental_distribute_dataset(dataset.with_options(options))
+
+
+def get_generator_dataset(generator):
+
+    first_batch = next(generator)
+
+    def batches():
+        yield first_batch
+        for batch in generator:
+            yield batch
+
+    return tf.data.Dataset.from_generator(batches, output_signature=tf.nest.map_structure(
+        lambda array: tf.TensorSpec((None,) + array.shape[1:], tf.as_dtype(array.dtype)), first_batch))
@@ -0,0 +1,115 @@
+# Export.py
+# Exports a trained Denoising Wavenet to a self-contained SavedModel and TFLite flatbuffer for lightweight serving
+
+import os
+import util
+import tensorflow as tf
+from tensorflow.keras.export import ExportArchive
+
+# None keeps float32 weights, 'dynamic' stores int8 weights with dynamic-range activations
+QUANTIZATIONS = [None, 'float16', 'dynamic', 'int8']
+
+
+def get_export_metadata(model, batch_size):
+
+    # Everything a runner needs to fragment audio and encode the condition, without the config or Keras
+    return {
+        'batch_size': int(batch_size),
+        'input_length': int(model.input_length),
+        'target_field_length': int(model.target_field_length),
+        'target_padding': int(model.target_padding),
+        'receptive_field_length': int(model.receptive_field_length),
+        'condition_input_length': int(model.condition_input_length),
+        'condition_encoding': model.config['model']['condition_encoding'],
+        'num_condition_classes': int(model.num_condition_classes),
+        'sample_rate': int(model.config['dataset']['sample_rate'])
+    }
+
+
+def export_saved_model(model, saved_model_path, batch_size):
+
+    keras_model = model.model
+
+    # Tracing the Keras model into a fixed-signature graph lowers Slice, AddSingletonDepth, Subtract and the
+    # squeeze Lambdas to StridedSlice, ExpandDims, Sub and Squeeze, so the artifact needs none of layers.py
+    def serve(data_input, condition_input):
+        data_output_1, data_output_2 = keras_model([data_input, condition_input], training=False)
+        return {'data_output_1': data_output_1, 'data_output_2': data_output_2}
+
+    export_archive = ExportArchive()
+    export_archive.track(keras_model)
+    export_archive.add_endpoint(name='serving_default', fn=serve, input_signature=[
+        tf.TensorSpec((batch_size, model.input_length), tf.float32, name='data_input'),
+        tf.TensorSpec((batch_size, model.condition_input_length), tf.float32, name='condition_input')])
+    export_archive.write_out(saved_model_path)
+
+
+def get_tflite_filename(quantization=None):
+
+    if quantization is None:
+        return 'model.tflite'
+    return 'model_%s.tflite' % quantization
+
+
+def get_representative_dataset(dataset, batch_size, num_batches):
+
+    # Calibration batches for int8 quantization, drawn like training batches from the dataset
+    def representative_dataset():
+        dataset.batch_size = batch_size
+        batch_generator = dataset.get_random_batch_generator('train')
+        for _ in range(num_batches):
+            inputs, _ = next(batch_generator)
+            yield {'data_input': inputs['data_input'].astype('float32'),
+                   'condition_input': inputs['condition_input'].astype('float32')}
+
+    return representative_dataset
+
+
+def export_tflite(saved_model_path, tflite_path, quantization=None, representative_dataset=None):
+
+    if quantization not in QUANTIZATIONS:
+        raise ValueError('Unknown quantization: %s, choose one of %s' % (
+            quantization, ', '.join(str(q) for q in QUANTIZATIONS)))
+
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_path)
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS]
+
+    if quantization is not None:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        # Weights and activations in int8, inputs and outputs stay float32
+        if representative_dataset is None:
+            raise ValueError('int8 quantization needs a representative dataset for calibration')
+        converter.representative_dataset = representative_dataset
+
+    tflite_model = converter.convert()
+
+    with open(tflite_path, 'wb') as tflite_file:
+        tflite_file.write(tflite_model)
+
+
+def export_model(model, export_path, batch_size, quantizations=(None,), dataset=None, num_calibration_batches=100):
+
+    if not os.path.exists(export_path):
+        os.makedirs(export_path)
+
+    saved_model_path = os.path.join(export_path, 'saved_model')
+    print('Exporting SavedModel to: ' + saved_model_path)
+    export_saved_model(model, saved_model_path, batch_size)
+
+    representative_dataset = None
+    if dataset is not None:
+        representative_dataset = get_representative_dataset(dataset, batch_size, num_calibration_batches)
+
+    tflite_paths = []
+    for quantization in quantizations:
+        tflite_path = os.path.join(export_path, get_tflite_filename(quantization))
+        print('Exporting TFLite model to: ' + tflite_path)
+        export_tflite(saved_model_path, tflite_path, quantization, representative_dataset)
+        tflite_paths.append(tflite_path)
+
+    util.pretty_json_dump(get_export_metadata(model, batch_size), os.path.join(export_path, 'metadata.json'))
+
+    return tflite_paths
@@ -0,0 +1,60 @@
+# Fast_start.py
+# Cache of TFLite exports for inference-only startup. The first run for a checkpoint exports it, later runs load the
+# flatbuffer with the TFLite interpreter without importing TensorFlow, building, loading or compiling the Keras model
+
+import os
+import json
+import shutil
+import hashlib
+import checkpoints
+
+CACHE_FOLDER_NAME = 'fast_start'
+TFLITE_FILENAME = 'model.tflite'
+
+# Set in config['model'] by DenoisingWavenet, derived from the other model settings
+DERIVED_MODEL_KEYS = ['num_residual_blocks', 'receptive_field_length', 'input_length', 'target_field_length',
+                      'num_params']
+
+
+def get_cache_key(config, checkpoint_path, batch_size, target_field_length=None, quantization=None):
+
+    # Changing the architecture, the checkpoint file or any export setting gives a new cache entry
+    checkpoint_stat = os.stat(checkpoint_path)
+    key = {
+        'model': dict((name, value) for name, value in config['model'].items() if name not in DERIVED_MODEL_KEYS),
+        'dataset': config['dataset'],
+        'checkpoint': [os.path.abspath(checkpoint_path), checkpoint_stat.st_size, checkpoint_stat.st_mtime_ns],
+        'batch_size': int(batch_size),
+        'target_field_length': int(target_field_length or config['model']['target_field_length']),
+        'quantization': quantization
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def get_cached_model_path(config, batch_size, export_model, target_field_length=None, load_checkpoint=None,
+                          quantization=None):
+
+    # export_model(export_path) writes a TFLite export with its metadata.json and returns the flatbuffer path. It
+    # is only called when the cache has no entry for this checkpoint and these settings yet
+    checkpoint_path, _ = checkpoints.get_checkpoint_path(
+        os.path.join(config['training']['path'], 'checkpoints'), load_checkpoint)
+    if checkpoint_path is None:
+        raise ValueError('Fast-start inference needs a trained checkpoint in %s' % config['training']['path'])
+
+    cache_path = os.path.join(config['training']['path'], 'export', CACHE_FOLDER_NAME, get_cache_key(
+        config, checkpoint_path, batch_size, target_field_length, quantization))
+    tflite_path = os.path.join(cache_path, TFLITE_FILENAME)
+    if os.path.exists(tflite_path):
+        return tflite_path
+
+    print('Building fast-start model cache in: ' + cache_path)
+    temporary_cache_path = cache_path + '.tmp%d' % os.getpid()
+    os.replace(export_model(temporary_cache_path), os.path.join(temporary_cache_path, TFLITE_FILENAME))
+    shutil.rmtree(os.path.join(temporary_cache_path, 'saved_model'), ignore_errors=True)
+
+    # An entry appears complete or not at all. If another process got there first, its entry is used
+    try:
+        os.rename(temporary_cache_path, cache_path)
+    except OSError:
+        shutil.rmtree(temporary_cache_path)
+    return tflite_path
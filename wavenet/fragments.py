@@ -0,0 +1,31 @@
+# Fragments.py
+# Splits a signal into overlapping model-input fragments and joins the model outputs back together.
+# Only depends on numpy, so lightweight runners can use it without TensorFlow.
+
+import numpy as np
+
+
+def get_num_output_samples(model, num_input_samples):
+    return num_input_samples - (model.receptive_field_length - 1)
+
+
+def split_into_fragments(model, noisy):
+
+    # Fragments advance by one target field; the last one is zero-padded, as in denoise.denoise_sample
+    if len(noisy) < model.receptive_field_length:
+        raise ValueError('Input is not long enough to be used with this model.')
+
+    num_output_samples = get_num_output_samples(model, len(noisy))
+    num_fragments = int(np.ceil(num_output_samples / model.target_field_length))
+
+    padded_noisy = np.zeros((num_fragments - 1) * model.target_field_length + model.input_length, dtype='float32')
+    padded_noisy[:len(noisy)] = noisy
+    fragment_starts = np.arange(num_fragments) * model.target_field_length
+
+    return padded_noisy[fragment_starts[:, None] + np.arange(model.input_length)]
+
+
+def join_fragments(model, output_fragments, num_output_samples):
+
+    return output_fragments[:, model.target_padding:model.target_padding + model.target_field_length].flatten()[
+        :num_output_samples]
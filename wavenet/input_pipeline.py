@@ -0,0 +1,81 @@
+# Input_pipeline.py
+# tf.data counterpart of NSDTSEADataset.get_random_batch_generator. Batches are built from the dataset's fragment
+# table, several at a time on tf.data threads and prefetched, so the next batches are ready while the model runs a
+# step
+
+import numpy as np
+import tensorflow as tf
+import util
+
+
+def get_condition_encode_function(dataset):
+
+    # TensorFlow versions of util.binary_encode and util.one_hot_encode
+    num_condition_classes = dataset.model.num_condition_classes
+    if dataset.condition_encode_function is util.binary_encode:
+        bits = tf.bitwise.left_shift(tf.constant(1, tf.int64), tf.range(
+            int(np.ceil(np.log2(num_condition_classes))), dtype=tf.int64))
+        return lambda condition_classes: tf.cast(tf.bitwise.bitwise_and(condition_classes[:, None], bits) > 0,
+                                                 tf.float32)
+    return lambda condition_classes: tf.one_hot(condition_classes, num_condition_classes)
+
+
+def get_batch_dataset(dataset, set, seed=None):
+
+    # Same sampling as get_random_batch_generator: a uniformly drawn file long enough for a fragment, a uniform
+    # offset into its voice region, regain, the noise-only substitution and the wildcard condition class. As there,
+    # the noise fragment starts at the offset from the start of the file, not from the voice region
+    if dataset.in_memory_percentage < 1:
+        raise ValueError("The tf.data input pipeline holds the whole set in memory and needs in_memory_percentage 1, "
+                         "use input_pipeline 'generator' for in_memory_percentage %g" % dataset.in_memory_percentage)
+    table = dataset.get_fragment_table(set)
+    batch_size = dataset.batch_size
+    input_length = dataset.model.input_length
+    noise_only_percent = dataset.noise_only_percent
+    wildcard_probability = 1.0 / dataset.get_num_condition_classes()
+    target_indices = dataset.model.get_padded_target_field_indices()
+    target_start, target_end = target_indices[0], target_indices[-1] + 1
+    encode_condition = get_condition_encode_function(dataset)
+
+    # The fragments are gathered from the buffers in NumPy, which leaves memory-mapped shards shared between
+    # processes instead of copying them into TensorFlow
+    clean, noisy = table.pop('clean'), table.pop('noisy')
+
+    def gather_fragments(speech_indices, noise_indices):
+        return (np.asarray(clean[speech_indices]),
+                np.asarray(noisy[noise_indices] - clean[noise_indices]))
+
+    table = dict((name, tf.constant(values)) for name, values in table.items())
+    num_files = int(table['file_offsets'].shape[0])
+    sample_range = tf.range(input_length, dtype=tf.int64)
+
+    def build_batch(seed):
+        seeds = tf.random.experimental.stateless_split(seed, 4)
+        files = tf.random.stateless_uniform([batch_size], seeds[0], 0, num_files, dtype=tf.int64)
+        offsets = tf.cast(tf.random.stateless_uniform([batch_size], seeds[1], dtype=tf.float64) * tf.cast(
+            tf.gather(table['num_offsets'], files), tf.float64), tf.int64)
+
+        noise_indices = (tf.gather(table['file_offsets'], files) + offsets)[:, None] + sample_range
+        speech_indices = noise_indices + tf.gather(table['speech_starts'], files)[:, None]
+        regain_factors = tf.gather(table['regain_factors'], files)[:, None]
+        speech, noise_fragment = tf.numpy_function(gather_fragments, [speech_indices, noise_indices],
+                                                   [tf.float32, tf.float32], stateful=False)
+        speech = tf.ensure_shape(speech, [batch_size, input_length]) * regain_factors
+        noise_fragment = tf.ensure_shape(noise_fragment, [batch_size, input_length]) * regain_factors
+
+        data_input = speech + noise_fragment
+        if noise_only_percent > 0:
+            noise_only = (tf.random.stateless_uniform([batch_size], seeds[2]) <= noise_only_percent)[:, None]
+            data_input = tf.where(noise_only, noise_fragment, data_input)
+            speech = tf.where(noise_only, tf.zeros_like(speech), speech)
+
+        wildcard = tf.random.stateless_uniform([batch_size], seeds[3]) <= wildcard_probability
+        condition_classes = tf.where(wildcard, tf.constant(0, tf.int64), tf.gather(table['condition_classes'], files))
+
+        return {'data_input': data_input, 'condition_input': encode_condition(condition_classes)}, {
+            'data_output_1': speech[:, target_start:target_end],
+            'data_output_2': noise_fragment[:, target_start:target_end]}
+
+    # Every batch draws from its own stateless seed, so batches built in parallel are independent
+    return tf.data.Dataset.random(seed).batch(2, drop_remainder=True).map(
+        build_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=seed is not None).prefetch(tf.data.AUTOTUNE)
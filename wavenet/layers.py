@@ -23,6 +23,31 @@ class AddSingletonDepth(keras.layers.Layer):
             return input_shape[0], input_shape[1], 1
 
 
+class BroadcastAdd(keras.layers.Layer):
+    # Adds a (batch, channels) tensor to every time step of a (batch, time, channels) tensor without repeating it
+
+    def call(self, x):
+        return x[0] + K.expand_dims(x[1], 1)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[0]
+
+
+class GatedActivation(keras.layers.Layer):
+    # tanh(filter + condition) * sigmoid(gate + condition) in one layer, where filter and gate are the two halves of
+    # a 2 * res wide convolution. The condition projection is laid out as in a (res, 2) reshape: even units go to
+    # the filter, odd units to the gate
+
+    def call(self, x):
+        data, condition = x
+        depth = condition.shape[-1] // 2
+        return K.tanh(data[..., :depth] + K.expand_dims(condition[:, 0::2], 1)) * \
+            K.sigmoid(data[..., depth:] + K.expand_dims(condition[:, 1::2], 1))
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[0][:-1] + (input_shape[0][-1] // 2,)
+
+
 class Subtract(keras.layers.Layer):
 
     def __init__(self, **kwargs):
@@ -2,14 +2,29 @@
 # Main.py
 
 import sys
+import copy
+import time
 import logging
 import optparse
 import json
 import os
-import models
 import datasets
 import util
 import denoise
+import tflite_runner
+import sharding
+import server
+import manifest
+import telemetry
+import checkpoints
+import fast_start
+import distillation
+import profiler
+import preprocessing
+import numpy as np
+
+# models, export, distributed and benchmark import TensorFlow, so they are imported by the modes that use them and
+# fast-start inference runs without it
 
 
 def set_system_settings():
@@ -29,6 +44,33 @@ def get_command_line_arguments():
     parser.set_defaults(noisy_input_path=None)
     parser.set_defaults(print_model_summary=False)
     parser.set_defaults(target_field_length=None)
+    parser.set_defaults(model_cache_mb=2048)
+    parser.set_defaults(compiled_inference=False)
+    parser.set_defaults(jit_compile=False)
+    parser.set_defaults(benchmark='compiled_inference')
+    parser.set_defaults(num_batches=20)
+    parser.set_defaults(export_path=None)
+    parser.set_defaults(quantization=None)
+    parser.set_defaults(num_calibration_batches=100)
+    parser.set_defaults(num_shards=1)
+    parser.set_defaults(host='127.0.0.1')
+    parser.set_defaults(port=8000)
+    parser.set_defaults(max_wait_ms=10)
+    parser.set_defaults(max_pending_fragments=1024)
+    parser.set_defaults(speech_gating=None)
+    parser.set_defaults(gating_attenuation=0.1)
+    parser.set_defaults(streaming=False)
+    parser.set_defaults(job_name=None)
+    parser.set_defaults(telemetry_path=None)
+    parser.set_defaults(fold_condition=False)
+    parser.set_defaults(num_workers=1)
+    parser.set_defaults(fast_start=False)
+    parser.set_defaults(teacher_config=None)
+    parser.set_defaults(pruning_fraction=0.25)
+    parser.set_defaults(pruned_path=None)
+    parser.set_defaults(fine_tune_epochs=0)
+    parser.set_defaults(profile_configs=None)
+    parser.set_defaults(profile_measure=False)
 
     parser.add_option('--mode', dest='mode')
     parser.add_option('--print_model_summary', dest='print_model_summary')
@@ -40,6 +82,33 @@ def get_command_line_arguments():
     parser.add_option('--noisy_input_path', dest='noisy_input_path')
     parser.add_option('--clean_input_path', dest='clean_input_path')
     parser.add_option('--target_field_length', dest='target_field_length')
+    parser.add_option('--model_cache_mb', dest='model_cache_mb')
+    parser.add_option('--compiled_inference', dest='compiled_inference')
+    parser.add_option('--jit_compile', dest='jit_compile')
+    parser.add_option('--benchmark', dest='benchmark')
+    parser.add_option('--num_batches', dest='num_batches')
+    parser.add_option('--export_path', dest='export_path')
+    parser.add_option('--quantization', dest='quantization')
+    parser.add_option('--num_calibration_batches', dest='num_calibration_batches')
+    parser.add_option('--num_shards', dest='num_shards')
+    parser.add_option('--host', dest='host')
+    parser.add_option('--port', dest='port')
+    parser.add_option('--max_wait_ms', dest='max_wait_ms')
+    parser.add_option('--max_pending_fragments', dest='max_pending_fragments')
+    parser.add_option('--speech_gating', dest='speech_gating')
+    parser.add_option('--gating_attenuation', dest='gating_attenuation')
+    parser.add_option('--streaming', dest='streaming')
+    parser.add_option('--job_name', dest='job_name')
+    parser.add_option('--telemetry_path', dest='telemetry_path')
+    parser.add_option('--fold_condition', dest='fold_condition')
+    parser.add_option('--num_workers', dest='num_workers')
+    parser.add_option('--fast_start', dest='fast_start')
+    parser.add_option('--teacher_config', dest='teacher_config')
+    parser.add_option('--pruning_fraction', dest='pruning_fraction')
+    parser.add_option('--pruned_path', dest='pruned_path')
+    parser.add_option('--fine_tune_epochs', dest='fine_tune_epochs')
+    parser.add_option('--profile_configs', dest='profile_configs')
+    parser.add_option('--profile_measure', dest='profile_measure')
 
     (options, args) = parser.parse_args()
 
@@ -65,8 +134,40 @@ def get_dataset(config, model):
         return datasets.NSDTSEADataset(config, model).load_dataset()
 
 
+def preprocess_dataset(config, cla):
+
+    # Writes the memory-mapped shards that load_dataset opens instead of the WAV files from then on
+    if config['dataset']['type'] != 'nsdtsea':
+        raise ValueError('Only nsdtsea datasets can be preprocessed')
+    preprocessed_path = preprocessing.get_preprocessed_path(config)
+    print('Preprocessing NSDTSEA dataset into %s...' % preprocessed_path)
+    preprocessing.preprocess_dataset(datasets.NSDTSEADataset(config, None), preprocessed_path)
+
+
+def get_batches(config, dataset, set, seed=None):
+
+    # Batches for model.fit: the dataset's Python generator, or the tf.data pipeline built from the same files
+    if config['training'].get('input_pipeline', 'generator') == 'tf.data':
+        import input_pipeline
+        return input_pipeline.get_batch_dataset(dataset, set, seed)
+    return dataset.get_random_batch_generator(set)
+
+
 def training(config, cla):
 
+    import models
+    import distributed
+
+    if int(cla.num_workers) > 1 and 'TF_CONFIG' not in os.environ:
+        print('Starting %d local training workers..' % int(cla.num_workers))
+        distributed.run_local_workers(int(cla.num_workers), sys.argv)
+        return
+
+    strategy = distributed.get_strategy()
+    if strategy is not None:
+        distributed_training(config, cla, strategy)
+        return
+
     # Instantiate Model
     model = models.DenoisingWavenet(
         config, load_checkpoint=cla.load_checkpoint, print_model_summary=cla.print_model_summary)
@@ -74,14 +175,131 @@ def training(config, cla):
 
     num_train_samples = config['training']['num_train_samples']
     num_test_samples = config['training']['num_test_samples']
-    train_set_generator = dataset.get_random_batch_generator('train')
-    test_set_generator = dataset.get_random_batch_generator('test')
+    train_set_generator = get_batches(config, dataset, 'train')
+    test_set_generator = get_batches(config, dataset, 'test')
 
     model.fit_model(train_set_generator, num_train_samples, test_set_generator, num_test_samples,
                     config['training']['num_epochs'])
 
 
+def distributed_training(config, cla, strategy):
+
+    import models
+    import distributed
+
+    # Each worker draws batches from its own shard of the training files. A configured seed gives every worker its
+    # own NumPy seed and separate seeds for its train and test pipelines, without one sampling is nondeterministic
+    worker_i, num_workers = distributed.get_task()
+    seed = config['training'].get('seed')
+    train_seed, test_seed = None, None
+    if seed is not None:
+        np.random.seed(seed + worker_i)
+        train_seed, test_seed = np.random.SeedSequence([seed, worker_i]).generate_state(2).tolist()
+
+    model = models.DenoisingWavenet(config, load_checkpoint=cla.load_checkpoint,
+                                    print_model_summary=cla.print_model_summary and distributed.is_chief(),
+                                    strategy=strategy)
+    dataset = get_dataset(config, model).shard(worker_i, num_workers)
+
+    train_dataset = distributed.get_distributed_dataset(strategy, get_batches(config, dataset, 'train', train_seed))
+    test_dataset = distributed.get_distributed_dataset(strategy, get_batches(config, dataset, 'test', test_seed))
+
+    model.fit_model_distributed(train_dataset, config['training']['num_train_samples'], test_dataset,
+                                config['training']['num_test_samples'], config['training']['num_epochs'],
+                                distributed.is_chief())
+
+
+def distillation_training(config, cla):
+
+    import models
+
+    # config is the student. The teacher is the trained session of --teacher_config, used for inference only
+    if cla.teacher_config is None:
+        raise ValueError('Distillation needs the config of a trained teacher session in --teacher_config')
+    teacher = models.DenoisingWavenet(load_config(cla.teacher_config), inference_only=True)
+    if teacher.checkpoint_path is None:
+        raise ValueError('The teacher session has no checkpoint: ' + teacher.config['training']['path'])
+
+    student = models.DenoisingWavenet(config, load_checkpoint=cla.load_checkpoint,
+                                      target_field_length=teacher.target_field_length,
+                                      print_model_summary=cla.print_model_summary)
+    distillation.check_models(teacher, student)
+    print('Distilling a %d parameter teacher into a %d parameter student' % (
+        teacher.model.count_params(), student.model.count_params()))
+
+    # Batches are drawn for the teacher's input length, the student trains on their centre
+    dataset = get_dataset(config, teacher)
+
+    num_batches = config['training'].get('num_distillation_batches', config['training']['num_train_samples'])
+    cache_path = distillation.get_cache_path(config, teacher, student, num_batches)
+    if not os.path.exists(cache_path):
+        print('Caching teacher targets in: ' + cache_path)
+        teacher.compile_inference(config['training']['batch_size'])
+        distillation.build_teacher_target_cache(cache_path, teacher, student,
+                                                dataset.get_random_batch_generator('train'), num_batches)
+    train_set_generator = distillation.get_random_batch_generator(
+        distillation.load_teacher_target_cache(cache_path))
+
+    # Validation is against the clean test set, so student and teacher losses are comparable
+    dataset.model = student
+    test_set_generator = dataset.get_random_batch_generator('test')
+
+    student.fit_model(train_set_generator, config['training']['num_train_samples'], test_set_generator,
+                      config['training']['num_test_samples'], config['training']['num_epochs'])
+
+
+def prune_model(config, cla):
+
+    import models
+    import pruning
+
+    # The pruned model becomes a new session, which the inference and training modes use like any other
+    pruned_path = cla.pruned_path
+    if pruned_path is None:
+        pruned_path = config['training']['path'].rstrip('/') + '_pruned'
+    pruned_checkpoints_path = os.path.join(pruned_path, 'checkpoints')
+    if os.path.isdir(pruned_checkpoints_path) and util.dir_contains_files(pruned_checkpoints_path):
+        raise ValueError('The pruned session already has checkpoints: ' + pruned_path)
+
+    # Channels are scored on the standard graph, into which the checkpoints of every graph variant load
+    probe_config = copy.deepcopy(config)
+    probe_config['model']['memory_lean'] = False
+    probe_config['model']['progressive_cropping'] = False
+    probe_config['model']['mixed_precision'] = None
+    model = models.DenoisingWavenet(probe_config, load_checkpoint=cla.load_checkpoint, inference_only=True)
+    if model.checkpoint_path is None:
+        raise ValueError('Pruning needs a trained checkpoint in ' + config['training']['path'])
+
+    dataset = get_dataset(config, model)
+    print('Scoring channels on %d calibration batches..' % int(cla.num_calibration_batches))
+    channels = pruning.select_channels(model, dataset.get_random_batch_generator('train'),
+                                       int(cla.num_calibration_batches), float(cla.pruning_fraction))
+
+    pruned_config = pruning.get_pruned_config(config, channels, pruned_path)
+    pruned_model = models.DenoisingWavenet(pruned_config, print_model_summary=cla.print_model_summary)
+    pruning.transfer_weights(model, pruned_model, channels)
+    print('Pruned residual channels %d -> %d, skip channels %d -> %d, parameters %d -> %d' % (
+        config['model']['filters']['depths']['res'], len(channels['residual']),
+        config['model']['filters']['depths']['skip'], len(channels['skip']),
+        model.model.count_params(), pruned_model.model.count_params()))
+
+    # Saved as the epoch 0 checkpoint of the pruned session
+    checkpoint_manager = checkpoints.CheckpointManager(pruned_checkpoints_path)
+    checkpoint_filename = checkpoint_manager.get_checkpoint_filename(0, None)
+    pruned_model.model.save(os.path.join(pruned_checkpoints_path, checkpoint_filename))
+    checkpoint_manager.add(checkpoint_filename, 0, None)
+    print('Pruned session written to: ' + pruned_path)
+
+    if int(cla.fine_tune_epochs) > 0:
+        dataset.model = pruned_model
+        pruned_model.fit_model(dataset.get_random_batch_generator('train'), config['training']['num_train_samples'],
+                               dataset.get_random_batch_generator('test'), config['training']['num_test_samples'],
+                               int(cla.fine_tune_epochs))
+
+
 def get_valid_output_folder_path(outputs_folder_path):
+    if not os.path.isdir(outputs_folder_path):
+        os.makedirs(outputs_folder_path)
     j = 1
     while True:
         output_folder_name = 'samples_%d' % j
@@ -94,25 +312,67 @@ def get_valid_output_folder_path(outputs_folder_path):
     return output_folder_path
 
 
-def inference(config, cla):
+def get_inference_batch_size(config, cla):
 
     if cla.batch_size is not None:
-        batch_size = int(cla.batch_size)
-    else:
-        batch_size = config['training']['batch_size']
+        return int(cla.batch_size)
+    return config['training']['batch_size']
 
-    if cla.target_field_length is not None:
-        cla.target_field_length = int(cla.target_field_length)
+
+def get_inference_model_getter(config, cla, batch_size):
+
+    # Returns a function mapping an input length to the model that should denoise it
+
+    # A quantized model is a TFLite export, kept in the same cache as fast-start exports
+    if bool(cla.fast_start) or cla.quantization is not None:
+        if bool(cla.one_shot) or bool(cla.fold_condition):
+            raise ValueError('Fast-start and quantized inference do not support --one_shot or --fold_condition')
+        model = tflite_runner.TFLiteModel(get_fast_start_model_path(config, cla, batch_size),
+                                          num_threads=len(sharding.get_available_cores()))
+        return lambda num_samples: model
+
+    import models
+
+    # The condition is fixed by --condition_value for the whole run, so it can be folded into the graph
+    folded_condition_input = get_condition_input(config, cla) if bool(cla.fold_condition) else None
 
     if not bool(cla.one_shot):
         model = models.DenoisingWavenet(config, target_field_length=cla.target_field_length,
-                                        load_checkpoint=cla.load_checkpoint, print_model_summary=cla.print_model_summary)
-        print('Performing inference..')
-    else:
-        print('Performing one-shot inference..')
-
-    samples_folder_path = os.path.join(config['training']['path'], 'samples')
-    output_folder_path = get_valid_output_folder_path(samples_folder_path)
+                                        load_checkpoint=cla.load_checkpoint,
+                                        print_model_summary=cla.print_model_summary, inference_only=True)
+        if folded_condition_input is not None:
+            model.fold_condition(folded_condition_input)
+        if bool(cla.compiled_inference):
+            model.compile_inference(batch_size, jit_compile=bool(cla.jit_compile))
+        return lambda num_samples: model
+
+    model_cache = models.ModelCache(config, load_checkpoint=cla.load_checkpoint,
+                                    max_memory_mb=float(cla.model_cache_mb),
+                                    print_model_summary=cla.print_model_summary,
+                                    inference_batch_size=batch_size if bool(cla.compiled_inference) else None,
+                                    jit_compile=bool(cla.jit_compile),
+                                    folded_condition_input=folded_condition_input)
+    return model_cache.get_model
+
+
+def get_fast_start_model_path(config, cla, batch_size):
+
+    # Only a cache miss builds the Keras model, which needs TensorFlow
+    def export_model(export_path):
+        import models
+        import export
+        model = models.DenoisingWavenet(copy.deepcopy(config), target_field_length=cla.target_field_length,
+                                        load_checkpoint=cla.load_checkpoint, inference_only=True)
+        dataset = get_dataset(config, model) if cla.quantization == 'int8' else None
+        return export.export_model(model, export_path, batch_size, [cla.quantization], dataset,
+                                   int(cla.num_calibration_batches))[0]
+
+    return fast_start.get_cached_model_path(config, batch_size, export_model,
+                                            target_field_length=cla.target_field_length,
+                                            load_checkpoint=cla.load_checkpoint, quantization=cla.quantization)
+
+
+def get_inference_filenames(cla):
 
     # If input_path is a single wav file, then set filenames to single element with wav filename
     if cla.noisy_input_path.endswith('.wav'):
@@ -126,38 +386,259 @@ def inference(config, cla):
         filenames = [filename for filename in os.listdir(
             cla.noisy_input_path) if filename.endswith('.wav')]
 
-    clean_input = None
-    for filename in filenames:
-        noisy_input = util.load_wav(
-            cla.noisy_input_path + filename, config['dataset']['sample_rate'])
-        if cla.clean_input_path is not None:
-            if not cla.clean_input_path.endswith('/'):
-                cla.clean_input_path += '/'
-            clean_input = util.load_wav(
-                cla.clean_input_path + filename, config['dataset']['sample_rate'])
+    if cla.clean_input_path is not None and not cla.clean_input_path.endswith('/'):
+        cla.clean_input_path += '/'
+
+    return filenames
+
+
+def get_condition_input(config, cla):
+
+    if config['model']['condition_encoding'] == 'one_hot':
+        return util.one_hot_encode(int(cla.condition_value), 29)[0]
+    return util.binary_encode(int(cla.condition_value), 29)[0]
+
+
+def denoise_file(config, cla, get_model, filename, condition_input, batch_size, output_folder_path,
+                 show_progress=True, partial_output_folder_path=None, inference_telemetry=None):
+
+    if inference_telemetry is None:
+        inference_telemetry = telemetry.InferenceTelemetry()
+    start_time = time.perf_counter()
+
+    # With a partial output folder, outputs are only moved into the output folder once all of them are written
+    denoise_output_folder_path = output_folder_path
+    if partial_output_folder_path is not None:
+        denoise_output_folder_path = partial_output_folder_path
+
+    if bool(cla.streaming):
+        if bool(cla.one_shot) or cla.speech_gating is not None:
+            raise ValueError('Streaming inference does not support --one_shot or --speech_gating')
+        num_samples, output_filepaths = denoise.denoise_file_streaming(
+            get_model(None), cla.noisy_input_path + filename,
+            cla.clean_input_path + filename if cla.clean_input_path is not None else None, condition_input,
+            batch_size, filename[0:-4] + '_', config['dataset']['sample_rate'], denoise_output_folder_path,
+            show_progress=show_progress, telemetry=inference_telemetry)
+    else:
+        with inference_telemetry.stage('wav_reading'):
+            noisy_input = util.load_wav(
+                cla.noisy_input_path + filename, config['dataset']['sample_rate'])
+            clean_input = None
+            if cla.clean_input_path is not None:
+                clean_input = util.load_wav(
+                    cla.clean_input_path + filename, config['dataset']['sample_rate'])
 
         input = {'noisy': noisy_input, 'clean': clean_input}
 
         output_filename_prefix = filename[0:-4] + '_'
 
-        if config['model']['condition_encoding'] == 'one_hot':
-            condition_input = util.one_hot_encode(
-                int(cla.condition_value), 29)[0]
-        else:
-            condition_input = util.binary_encode(
-                int(cla.condition_value), 29)[0]
-
-        if bool(cla.one_shot):
-            if len(input['noisy']) % 2 == 0:  # If input length is even, remove one sample
-                input['noisy'] = input['noisy'][:-1]
-                if input['clean'] is not None:
-                    input['clean'] = input['clean'][:-1]
-            model = models.DenoisingWavenet(config, load_checkpoint=cla.load_checkpoint, input_length=len(
-                input['noisy']), print_model_summary=cla.print_model_summary)
+        model = get_model(len(input['noisy']))
 
+        output_filepaths = denoise.denoise_sample(
+            model, input, condition_input, batch_size, output_filename_prefix, config['dataset']['sample_rate'],
+            denoise_output_folder_path, show_progress=show_progress, speech_gating=cla.speech_gating,
+            gating_attenuation=float(cla.gating_attenuation), telemetry=inference_telemetry)
+        num_samples = len(noisy_input)
+
+    if partial_output_folder_path is not None:
+        output_filepaths = manifest.commit_outputs(output_filepaths, output_folder_path)
+
+    inference_telemetry.record_file(filename, num_samples, config['dataset']['sample_rate'],
+                                    time.perf_counter() - start_time)
+
+    return num_samples, output_filepaths
+
+
+def get_job_manifest(config, cla, output_folder_path):
+
+    # Everything besides the checkpoint that changes the outputs of a completed input
+    settings = dict((key, str(getattr(cla, key))) for key in [
+        'condition_value', 'target_field_length', 'one_shot', 'quantization', 'speech_gating', 'gating_attenuation',
+        'streaming', 'fold_condition', 'fast_start'])
+    # Copied before the model is built, which adds derived values such as input_length to config['model']
+    settings['model'] = copy.deepcopy(config['model'])
+    settings['sample_rate'] = config['dataset']['sample_rate']
+    checkpoint_path, _ = checkpoints.get_checkpoint_path(
+        os.path.join(config['training']['path'], 'checkpoints'), cla.load_checkpoint)
+    return manifest.JobManifest(output_folder_path, checkpoint_path, settings)
+
+
+def inference(config, cla):
+
+    batch_size = get_inference_batch_size(config, cla)
+
+    if cla.target_field_length is not None:
+        cla.target_field_length = int(cla.target_field_length)
+
+    samples_folder_path = os.path.join(config['training']['path'], 'samples')
+    num_shards = int(cla.num_shards)
+
+    # A named job keeps its output folder and manifest, so it can be resumed by running it again
+    job_manifest = None
+    partial_output_folder_path = None
+    if cla.job_name is not None:
+        output_folder_path = os.path.join(samples_folder_path, cla.job_name)
+        if not os.path.isdir(output_folder_path):
+            os.makedirs(output_folder_path)
+        job_manifest = get_job_manifest(config, cla, output_folder_path)
+        partial_output_folder_path = job_manifest.partial_path
+    else:
+        output_folder_path = get_valid_output_folder_path(samples_folder_path)
+
+    filenames = get_inference_filenames(cla)
+    if job_manifest is not None:
+        num_filenames = len(filenames)
+        pending_filepaths = set(job_manifest.get_pending([cla.noisy_input_path + filename for filename in filenames]))
+        filenames = [filename for filename in filenames if cla.noisy_input_path + filename in pending_filepaths]
+        print('Job %s: %d of %d inputs already completed' % (
+            cla.job_name, num_filenames - len(filenames), num_filenames))
+        for filename in filenames:
+            job_manifest.mark_started(cla.noisy_input_path + filename)
+
+    def on_file_done(filename, output_filepaths):
+        if job_manifest is not None:
+            job_manifest.mark_complete(cla.noisy_input_path + filename, output_filepaths)
+
+    def on_shard_file_done(filename, result):
+        output_filepaths, telemetry_state = result
+        inference_telemetry.merge(telemetry_state)
+        on_file_done(filename, output_filepaths)
+
+    if num_shards > 1:
+        if bool(cla.fast_start) or cla.quantization is not None:
+            # Built once here rather than by every worker
+            get_fast_start_model_path(config, cla, batch_size)
+        print('Performing sharded inference with %d workers..' % num_shards)
+        inference_telemetry = telemetry.InferenceTelemetry()
+        sharding.run_shards(inference_worker, (config, cla, batch_size, output_folder_path,
+                                               partial_output_folder_path),
+                            sharding.order_largest_first(filenames, cla.noisy_input_path), num_shards,
+                            config['dataset']['sample_rate'], on_work_item_done=on_shard_file_done)
+        write_telemetry(cla, inference_telemetry)
+        return
+
+    get_model = get_inference_model_getter(config, cla, batch_size)
+    if not bool(cla.one_shot):
+        print('Performing inference..')
+    else:
+        print('Performing one-shot inference..')
+
+    condition_input = get_condition_input(config, cla)
+
+    inference_telemetry = telemetry.InferenceTelemetry()
+    for filename in filenames:
         print("Denoising: " + filename)
-        denoise.denoise_sample(model, input, condition_input, batch_size, output_filename_prefix,
-                               config['dataset']['sample_rate'], output_folder_path)
+        _, output_filepaths = denoise_file(config, cla, get_model, filename, condition_input, batch_size,
+                                           output_folder_path, partial_output_folder_path=partial_output_folder_path,
+                                           inference_telemetry=inference_telemetry)
+        on_file_done(filename, output_filepaths)
+
+    write_telemetry(cla, inference_telemetry)
+
+
+def write_telemetry(cla, inference_telemetry):
+
+    if cla.telemetry_path is None:
+        return
+
+    if not os.path.isdir(cla.telemetry_path):
+        os.makedirs(cla.telemetry_path)
+    inference_telemetry.write_json(os.path.join(cla.telemetry_path, 'wavenet_inference.json'))
+    inference_telemetry.write_prometheus(os.path.join(cla.telemetry_path, 'wavenet_inference.prom'))
+
+    summary = inference_telemetry.get_summary()
+    if summary['num_files'] > 0:
+        print('Telemetry: %d files, real-time factor %.3f, batch fill %.2f, peak memory %d MB, written to %s' % (
+            summary['num_files'], summary['real_time_factor'], summary['batch_fill_ratio'] or 0.0,
+            summary['peak_rss_bytes'] // 2 ** 20, cla.telemetry_path))
+
+
+def inference_worker(shard_i, cores, work_queue, log_queue, config, cla, batch_size, output_folder_path,
+                     partial_output_folder_path):
+
+    sharding.set_worker_resources(cores)
+
+    get_model = get_inference_model_getter(config, cla, batch_size)
+    condition_input = get_condition_input(config, cla)
+
+    for filename in sharding.iterate_work_queue(work_queue):
+        start_time = time.time()
+        # Each file gets its own telemetry, merged into the job telemetry by the parent process
+        file_telemetry = telemetry.InferenceTelemetry()
+        num_samples, output_filepaths = denoise_file(config, cla, get_model, filename, condition_input, batch_size,
+                                                     output_folder_path, show_progress=False,
+                                                     partial_output_folder_path=partial_output_folder_path,
+                                                     inference_telemetry=file_telemetry)
+        sharding.log_progress(log_queue, shard_i, filename, num_samples, time.time() - start_time,
+                              (output_filepaths, file_telemetry.get_state()))
+
+
+def serve(config, cla):
+
+    if bool(cla.one_shot):
+        raise ValueError('The denoising server does not support --one_shot')
+    if bool(cla.fold_condition):
+        raise ValueError('The denoising server takes the condition per request and does not support --fold_condition')
+
+    batch_size = get_inference_batch_size(config, cla)
+    if cla.target_field_length is not None:
+        cla.target_field_length = int(cla.target_field_length)
+
+    model = get_inference_model_getter(config, cla, batch_size)(0)
+    server.serve(model, batch_size, config['dataset']['sample_rate'], config['model']['condition_encoding'],
+                 host=cla.host, port=int(cla.port), max_wait_ms=float(cla.max_wait_ms),
+                 max_pending_fragments=int(cla.max_pending_fragments))
+
+
+def export_model(config, cla):
+
+    import models
+    import export
+
+    batch_size = get_inference_batch_size(config, cla)
+
+    if cla.target_field_length is not None:
+        cla.target_field_length = int(cla.target_field_length)
+
+    if cla.export_path is None:
+        cla.export_path = os.path.join(config['training']['path'], 'export')
+
+    quantizations = [None]
+    if cla.quantization is not None:
+        quantizations += cla.quantization.split(',')
+
+    model = models.DenoisingWavenet(config, target_field_length=cla.target_field_length,
+                                    load_checkpoint=cla.load_checkpoint, print_model_summary=cla.print_model_summary,
+                                    inference_only=True)
+    dataset = get_dataset(config, model) if 'int8' in quantizations else None
+    export.export_model(model, cla.export_path, batch_size, quantizations, dataset, int(cla.num_calibration_batches))
+
+
+def profile_configs(config, cla):
+
+    # Analytic cost of one or more configs, with --profile_measure the figures of the real models next to them
+    config_paths = [cla.config] if cla.profile_configs is None else cla.profile_configs.split(',')
+    target_field_length = int(cla.target_field_length) if cla.target_field_length is not None else None
+
+    profiles = []
+    for config_path in config_paths:
+        profile_config = load_config(config_path)
+        profiles.append((config_path, profiler.get_profile(
+            profile_config, profile_config['training']['batch_size'], get_inference_batch_size(profile_config, cla),
+            target_field_length)))
+
+        if len(config_paths) == 1:
+            profiler.print_layer_table(profiler.get_layer_profiles(
+                profile_config, get_inference_batch_size(profile_config, cla), target_field_length))
+            print('')
+    profiler.print_comparison_table(profiles)
+
+    if cla.profile_measure:
+        measurements = [profiler.measure_profile(load_config(config_path), profile, int(cla.num_batches))
+                        for config_path, profile in profiles]
+        print('')
+        profiler.print_measurement_table(profiles, measurements)
+
 
 # from tensorflow.compat.v1 import ConfigProto
 # from tensorflow.compat.v1 import InteractiveSession
@@ -179,8 +660,23 @@ def main():
 
     if cla.mode == 'training':
         training(config, cla)
+    elif cla.mode == 'distillation':
+        distillation_training(config, cla)
+    elif cla.mode == 'pruning':
+        prune_model(config, cla)
     elif cla.mode == 'inference':
         inference(config, cla)
+    elif cla.mode == 'serve':
+        serve(config, cla)
+    elif cla.mode == 'export':
+        export_model(config, cla)
+    elif cla.mode == 'preprocess':
+        preprocess_dataset(config, cla)
+    elif cla.mode == 'profile':
+        profile_configs(config, cla)
+    elif cla.mode == 'benchmark':
+        import benchmark
+        benchmark.run_benchmark(config, cla)
 
 
 if __name__ == "__main__":
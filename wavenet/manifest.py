@@ -0,0 +1,111 @@
+# Manifest.py
+# Job manifest for resumable batch inference: records which inputs were completed, with which checkpoint and
+# settings, and where their outputs went
+
+import os
+import json
+import hashlib
+
+
+def get_file_hash(file_path, block_length=1 << 20):
+
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(block_length), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_checkpoint_identity(checkpoint_path):
+
+    if checkpoint_path is None:
+        return None
+    checkpoint_stat = os.stat(checkpoint_path)
+    return {'path': os.path.abspath(checkpoint_path), 'size': checkpoint_stat.st_size,
+            'mtime': checkpoint_stat.st_mtime}
+
+
+class JobManifest():
+
+    def __init__(self, output_path, checkpoint_path, settings):
+
+        self.manifest_path = os.path.join(output_path, 'manifest.json')
+        self.partial_path = os.path.join(output_path, '.partial')
+        self.checkpoint = get_checkpoint_identity(checkpoint_path)
+        self.settings = settings
+        self.entries = {}
+
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as manifest_file:
+                self.entries = json.load(manifest_file)['entries']
+
+        if not os.path.exists(self.partial_path):
+            os.makedirs(self.partial_path)
+
+    def is_complete(self, input_path):
+
+        entry = self.entries.get(os.path.abspath(input_path))
+        if entry is None or entry['status'] != 'complete':
+            return False
+        if entry['checkpoint'] != self.checkpoint or entry['settings'] != self.settings:
+            return False
+        if not all(os.path.exists(output_path) for output_path in entry['outputs']):
+            return False
+
+        # Size and mtime are enough when unchanged, the content hash settles it when they differ
+        input_stat = os.stat(input_path)
+        if entry['size'] == input_stat.st_size and entry['mtime'] == input_stat.st_mtime:
+            return True
+        if entry['size'] == input_stat.st_size and entry['hash'] == get_file_hash(input_path):
+            entry['mtime'] = input_stat.st_mtime
+            self.save()
+            return True
+        return False
+
+    def get_pending(self, input_paths):
+        return [input_path for input_path in input_paths if not self.is_complete(input_path)]
+
+    def mark_started(self, input_path):
+
+        # Outputs of an earlier, stale run are removed, their file names may differ from the new ones
+        entry = self.entries.get(os.path.abspath(input_path))
+        if entry is not None:
+            for output_path in entry['outputs']:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+
+        self.entries[os.path.abspath(input_path)] = {'status': 'partial', 'outputs': []}
+        self.save()
+
+    def mark_complete(self, input_path, output_paths):
+
+        input_stat = os.stat(input_path)
+        self.entries[os.path.abspath(input_path)] = {
+            'status': 'complete',
+            'size': input_stat.st_size,
+            'mtime': input_stat.st_mtime,
+            'hash': get_file_hash(input_path),
+            'checkpoint': self.checkpoint,
+            'settings': self.settings,
+            'outputs': output_paths
+        }
+        self.save()
+
+    def save(self):
+
+        # Written to a temporary file and renamed, so an interruption never leaves a truncated manifest
+        temporary_manifest_path = self.manifest_path + '.tmp'
+        with open(temporary_manifest_path, 'w') as manifest_file:
+            json.dump({'entries': self.entries}, manifest_file, sort_keys=True, indent=4, separators=(',', ': '))
+        os.replace(temporary_manifest_path, self.manifest_path)
+
+
+def commit_outputs(partial_output_paths, output_path):
+
+    # Outputs are written into the partial folder first and renamed into place once the whole file is done
+    output_paths = []
+    for partial_output_path in partial_output_paths:
+        final_output_path = os.path.join(output_path, os.path.basename(partial_output_path))
+        os.replace(partial_output_path, final_output_path)
+        output_paths.append(final_output_path)
+    return output_paths
@@ -3,16 +3,21 @@
 
 import util
 import os
+import copy
+import collections
 import numpy as np
 import layers
 import logging
+import checkpoints
+import async_checkpoint
 
 import tensorflow as tf
 from tensorflow.keras.models import Model
-from tensorflow.keras.layers import Input, Dense, Activation, Lambda, Add, Multiply, Conv1D, RepeatVector, Reshape
+from tensorflow.keras.layers import Input, Dense, Activation, Lambda, Add, Multiply, Conv1D, RepeatVector, Reshape, \
+    Cropping1D, ZeroPadding1D
 from tensorflow.keras import backend as K
 from tensorflow.keras.losses import MeanAbsoluteError
-from tensorflow.keras.callbacks import ReduceLROnPlateau, EarlyStopping, ModelCheckpoint, CSVLogger
+from tensorflow.keras.callbacks import ReduceLROnPlateau, EarlyStopping, CSVLogger
 from tensorflow.keras.optimizers import Adam
 
 
@@ -30,7 +35,8 @@ def out_2_loss_fn(y_true, y_pred, weight, l1, l2):
 
 class DenoisingWavenet():
 
-    def __init__(self, config, load_checkpoint=None, input_length=None, target_field_length=None, print_model_summary=False):
+    def __init__(self, config, load_checkpoint=None, input_length=None, target_field_length=None, print_model_summary=False,
+                 weights=None, strategy=None, inference_only=False):
 
         self.config = config
         self.verbosity = config['training']['verbosity']
@@ -46,9 +52,9 @@ class DenoisingWavenet():
 
         self.condition_input_length = self.get_condition_input_length(
             self.config['model']['condition_encoding'])
-        self.receptive_field_length = util.compute_receptive_field_length(config['model']['num_stacks'], self.dilations,
-                                                                          config['model']['filters']['lengths']['res'],
-                                                                          1)
+        self.receptive_field_length = int(util.compute_receptive_field_length(config['model']['num_stacks'], self.dilations,
+                                                                              config['model']['filters']['lengths']['res'],
+                                                                              1))
 
         if input_length is not None:
             self.input_length = int(input_length)
@@ -68,25 +74,50 @@ class DenoisingWavenet():
         self.half_target_field_length = self.target_field_length // 2
         self.half_receptive_field_length = self.receptive_field_length // 2
         self.num_residual_blocks = len(self.dilations) * self.num_stacks
+        # Broadcast condition adds and fused gating instead of RepeatVector and Slice tensors, same weights
+        self.memory_lean = self.config['model'].get('memory_lean', False)
+        # Keras dtype policy such as mixed_bfloat16; inputs, outputs, losses and variables stay float32
+        self.mixed_precision = self.config['model'].get('mixed_precision')
         self.activation = Activation('relu')
         self.samples_of_interest_indices = self.get_padded_target_field_indices()
         self.target_sample_indices = self.get_target_field_indices()
 
-        self.optimizer = self.get_optimizer()
-        self.out_1_loss = self.get_out_1_loss()
-        self.out_2_loss = self.get_out_2_loss()
-        self.metrics = self.get_metrics()
+        # An inference-only model is never compiled, so it needs no optimizer, losses or metrics
+        self.inference_only = inference_only
+        self.optimizer = None
+        self.out_1_loss = None
+        self.out_2_loss = None
+        self.metrics = None
+        if not self.inference_only:
+            self.optimizer = self.get_optimizer()
+            self.out_1_loss = self.get_out_1_loss()
+            self.out_2_loss = self.get_out_2_loss()
+            self.metrics = self.get_metrics()
         self.epoch_num = 0
         self.checkpoints_path = ''
+        self.checkpoint_path = None
         self.samples_path = ''
         self.history_filename = ''
+        self.inference_function = None
+        self.inference_batch_size = None
+        self.folded_model = None
+        self.folded_condition_input = None
+        self.shared_inference_layers = {}
+        self.strategy = strategy
 
         self.config['model']['num_residual_blocks'] = self.num_residual_blocks
         self.config['model']['receptive_field_length'] = self.receptive_field_length
         self.config['model']['input_length'] = int(self.input_length)
         self.config['model']['target_field_length'] = self.target_field_length
 
-        self.model = self.setup_model(load_checkpoint, print_model_summary)
+        if self.strategy is not None:
+            # Variables, the optimizer and compiled metrics are mirrored across workers, so they are all created
+            # inside the strategy scope
+            with self.strategy.scope():
+                self.optimizer = self.get_optimizer()
+                self.model = self.setup_model(load_checkpoint, print_model_summary, weights)
+        else:
+            self.model = self.setup_model(load_checkpoint, print_model_summary, weights)
 
     def get_config(self):
         # Return a dictionary of all important parameters to re-create the model
@@ -112,7 +143,7 @@ class DenoisingWavenet():
         }
         return config
 
-    def setup_model(self, load_checkpoint=None, print_model_summary=False):
+    def setup_model(self, load_checkpoint=None, print_model_summary=False, weights=None):
 
         self.checkpoints_path = os.path.join(
             self.config['training']['path'], 'checkpoints')
@@ -121,44 +152,47 @@ class DenoisingWavenet():
         self.history_filename = 'history_' + self.config['training']['path'][
             self.config['training']['path'].rindex('/') + 1:] + '.csv'
 
-        model = self.build_model()
+        # Layers take the global dtype policy when they are created, so it is only set while building. Variables
+        # stay float32 under mixed policies, so checkpoints are interchangeable with float32 runs. Compiling
+        # a mixed_float16 model wraps the optimizer in a LossScaleOptimizer, bfloat16 needs no loss scaling
+        previous_dtype_policy = tf.keras.mixed_precision.global_policy()
+        if self.mixed_precision is not None:
+            tf.keras.mixed_precision.set_global_policy(self.mixed_precision)
+        try:
+            model = self.build_model()
+        finally:
+            tf.keras.mixed_precision.set_global_policy(previous_dtype_policy)
+
+        self.checkpoint_path, self.epoch_num = checkpoints.get_checkpoint_path(self.checkpoints_path, load_checkpoint)
+
+        if weights is not None:
+            # Weights already loaded by another model instance, e.g. a ModelCache bucket
+            model.set_weights(weights)
+
+        elif self.checkpoint_path is not None:
 
-        if os.path.exists(self.checkpoints_path) and util.dir_contains_files(self.checkpoints_path):
-
-            if load_checkpoint is not None:
-                last_checkpoint_path = load_checkpoint
-                self.epoch_num = 0
-            else:
-                checkpoints = os.listdir(self.checkpoints_path)
-                checkpoints.sort(key=lambda x: os.stat(
-                    os.path.join(self.checkpoints_path, x)).st_mtime)
-                last_checkpoint = checkpoints[-1]
-                last_checkpoint_path = os.path.join(
-                    self.checkpoints_path, last_checkpoint)
-                self.epoch_num = int(last_checkpoint[11:16])
             print('Loading model from epoch: %d' % self.epoch_num)
-            model.load_weights(last_checkpoint_path)
+            model.load_weights(self.checkpoint_path)
 
         else:
             print('Building new model...')
 
-            if not os.path.exists(self.config['training']['path']):
-                os.mkdir(self.config['training']['path'])
-
-            if not os.path.exists(self.checkpoints_path):
-                os.mkdir(self.checkpoints_path)
+            # exist_ok, since several training workers may set up the same session at once
+            os.makedirs(self.checkpoints_path, exist_ok=True)
 
             self.epoch_num = 0
 
-        if not os.path.exists(self.samples_path):
-            os.mkdir(self.samples_path)
+        os.makedirs(self.samples_path, exist_ok=True)
 
         if print_model_summary:
             model.summary()
 
+        self.config['model']['num_params'] = model.count_params()
+        if self.inference_only:
+            return model
+
         model.compile(optimizer=self.optimizer,
                       loss={'data_output_1': self.out_1_loss, 'data_output_2': self.out_2_loss}, metrics=self.metrics)
-        self.config['model']['num_params'] = model.count_params()
 
         config_path = os.path.join(
             self.config['training']['path'], 'config.json')
@@ -171,8 +205,23 @@ class DenoisingWavenet():
 
     def get_optimizer(self):
 
+        gradient_accumulation_steps = self.get_gradient_accumulation_steps()
+        if gradient_accumulation_steps == 1:
+            gradient_accumulation_steps = None
         return Adam(learning_rate=self.config['optimizer']['lr'], decay=self.config['optimizer']['decay'],
-                    epsilon=self.config['optimizer']['epsilon'])
+                    epsilon=self.config['optimizer']['epsilon'],
+                    gradient_accumulation_steps=gradient_accumulation_steps)
+
+    def get_gradient_accumulation_steps(self):
+
+        # batch_size is the micro-batch that goes through the model at once. With a larger effective_batch_size,
+        # the optimizer averages the gradients of effective_batch_size / batch_size micro-batches per update
+        batch_size = self.config['training']['batch_size']
+        effective_batch_size = self.config['training'].get('effective_batch_size', batch_size)
+        if effective_batch_size % batch_size != 0:
+            raise ValueError('effective_batch_size %d is not a multiple of batch_size %d' % (
+                effective_batch_size, batch_size))
+        return effective_batch_size // batch_size
 
     def get_out_1_loss(self):
         if self.config['training']['loss']['out_1']['weight'] == 0:
@@ -215,24 +264,40 @@ class DenoisingWavenet():
     #         self.config['training']['loss']['out_2']['l2'])
     
 
-    def get_callbacks(self):
+    def get_callbacks(self, is_chief=True):
 
-        return [
+        callbacks = [
             ReduceLROnPlateau(patience=self.config['training']['early_stopping_patience'] / 2,
                               cooldown=self.config['training']['early_stopping_patience'] / 4,
                               verbose=1),
             EarlyStopping(patience=self.config['training']['early_stopping_patience'], verbose=1,
-                          monitor='loss'),
-            ModelCheckpoint(os.path.join(
-                self.checkpoints_path, 'checkpoint.{epoch:05d}-{val_loss:.3f}.keras')),
-            CSVLogger(os.path.join(
-                self.config['training']['path'], self.history_filename), append=True)
+                          monitor='loss')
         ]
+        if is_chief:
+            checkpoint_manager = checkpoints.CheckpointManager(
+                self.checkpoints_path, self.config['training'].get('checkpoints_to_keep', 5))
+            callbacks += [
+                async_checkpoint.AsyncCheckpoint(checkpoint_manager, self.build_checkpoint_model),
+                CSVLogger(os.path.join(
+                    self.config['training']['path'], self.history_filename), append=True)
+            ]
+        return callbacks
+
+    def build_checkpoint_model(self):
+
+        # A second float32 graph with the same layout, which the checkpoint thread writes from
+        shared_inference_layers = self.shared_inference_layers
+        model = self.build_model()
+        self.shared_inference_layers = shared_inference_layers
+        return model
 
     def fit_model(self, train_set_generator, num_train_samples, test_set_generator, num_test_samples, num_epochs):
 
         print(
             f"Fitting model with {num_train_samples} training samples and {num_test_samples} test samples...")
+        if self.get_gradient_accumulation_steps() > 1:
+            print('Accumulating gradients over %d micro-batches per optimizer step' % (
+                self.get_gradient_accumulation_steps()))
 
         self.model.fit(train_set_generator,
             epochs=num_epochs,
@@ -251,8 +316,114 @@ class DenoisingWavenet():
         #                verbose=self.verbosity,
         #                initial_epoch=self.epoch_num)
 
+    def fit_model_distributed(self, train_dataset, num_train_samples, test_dataset, num_test_samples, num_epochs,
+                              is_chief):
+
+        # Synchronous data-parallel counterpart of fit_model over distributed datasets, one batch per worker and
+        # step. Gradients are summed across workers by the optimizer and the losses are scaled by the number of
+        # replicas, so a step is one update with a global batch of num_workers * batch_size. Every worker sees
+        # the same reduced logs, so learning rate and early stopping decisions stay in sync
+        strategy = self.strategy
+        model = self.model
+
+        print(f"Fitting model on {strategy.num_replicas_in_sync} replicas with {num_train_samples} training "
+              f"samples and {num_test_samples} test samples...")
+
+        with strategy.scope():
+            model.optimizer.build(model.trainable_variables)
+
+        def reduce_logs(logs):
+            return dict((key, strategy.reduce('MEAN', value, axis=None)) for key, value in logs.items())
+
+        @tf.function
+        def train_function(iterator):
+            return reduce_logs(strategy.run(model.train_step, args=(next(iterator),)))
+
+        @tf.function
+        def test_function(iterator):
+            return reduce_logs(strategy.run(model.test_step, args=(next(iterator),)))
+
+        callbacks = tf.keras.callbacks.CallbackList(self.get_callbacks(is_chief), model=model, epochs=num_epochs,
+                                                    steps=num_train_samples, verbose=self.verbosity)
+        train_iterator = iter(train_dataset)
+        test_iterator = iter(test_dataset)
+
+        model.stop_training = False
+        callbacks.on_train_begin()
+        for epoch in range(num_epochs):
+            callbacks.on_epoch_begin(epoch)
+            model.reset_metrics()
+            for step in range(num_train_samples):
+                callbacks.on_train_batch_begin(step)
+                logs = train_function(train_iterator)
+                callbacks.on_train_batch_end(step, logs)
+            epoch_logs = dict((key, float(value)) for key, value in logs.items())
+
+            model.reset_metrics()
+            for _ in range(num_test_samples):
+                logs = test_function(test_iterator)
+            epoch_logs.update(('val_' + key, float(value)) for key, value in logs.items())
+
+            print('Epoch %d/%d: %s' % (epoch + 1, num_epochs, ', '.join(
+                '%s %.4f' % (key, value) for key, value in sorted(epoch_logs.items()))))
+            callbacks.on_epoch_end(epoch, epoch_logs)
+            if model.stop_training:
+                break
+        callbacks.on_train_end()
+
+    def compile_inference(self, batch_size, jit_compile=False):
+
+        # Fixed-signature inference function: every batch, including the padded tail batch, reuses one trace
+        self.inference_batch_size = int(batch_size)
+        model = self.model
+        folded_model = self.folded_model
+
+        @tf.function(input_signature=[
+            tf.TensorSpec((self.inference_batch_size, self.input_length), tf.float32, name='data_input'),
+            tf.TensorSpec((self.inference_batch_size, self.condition_input_length), tf.float32, name='condition_input')],
+            jit_compile=jit_compile)
+        def inference_function(data_input, condition_input):
+            if folded_model is not None:
+                return folded_model(data_input, training=False)
+            return model([data_input, condition_input], training=False)
+
+        self.inference_function = inference_function
+
+        # Warm up, so that tracing and compilation do not land on the first real batch
+        self.inference_function(np.zeros((self.inference_batch_size, self.input_length), dtype='float32'),
+                                np.zeros((self.inference_batch_size, self.condition_input_length), dtype='float32'))
+
+    def fold_condition(self, condition_input):
+
+        # Inference for a single fixed condition, see build_condition_folded_model. Call before compile_inference
+        self.folded_condition_input = np.array(condition_input, dtype='float32')
+        self.folded_model = self.build_condition_folded_model(self.folded_condition_input)
+
     def denoise_batch(self, inputs):
-        return self.model.predict_on_batch(inputs)
+
+        if self.folded_model is not None and np.any(inputs['condition_input'] != self.folded_condition_input):
+            raise ValueError('Condition input differs from the condition folded into the inference graph')
+
+        if self.inference_function is None:
+            if self.folded_model is not None:
+                return self.folded_model.predict_on_batch(inputs['data_input'])
+            return self.model.predict_on_batch(inputs)
+
+        num_fragments = inputs['data_input'].shape[0]
+        outputs = [[], []]
+        for batch_start in range(0, num_fragments, self.inference_batch_size):
+            batch_end = min(batch_start + self.inference_batch_size, num_fragments)
+
+            data_input = np.zeros((self.inference_batch_size, self.input_length), dtype='float32')
+            condition_input = np.zeros((self.inference_batch_size, self.condition_input_length), dtype='float32')
+            data_input[:batch_end - batch_start] = inputs['data_input'][batch_start:batch_end]
+            condition_input[:batch_end - batch_start] = inputs['condition_input'][batch_start:batch_end]
+
+            batch_outputs = self.inference_function(data_input, condition_input)
+            for output_i in range(len(outputs)):
+                outputs[output_i].append(batch_outputs[output_i].numpy()[:batch_end - batch_start])
+
+        return [np.concatenate(output, axis=0) for output in outputs]
 
     def get_target_field_indices(self):
 
@@ -286,6 +457,9 @@ class DenoisingWavenet():
 
     def build_model(self):
 
+        if self.config['model'].get('progressive_cropping', False):
+            return self.build_progressively_cropped_model()
+
         data_input = Input(
             shape=(int(self.input_length),),
             name='data_input')
@@ -293,12 +467,12 @@ class DenoisingWavenet():
         condition_input = Input(shape=(int(self.condition_input_length),),
                                 name='condition_input')
 
-        data_expanded = layers.AddSingletonDepth()(data_input)
+        data_expanded = layers.AddSingletonDepth(dtype='float32')(data_input)
         data_input_target_field_length = layers.Slice(
             (slice(
                 self.samples_of_interest_indices[0], self.samples_of_interest_indices[-1] + 1, 1), Ellipsis),
             (self.padded_target_field_length, 1),
-            name='data_input_target_field_length')(data_expanded)
+            name='data_input_target_field_length', dtype='float32')(data_expanded)
 
         data_out = Conv1D(self.config['model']['filters']['depths']['res'],
                           self.config['model']['filters']['lengths']['res'], padding='same',
@@ -308,10 +482,13 @@ class DenoisingWavenet():
         condition_out = Dense(self.config['model']['filters']['depths']['res'],
                               name='initial_dense_condition',
                               use_bias=False)(condition_input)
-        condition_out = RepeatVector(int(self.input_length),
-                                     name='initial_condition_repeat')(condition_out)
-        data_out = Add(name='initial_data_condition_merge')(
-            [data_out, condition_out])
+        if self.memory_lean:
+            data_out = layers.BroadcastAdd(name='initial_data_condition_merge')([data_out, condition_out])
+        else:
+            condition_out = RepeatVector(int(self.input_length),
+                                         name='initial_condition_repeat')(condition_out)
+            data_out = Add(name='initial_data_condition_merge')(
+                [data_out, condition_out])
 
         skip_connections = []
         res_block_i = 0
@@ -328,51 +505,262 @@ class DenoisingWavenet():
         data_out = Add()(skip_connections)
         data_out = self.activation(data_out)
 
-        data_out = Conv1D(self.config['model']['filters']['depths']['final'][0],
-                          self.config['model']['filters']['lengths']['final'][0],
-                          padding='same',
-                          use_bias=False)(data_out)
+        self.shared_inference_layers['penultimate_conv'] = Conv1D(
+            self.config['model']['filters']['depths']['final'][0],
+            self.config['model']['filters']['lengths']['final'][0],
+            padding='same',
+            use_bias=False)
+        data_out = self.shared_inference_layers['penultimate_conv'](data_out)
 
         condition_out = Dense(self.config['model']['filters']['depths']['final'][0],
                               use_bias=False,
                               name='penultimate_conv_1d_condition')(condition_input)
 
-        condition_out = RepeatVector(self.padded_target_field_length,
-                                     name='penultimate_conv_1d_condition_repeat')(condition_out)
+        if self.memory_lean:
+            data_out = layers.BroadcastAdd(name='penultimate_conv_1d_condition_merge')([data_out, condition_out])
+        else:
+            condition_out = RepeatVector(self.padded_target_field_length,
+                                         name='penultimate_conv_1d_condition_repeat')(condition_out)
 
-        data_out = Add(name='penultimate_conv_1d_condition_merge')(
-            [data_out, condition_out])
+            data_out = Add(name='penultimate_conv_1d_condition_merge')(
+                [data_out, condition_out])
 
         data_out = self.activation(data_out)
-        data_out = Conv1D(self.config['model']['filters']['depths']['final'][1],
-                          self.config['model']['filters']['lengths']['final'][1], padding='same',
-                          use_bias=False)(data_out)
+        self.shared_inference_layers['final_conv'] = Conv1D(
+            self.config['model']['filters']['depths']['final'][1],
+            self.config['model']['filters']['lengths']['final'][1], padding='same',
+            use_bias=False)
+        data_out = self.shared_inference_layers['final_conv'](data_out)
 
         condition_out = Dense(self.config['model']['filters']['depths']['final'][1], use_bias=False,
                               name='final_conv_1d_condition')(condition_input)
 
-        condition_out = RepeatVector(self.padded_target_field_length,
-                                     name='final_conv_1d_condition_repeat')(condition_out)
+        if self.memory_lean:
+            data_out = layers.BroadcastAdd(name='final_conv_1d_condition_merge')([data_out, condition_out])
+        else:
+            condition_out = RepeatVector(self.padded_target_field_length,
+                                         name='final_conv_1d_condition_repeat')(condition_out)
 
-        data_out = Add(name='final_conv_1d_condition_merge')(
-            [data_out, condition_out])
+            data_out = Add(name='final_conv_1d_condition_merge')(
+                [data_out, condition_out])
 
-        data_out = Conv1D(1, 1)(data_out)
+        self.shared_inference_layers['output_conv'] = Conv1D(1, 1, dtype='float32')
+        data_out = self.shared_inference_layers['output_conv'](data_out)
 
         data_out_speech = data_out
-        data_out_noise = layers.Subtract(name='subtract_layer')(
+        data_out_noise = layers.Subtract(name='subtract_layer', dtype='float32')(
             [data_input_target_field_length, data_out_speech])
 
         data_out_speech = Lambda(lambda x: tf.squeeze(x, 2),
-                                 output_shape=lambda shape: (shape[0], shape[1]), name='data_output_1')(
+                                 output_shape=lambda shape: (shape[0], shape[1]), dtype='float32',
+                                 name='data_output_1')(
             data_out_speech)
 
         data_out_noise = Lambda(lambda x: tf.squeeze(x, 2),
-                                output_shape=lambda shape: (shape[0], shape[1]), name='data_output_2')(
+                                output_shape=lambda shape: (shape[0], shape[1]), dtype='float32',
+                                name='data_output_2')(
             data_out_noise)
 
         return Model(inputs=[data_input, condition_input], outputs=[data_out_speech, data_out_noise])
 
+    def get_progressive_crop_regions(self):
+
+        # Working backwards from the samples of interest, the [start, end) region of each residual block's output
+        # that still reaches them, and the region of the initial convolution's output the first block needs
+        target_region = (self.samples_of_interest_indices[0], self.samples_of_interest_indices[-1] + 1)
+        res_length = self.config['model']['filters']['lengths']['res']
+
+        block_regions = []
+        region = target_region
+        for dilation in reversed(self.dilations * self.num_stacks):
+            block_regions.insert(0, region)
+            region = self.get_conv_input_region(region, res_length, dilation)
+        return region, block_regions
+
+    def get_conv_input_region(self, output_region, kernel_size, dilation):
+
+        # Input samples a 'same' convolution reads for output_region, before clipping to the input
+        left = dilation * (kernel_size - 1) // 2
+        right = dilation * (kernel_size - 1) - left
+        return max(output_region[0] - left, 0), min(output_region[1] + right, self.input_length)
+
+    def build_progressively_cropped_model(self):
+
+        # Same outputs and weights as the standard model, but every layer only computes the region of its output
+        # that can still reach the samples of interest: convolutions are valid instead of 'same', zero-padded only
+        # where the 'same' convolution would have read past the input, and the residual path is cropped to match
+        # Condition adds and gating are always those of the memory_lean graph
+        res_depth = self.config['model']['filters']['depths']['res']
+        skip_depth = self.config['model']['filters']['depths']['skip']
+        res_length = self.config['model']['filters']['lengths']['res']
+        target_region = (self.samples_of_interest_indices[0], self.samples_of_interest_indices[-1] + 1)
+        initial_region, block_regions = self.get_progressive_crop_regions()
+
+        def crop(data_x, region, cropped_region):
+            if cropped_region == region:
+                return data_x
+            return Cropping1D((cropped_region[0] - region[0], region[1] - cropped_region[1]))(data_x)
+
+        def cropped_conv(conv, data_x, region, output_region):
+            left = conv.dilation_rate[0] * (conv.kernel_size[0] - 1) // 2
+            right = conv.dilation_rate[0] * (conv.kernel_size[0] - 1) - left
+            data_x = crop(data_x, region, self.get_conv_input_region(
+                output_region, conv.kernel_size[0], conv.dilation_rate[0]))
+            padding = (max(left - output_region[0], 0), max(output_region[1] + right - self.input_length, 0))
+            if padding != (0, 0):
+                data_x = ZeroPadding1D(padding)(data_x)
+            return conv(data_x)
+
+        data_input = Input(shape=(int(self.input_length),), name='data_input')
+        condition_input = Input(shape=(int(self.condition_input_length),), name='condition_input')
+
+        data_expanded = layers.AddSingletonDepth(dtype='float32')(data_input)
+        data_input_target_field_length = layers.Slice(
+            (slice(self.samples_of_interest_indices[0], self.samples_of_interest_indices[-1] + 1, 1), Ellipsis),
+            (self.padded_target_field_length, 1),
+            name='data_input_target_field_length', dtype='float32')(data_expanded)
+
+        data_out = cropped_conv(Conv1D(res_depth, res_length, use_bias=False, name='initial_causal_conv'),
+                                data_expanded, (0, self.input_length), initial_region)
+        condition_out = Dense(res_depth, name='initial_dense_condition', use_bias=False)(condition_input)
+        data_out = layers.BroadcastAdd(name='initial_data_condition_merge')([data_out, condition_out])
+
+        skip_connections = []
+        region = initial_region
+        res_block_i = 0
+        for stack_i in range(self.num_stacks):
+            for layer_in_stack, dilation in enumerate(self.dilations):
+                block_region = block_regions[res_block_i]
+                res_block_i += 1
+                original_x = data_out
+
+                data_out = cropped_conv(Conv1D(2 * res_depth, res_length, dilation_rate=dilation, use_bias=False,
+                                               name='res_%d_dilated_conv_d%d_s%d' % (res_block_i, dilation, stack_i)),
+                                        data_out, region, block_region)
+                condition_out = Dense(2 * res_depth, use_bias=False, name='res_%d_dense_condition_%d_s%d' % (
+                    res_block_i, layer_in_stack, stack_i))(condition_input)
+                data_x = layers.GatedActivation(
+                    name=f"res_{res_block_i}_gated_activation_{layer_in_stack}_s{stack_i}")([data_out, condition_out])
+
+                self.shared_inference_layers['res_%d_output_conv' % res_block_i] = Conv1D(
+                    res_depth + skip_depth, 1, use_bias=False)
+                data_x = self.shared_inference_layers['res_%d_output_conv' % res_block_i](data_x)
+
+                block_length = block_region[1] - block_region[0]
+                skip_x = layers.Slice((Ellipsis, slice(res_depth, res_depth + skip_depth)),
+                                      (block_length, skip_depth))(data_x)
+                skip_connections.append(crop(skip_x, block_region, target_region))
+
+                res_x = layers.Slice((Ellipsis, slice(0, res_depth)), (block_length, res_depth))(data_x)
+                data_out = Add()([crop(original_x, region, block_region), res_x])
+                region = block_region
+
+        data_out = Add()(skip_connections)
+        data_out = self.activation(data_out)
+
+        self.shared_inference_layers['penultimate_conv'] = Conv1D(
+            self.config['model']['filters']['depths']['final'][0],
+            self.config['model']['filters']['lengths']['final'][0], padding='same', use_bias=False)
+        data_out = self.shared_inference_layers['penultimate_conv'](data_out)
+        condition_out = Dense(self.config['model']['filters']['depths']['final'][0], use_bias=False,
+                              name='penultimate_conv_1d_condition')(condition_input)
+        data_out = layers.BroadcastAdd(name='penultimate_conv_1d_condition_merge')([data_out, condition_out])
+
+        data_out = self.activation(data_out)
+        self.shared_inference_layers['final_conv'] = Conv1D(
+            self.config['model']['filters']['depths']['final'][1],
+            self.config['model']['filters']['lengths']['final'][1], padding='same', use_bias=False)
+        data_out = self.shared_inference_layers['final_conv'](data_out)
+        condition_out = Dense(self.config['model']['filters']['depths']['final'][1], use_bias=False,
+                              name='final_conv_1d_condition')(condition_input)
+        data_out = layers.BroadcastAdd(name='final_conv_1d_condition_merge')([data_out, condition_out])
+
+        self.shared_inference_layers['output_conv'] = Conv1D(1, 1, dtype='float32')
+        data_out_speech = self.shared_inference_layers['output_conv'](data_out)
+        data_out_noise = layers.Subtract(name='subtract_layer', dtype='float32')(
+            [data_input_target_field_length, data_out_speech])
+
+        data_out_speech = Lambda(lambda x: tf.squeeze(x, 2), output_shape=lambda shape: (shape[0], shape[1]),
+                                 dtype='float32', name='data_output_1')(data_out_speech)
+        data_out_noise = Lambda(lambda x: tf.squeeze(x, 2), output_shape=lambda shape: (shape[0], shape[1]),
+                                dtype='float32', name='data_output_2')(data_out_noise)
+
+        return Model(inputs=[data_input, condition_input], outputs=[data_out_speech, data_out_noise])
+
+    def build_condition_folded_model(self, condition_input):
+
+        # Same outputs as self.model for one condition input, which is no longer an input of the graph.
+        # The condition only ever enters as Dense(condition) repeated over time and added to a bias-free
+        # convolution, so each projection is computed once here and becomes that convolution's bias
+        res_depth = self.config['model']['filters']['depths']['res']
+        skip_depth = self.config['model']['filters']['depths']['skip']
+
+        def condition_folded_conv(conv, condition_layer_name, data_x, interleaved=False):
+            kernel = conv.get_weights()[0]
+            bias = np.dot(condition_input, self.model.get_layer(condition_layer_name).get_weights()[0])
+            if interleaved:
+                # Residual block projections are reshaped to (res, 2): even units feed tanh, odd units the sigmoid
+                bias = np.concatenate((bias[0::2], bias[1::2]))
+            folded_conv = Conv1D(kernel.shape[-1], kernel.shape[0], dilation_rate=conv.dilation_rate,
+                                 padding='same', name=conv.name + '_folded')
+            data_out = folded_conv(data_x)
+            folded_conv.set_weights([kernel, bias])
+            return data_out
+
+        data_input = Input(shape=(int(self.input_length),), name='data_input')
+
+        data_expanded = layers.AddSingletonDepth()(data_input)
+        data_input_target_field_length = layers.Slice(
+            (slice(self.samples_of_interest_indices[0], self.samples_of_interest_indices[-1] + 1, 1), Ellipsis),
+            (self.padded_target_field_length, 1))(data_expanded)
+
+        data_out = condition_folded_conv(self.model.get_layer('initial_causal_conv'), 'initial_dense_condition',
+                                         data_expanded)
+
+        skip_connections = []
+        res_block_i = 0
+        for stack_i in range(self.num_stacks):
+            for layer_in_stack, dilation in enumerate(self.dilations):
+                res_block_i += 1
+                original_x = data_out
+
+                data_out = condition_folded_conv(
+                    self.model.get_layer('res_%d_dilated_conv_d%d_s%d' % (res_block_i, dilation, stack_i)),
+                    'res_%d_dense_condition_%d_s%d' % (res_block_i, layer_in_stack, stack_i), data_out,
+                    interleaved=True)
+                tanh_out = Activation('tanh')(
+                    layers.Slice((Ellipsis, slice(0, res_depth)), (self.input_length, res_depth))(data_out))
+                sigm_out = Activation('sigmoid')(
+                    layers.Slice((Ellipsis, slice(res_depth, 2 * res_depth)), (self.input_length, res_depth))(
+                        data_out))
+                data_x = self.shared_inference_layers['res_%d_output_conv' % res_block_i](
+                    Multiply()([tanh_out, sigm_out]))
+
+                res_x = layers.Slice((Ellipsis, slice(0, res_depth)), (self.input_length, res_depth))(data_x)
+                skip_x = layers.Slice((Ellipsis, slice(res_depth, res_depth + skip_depth)),
+                                      (self.input_length, skip_depth))(data_x)
+                skip_x = layers.Slice((slice(self.samples_of_interest_indices[0],
+                                             self.samples_of_interest_indices[-1] + 1, 1), Ellipsis),
+                                      (self.padded_target_field_length, skip_depth))(skip_x)
+                skip_connections.append(skip_x)
+                data_out = Add()([original_x, res_x])
+
+        data_out = self.activation(Add()(skip_connections))
+        data_out = condition_folded_conv(self.shared_inference_layers['penultimate_conv'],
+                                         'penultimate_conv_1d_condition', data_out)
+        data_out = self.activation(data_out)
+        data_out = condition_folded_conv(self.shared_inference_layers['final_conv'], 'final_conv_1d_condition',
+                                         data_out)
+        data_out_speech = self.shared_inference_layers['output_conv'](data_out)
+        data_out_noise = layers.Subtract()([data_input_target_field_length, data_out_speech])
+
+        data_out_speech = Lambda(lambda x: tf.squeeze(x, 2), output_shape=lambda shape: (shape[0], shape[1]),
+                                 name='data_output_1')(data_out_speech)
+        data_out_noise = Lambda(lambda x: tf.squeeze(x, 2), output_shape=lambda shape: (shape[0], shape[1]),
+                                name='data_output_2')(data_out_noise)
+
+        return Model(inputs=data_input, outputs=[data_out_speech, data_out_noise])
+
     def dilated_residual_block(self, data_x, condition_x, res_block_i, layer_i, dilation, stack_i):
 
         original_x = data_x
@@ -386,58 +774,63 @@ class DenoisingWavenet():
             res_block_i, dilation, stack_i),
             activation=None)(data_x)
 
-        data_out_1 = layers.Slice(
-            (Ellipsis, slice(
-                0, self.config['model']['filters']['depths']['res'])),
-            (int(self.input_length), self.config['model']
-             ['filters']['depths']['res']),
-            name='res_%d_data_slice_1_d%d_s%d' % (self.num_residual_blocks, dilation, stack_i))(data_out)
-
-        data_out_2 = layers.Slice(
-            (Ellipsis, slice(self.config['model']['filters']['depths']['res'],
-                             2 * self.config['model']['filters']['depths']['res'])),
-            (self.input_length, self.config['model']
-             ['filters']['depths']['res']),
-            name='res_%d_data_slice_2_d%d_s%d' % (self.num_residual_blocks, dilation, stack_i))(data_out)
-
         # Condition sub-block
         condition_out = Dense(2 * self.config['model']['filters']['depths']['res'],
                               name='res_%d_dense_condition_%d_s%d' % (
             res_block_i, layer_i, stack_i),
             use_bias=False)(condition_x)
 
-        condition_out = Reshape((self.config['model']['filters']['depths']['res'], 2),
-                                name='res_%d_condition_reshape_d%d_s%d' % (
-            res_block_i, dilation, stack_i))(condition_out)
-
-        condition_out_1 = layers.Slice((Ellipsis, 0), (self.config['model']['filters']['depths']['res'],),
-                                       name='res_%d_condition_slice_1_d%d_s%d' % (
-            res_block_i, dilation, stack_i))(condition_out)
-
-        condition_out_2 = layers.Slice((Ellipsis, 1), (self.config['model']['filters']['depths']['res'],),
-                                       name='res_%d_condition_slice_2_d%d_s%d' % (
-            res_block_i, dilation, stack_i))(condition_out)
-
-        condition_out_1 = RepeatVector(int(self.input_length), name='res_%d_condition_repeat_1_d%d_s%d' % (
-            res_block_i, dilation, stack_i))(condition_out_1)
-        condition_out_2 = RepeatVector(int(self.input_length), name='res_%d_condition_repeat_2_d%d_s%d' % (
-            res_block_i, dilation, stack_i))(condition_out_2)
-
-        data_out_1 = Add(name=f"res_{res_block_i}_merge_1_d{dilation}_s{stack_i}")(
-            [data_out_1, condition_out_1])
-        data_out_2 = Add(name=f"res_{res_block_i}_merge_2_d{dilation}_s{stack_i}")(
-            [data_out_2, condition_out_2])
-
-        tanh_out = Activation('tanh')(data_out_1)
-        sigm_out = Activation('sigmoid')(data_out_2)
-
-        data_x = Multiply(name=f"res_{res_block_i}_gated_activation_{layer_i}_s{stack_i}")(
-            [tanh_out, sigm_out])
-
-        data_x = Conv1D(
+        if self.memory_lean:
+            data_x = layers.GatedActivation(name=f"res_{res_block_i}_gated_activation_{layer_i}_s{stack_i}")(
+                [data_out, condition_out])
+        else:
+            data_out_1 = layers.Slice(
+                (Ellipsis, slice(
+                    0, self.config['model']['filters']['depths']['res'])),
+                (int(self.input_length), self.config['model']
+                 ['filters']['depths']['res']),
+                name='res_%d_data_slice_1_d%d_s%d' % (self.num_residual_blocks, dilation, stack_i))(data_out)
+
+            data_out_2 = layers.Slice(
+                (Ellipsis, slice(self.config['model']['filters']['depths']['res'],
+                                 2 * self.config['model']['filters']['depths']['res'])),
+                (self.input_length, self.config['model']
+                 ['filters']['depths']['res']),
+                name='res_%d_data_slice_2_d%d_s%d' % (self.num_residual_blocks, dilation, stack_i))(data_out)
+
+            condition_out = Reshape((self.config['model']['filters']['depths']['res'], 2),
+                                    name='res_%d_condition_reshape_d%d_s%d' % (
+                res_block_i, dilation, stack_i))(condition_out)
+
+            condition_out_1 = layers.Slice((Ellipsis, 0), (self.config['model']['filters']['depths']['res'],),
+                                           name='res_%d_condition_slice_1_d%d_s%d' % (
+                res_block_i, dilation, stack_i))(condition_out)
+
+            condition_out_2 = layers.Slice((Ellipsis, 1), (self.config['model']['filters']['depths']['res'],),
+                                           name='res_%d_condition_slice_2_d%d_s%d' % (
+                res_block_i, dilation, stack_i))(condition_out)
+
+            condition_out_1 = RepeatVector(int(self.input_length), name='res_%d_condition_repeat_1_d%d_s%d' % (
+                res_block_i, dilation, stack_i))(condition_out_1)
+            condition_out_2 = RepeatVector(int(self.input_length), name='res_%d_condition_repeat_2_d%d_s%d' % (
+                res_block_i, dilation, stack_i))(condition_out_2)
+
+            data_out_1 = Add(name=f"res_{res_block_i}_merge_1_d{dilation}_s{stack_i}")(
+                [data_out_1, condition_out_1])
+            data_out_2 = Add(name=f"res_{res_block_i}_merge_2_d{dilation}_s{stack_i}")(
+                [data_out_2, condition_out_2])
+
+            tanh_out = Activation('tanh')(data_out_1)
+            sigm_out = Activation('sigmoid')(data_out_2)
+
+            data_x = Multiply(name=f"res_{res_block_i}_gated_activation_{layer_i}_s{stack_i}")(
+                [tanh_out, sigm_out])
+
+        self.shared_inference_layers['res_%d_output_conv' % res_block_i] = Conv1D(
             self.config['model']['filters']['depths']['res'] +
             self.config['model']['filters']['depths']['skip'], 1,
-            padding='same', use_bias=False)(data_x)
+            padding='same', use_bias=False)
+        data_x = self.shared_inference_layers['res_%d_output_conv' % res_block_i](data_x)
 
         res_x = layers.Slice((Ellipsis, slice(0, self.config['model']['filters']['depths']['res'])),
                              (self.input_length,
@@ -458,3 +851,96 @@ class DenoisingWavenet():
         res_x = Add()([original_x, res_x])
 
         return res_x, skip_x
+
+
+class ModelCache():
+    # Keeps DenoisingWavenet instances for a small set of length buckets, so one-shot inference over many files
+    # builds only a handful of models. Inputs are rounded up to the next bucket; denoise_sample pads the tail
+    # fragment with zeros and crops the padded outputs away again.
+
+    def __init__(self, config, load_checkpoint=None, max_memory_mb=2048, print_model_summary=False,
+                 inference_batch_size=None, jit_compile=False, folded_condition_input=None):
+
+        self.config = copy.deepcopy(config)
+        self.load_checkpoint = load_checkpoint
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024
+        self.print_model_summary = print_model_summary
+        self.inference_batch_size = inference_batch_size
+        self.jit_compile = jit_compile
+        self.folded_condition_input = folded_condition_input
+        self.base_target_field_length = self.config['model']['target_field_length']
+        self.models = collections.OrderedDict()
+        self.weights = None
+        self.receptive_field_length = None
+        self.num_residual_blocks = None
+        self.num_builds = 0
+
+        self.load_weights()
+
+    def load_weights(self):
+
+        # The checkpoint is read from disk once, every other bucket model is initialised from these weights
+        model = self.build_model(self.base_target_field_length, load_checkpoint=self.load_checkpoint)
+        self.weights = model.model.get_weights()
+        self.receptive_field_length = model.receptive_field_length
+        self.num_residual_blocks = model.num_residual_blocks
+        self.add_model(model)
+
+    def get_bucket_target_field_length(self, num_samples, receptive_field_length):
+
+        # Bucket target field lengths double from the configured one and stay odd: 1601, 3201, 6401, ...
+        required_target_field_length = num_samples - (receptive_field_length - 1)
+        target_field_length = self.base_target_field_length
+        while target_field_length < required_target_field_length:
+            next_target_field_length = 2 * (target_field_length - 1) + 1
+            if self.estimate_model_bytes(receptive_field_length + next_target_field_length - 1) > self.max_memory_bytes:
+                break  # Longer inputs are split into several fragments by denoise_sample
+            target_field_length = next_target_field_length
+        return target_field_length
+
+    def estimate_model_bytes(self, input_length):
+
+        # Rough float32 footprint of a single-fragment forward pass: the working set of one residual block over
+        # the whole input, plus the skip connections and final layers kept over the target field
+        depths = self.config['model']['filters']['depths']
+        target_field_length = input_length - (self.receptive_field_length - 1)
+        block_values = input_length * (4 * depths['res'] + 2 * (depths['res'] + depths['skip']))
+        target_field_values = target_field_length * (self.num_residual_blocks * depths['skip'] + sum(depths['final']))
+        return 4 * (block_values + target_field_values)
+
+    def get_model(self, num_samples):
+
+        target_field_length = self.get_bucket_target_field_length(num_samples, self.receptive_field_length)
+
+        if target_field_length in self.models:
+            self.models.move_to_end(target_field_length)
+            return self.models[target_field_length]
+
+        model = self.build_model(target_field_length, weights=self.weights)
+        self.add_model(model)
+        return model
+
+    def build_model(self, target_field_length, load_checkpoint=None, weights=None):
+
+        self.num_builds += 1
+        logging.info('Building model for target field length bucket %d' % target_field_length)
+        model = DenoisingWavenet(copy.deepcopy(self.config), load_checkpoint=load_checkpoint,
+                                 target_field_length=target_field_length, weights=weights,
+                                 print_model_summary=self.print_model_summary and self.num_builds == 1,
+                                 inference_only=True)
+        if self.folded_condition_input is not None:
+            model.fold_condition(self.folded_condition_input)
+        if self.inference_batch_size is not None:
+            model.compile_inference(self.inference_batch_size, self.jit_compile)
+        return model
+
+    def add_model(self, model):
+
+        self.models[model.target_field_length] = model
+        self.models.move_to_end(model.target_field_length)
+        while len(self.models) > 1 and self.get_memory_usage() > self.max_memory_bytes:
+            target_field_length, _ = self.models.popitem(last=False)
+            logging.info('Evicting model for target field length bucket %d' % target_field_length)
+
+    def get_memory_usage(self):
+        return sum(self.estimate_model_bytes(model.input_length) for model in self.models.values())
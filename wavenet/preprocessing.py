@@ -0,0 +1,123 @@
+# Preprocessing.py
+# One-time conversion of an NSDTSEA dataset into a single float32 shard per set and condition, with an index of
+# file offsets, lengths, speakers, voice indices and regain factors. Shards are opened memory-mapped, so loading the
+# dataset decodes no WAV files and every process reading the same shards shares their pages
+
+import os
+import json
+import shutil
+import numpy as np
+
+INDEX_FILENAME = 'index.json'
+SETS = ['train', 'test']
+CONDITIONS = ['clean', 'noisy']
+
+
+def get_preprocessed_path(config):
+
+    if config['dataset'].get('preprocessed_path') is not None:
+        return config['dataset']['preprocessed_path']
+    return os.path.join(config['dataset']['path'], 'preprocessed')
+
+
+def get_index_key(config):
+
+    # The dataset and settings the stored sequences and metadata depend on
+    return {'path': os.path.abspath(config['dataset']['path']),
+            'sample_rate': config['dataset']['sample_rate'],
+            'regain': config['dataset']['regain'],
+            'extract_voice': config['dataset']['extract_voice']}
+
+
+def get_shard_path(preprocessed_path, set, condition):
+    return os.path.join(preprocessed_path, '%s_%s.f32' % (set, condition))
+
+
+def preprocess_dataset(dataset, preprocessed_path):
+
+    # Files keep the order NSDTSEADataset.load_directory would see them in, so speaker_mapping is the same as when
+    # loading the WAV files. Sequences are appended to the shard one at a time and never held all at once
+    temporary_path = preprocessed_path.rstrip(os.sep) + '.tmp%d' % os.getpid()
+    os.makedirs(temporary_path)
+
+    index = {'key': dataset.preprocessing_key, 'sets': {}}
+    with dataset.get_loading_pool() as loading_pool:
+        for set in SETS:
+            index['sets'][set] = {}
+            for condition in CONDITIONS:
+                directory_path = dataset.get_directory_path(set, condition)
+                filenames = dataset.get_wav_filenames(directory_path)
+                entry = {'filenames': filenames, 'offsets': [], 'lengths': []}
+                if condition == 'clean':
+                    entry['voice_indices'] = []
+                    entry['regain_factors'] = []
+
+                offset = 0
+                loaded_files = dataset.load_files([os.path.join(directory_path, filename) for filename in filenames],
+                                                  condition, loading_pool)
+                with open(get_shard_path(temporary_path, set, condition), 'wb') as shard_file:
+                    for filename, loaded_file in zip(filenames, loaded_files):
+                        sequence, regain_factor, speech_onset_offset_indices = loaded_file
+                        shard_file.write(np.asarray(sequence, dtype='float32').tobytes())
+                        entry['offsets'].append(offset)
+                        entry['lengths'].append(len(sequence))
+                        offset += len(sequence)
+
+                        if condition == 'clean':
+                            entry['regain_factors'].append(float(regain_factor))
+                            if speech_onset_offset_indices is not None:
+                                entry['voice_indices'].append([int(i) for i in speech_onset_offset_indices])
+                        dataset.add_speaker(filename[0:4])
+
+                index['sets'][set][condition] = entry
+                print('Preprocessed %d %s %s files, %d samples' % (len(filenames), set, condition, offset))
+
+            index['sets'][set]['speakers'] = [filename[0:4] for filename in index['sets'][set]['noisy']['filenames']]
+
+    index['speaker_mapping'] = sorted(dataset.speaker_mapping.items(), key=lambda item: item[1])
+    with open(os.path.join(temporary_path, INDEX_FILENAME), 'w') as index_file:
+        json.dump(index, index_file)
+
+    # The shards and index appear together or not at all
+    if os.path.isdir(preprocessed_path):
+        shutil.rmtree(preprocessed_path)
+    os.rename(temporary_path, preprocessed_path)
+    return index
+
+
+def matches_wav_files(index, dataset):
+
+    # Catches WAV files added or removed since preprocessing. Directories that are gone are not checked, so the
+    # shards can be used without the WAV files
+    for set in SETS:
+        for condition in CONDITIONS:
+            directory_path = dataset.get_directory_path(set, condition)
+            if os.path.isdir(directory_path) and sorted(dataset.get_wav_filenames(directory_path)) != sorted(
+                    index['sets'][set][condition]['filenames']):
+                return False
+    return True
+
+
+def load_index(preprocessed_path, dataset):
+
+    # None when the dataset has not been preprocessed, or was preprocessed with other settings or other files
+    index_path = os.path.join(preprocessed_path, INDEX_FILENAME)
+    if not os.path.isfile(index_path):
+        return None
+
+    with open(index_path, 'r') as index_file:
+        index = json.load(index_file)
+    if index['key'] != dataset.preprocessing_key or not matches_wav_files(index, dataset):
+        print('Preprocessed dataset at %s was made with other dataset settings or files, loading the WAV files' %
+              preprocessed_path)
+        return None
+    return index
+
+
+def open_shard(preprocessed_path, set, condition, index):
+
+    num_samples = sum(index['sets'][set][condition]['lengths'])
+    if num_samples == 0:
+        return np.zeros((0,), dtype='float32')
+    return np.memmap(get_shard_path(preprocessed_path, set, condition), dtype='float32', mode='r',
+                     shape=(num_samples,))
@@ -0,0 +1,359 @@
+# Profiler.py
+# Per-layer FLOPs, parameter counts and activation memory of a Denoising Wavenet config, computed from the config
+# alone so settings can be compared before a model is built. Mirrors build_model and
+# build_progressively_cropped_model layer by layer. Optionally measures the real model in fresh processes to check
+# the figures against peak RSS and step time
+
+import os
+import json
+import tempfile
+import numpy as np
+import util
+
+FLOAT32_BYTES = 4
+
+# Adam keeps two moments per weight, next to the weight and its gradient
+ADAM_STATE_COPIES = 4
+
+BASELINE_MEASUREMENT_CODE = """
+import json
+import models
+print(json.dumps({
+    'peak_rss_mb': [int(line.split()[1]) / 1024.0 for line in open('/proc/self/status') if line.startswith('VmHWM')][0]
+}))
+"""
+
+MODEL_MEASUREMENT_CODE = """
+import json
+import models
+import benchmark
+config = json.load(open(%r, 'r'))
+model = models.DenoisingWavenet(config)
+print(json.dumps({'num_params': model.model.count_params(), 'flops': float(benchmark.get_model_flops(model.model))}))
+"""
+
+
+class ModelGeometry():
+    # The lengths and depths DenoisingWavenet derives from a config, without building anything
+
+    def __init__(self, config, target_field_length=None):
+
+        model_config = config['model']
+        if type(model_config['dilations']) is int:
+            self.dilations = [2 ** i for i in range(0, model_config['dilations'] + 1)]
+        else:
+            self.dilations = model_config['dilations']
+        self.num_stacks = model_config['num_stacks']
+        self.res_length = model_config['filters']['lengths']['res']
+        self.final_lengths = model_config['filters']['lengths']['final']
+        self.res_depth = model_config['filters']['depths']['res']
+        self.skip_depth = model_config['filters']['depths']['skip']
+        self.final_depths = model_config['filters']['depths']['final']
+
+        num_condition_classes = config['dataset']['num_condition_classes']
+        if model_config['condition_encoding'] == 'binary':
+            self.condition_input_length = int(np.max((np.ceil(np.log2(num_condition_classes)), 1)))
+        else:
+            self.condition_input_length = num_condition_classes
+
+        self.receptive_field_length = int(util.compute_receptive_field_length(
+            self.num_stacks, self.dilations, self.res_length, 1))
+        self.target_field_length = int(target_field_length or model_config['target_field_length'])
+        self.input_length = self.receptive_field_length + self.target_field_length - 1
+        self.padded_target_field_length = self.target_field_length + 2 * model_config['target_padding']
+
+        # As DenoisingWavenet.get_padded_target_field_indices
+        target_sample_index = self.input_length // 2
+        target_padding = self.target_field_length // 2 + model_config['target_padding']
+        self.target_region = (target_sample_index - target_padding, target_sample_index + target_padding + 1)
+
+    def get_conv_input_region(self, output_region, kernel_size, dilation):
+
+        left = dilation * (kernel_size - 1) // 2
+        right = dilation * (kernel_size - 1) - left
+        return max(output_region[0] - left, 0), min(output_region[1] + right, self.input_length)
+
+    def get_progressive_crop_regions(self):
+
+        # As DenoisingWavenet.get_progressive_crop_regions
+        block_regions = []
+        region = self.target_region
+        for dilation in reversed(self.dilations * self.num_stacks):
+            block_regions.insert(0, region)
+            region = self.get_conv_input_region(region, self.res_length, dilation)
+        return region, block_regions
+
+
+def get_layer_profiles(config, batch_size, target_field_length=None):
+
+    # One row per layer output of the graph build_model would create: output shape without the batch axis,
+    # parameters, FLOPs per batch and output bytes per batch. FLOPs are the multiply-adds of convolutions and
+    # dense layers, two each, as in benchmark.get_model_flops; elementwise layers only count towards memory.
+    # lifetime says how long an output stays allocated during inference: until the end of its residual block
+    # ('block'), through the next block ('residual'), until the skip connections are summed ('skip') or until
+    # the outputs ('model')
+    geometry = ModelGeometry(config, target_field_length)
+    memory_lean = config['model'].get('memory_lean', False)
+    cropped = config['model'].get('progressive_cropping', False)
+    mixed_precision = config['model'].get('mixed_precision') not in [None, 'float32']
+    res_depth = geometry.res_depth
+    skip_depth = geometry.skip_depth
+    condition_length = geometry.condition_input_length
+    input_length = geometry.input_length
+    target_length = geometry.padded_target_field_length
+    if cropped:
+        # The cropped graph keeps the samples of interest, one more than padded_target_field_length if it is even
+        target_length = geometry.target_region[1] - geometry.target_region[0]
+
+    rows = []
+
+    def add(name, layer, shape, params=0, flops=0, lifetime='block', float32=False, group='head'):
+        dtype_bytes = FLOAT32_BYTES if float32 or not mixed_precision else 2
+        rows.append({'name': name, 'layer': layer, 'shape': tuple(int(size) for size in shape),
+                     'params': int(params), 'flops': int(flops) * batch_size, 'lifetime': lifetime, 'group': group,
+                     'activation_bytes': int(np.prod(shape)) * batch_size * dtype_bytes})
+
+    def add_conv(name, length, in_depth, out_depth, kernel_size, lifetime='block', float32=False, group='head',
+                 use_bias=False):
+        add(name, 'Conv1D', (length, out_depth), kernel_size * in_depth * out_depth + (out_depth if use_bias else 0),
+            2 * length * kernel_size * in_depth * out_depth, lifetime, float32, group)
+
+    def add_condition(name, merge_name, repeat_name, length, depth):
+        # Dense projection of the condition added over time: broadcast, or repeated then added
+        add(name, 'Dense', (depth,), condition_length * depth, 2 * condition_length * depth)
+        if memory_lean or cropped:
+            add(merge_name, 'BroadcastAdd', (length, depth))
+        else:
+            add(repeat_name, 'RepeatVector', (length, depth))
+            add(merge_name, 'Add', (length, depth))
+
+    def add_cropped_conv_input(name, region, conv_region, output_region, kernel_size, dilation, depth, group):
+        # Cropping and zero padding build_progressively_cropped_model puts in front of a valid convolution
+        if conv_region != region:
+            add(name + '_crop', 'Cropping1D', (conv_region[1] - conv_region[0], depth), group=group)
+        padded_length = output_region[1] - output_region[0] + dilation * (kernel_size - 1)
+        if padded_length != conv_region[1] - conv_region[0]:
+            add(name + '_padding', 'ZeroPadding1D', (padded_length, depth), group=group)
+
+    add('data_input', 'Input', (input_length,), lifetime='model', float32=True)
+    add('condition_input', 'Input', (condition_length,), lifetime='model', float32=True)
+    add('add_singleton_depth', 'AddSingletonDepth', (input_length, 1), float32=True)
+    add('data_input_target_field_length', 'Slice', (target_length, 1), lifetime='model', float32=True)
+
+    if cropped:
+        region, block_regions = geometry.get_progressive_crop_regions()
+        conv_region = geometry.get_conv_input_region(region, geometry.res_length, 1)
+        add_cropped_conv_input('initial_causal_conv', (0, input_length), conv_region, region, geometry.res_length, 1,
+                               1, 'head')
+    else:
+        region = (0, input_length)
+        block_regions = [region] * (len(geometry.dilations) * geometry.num_stacks)
+    add_conv('initial_causal_conv', region[1] - region[0], 1, res_depth, geometry.res_length)
+    add_condition('initial_dense_condition', 'initial_data_condition_merge', 'initial_condition_repeat',
+                  region[1] - region[0], res_depth)
+    rows[-1]['lifetime'] = 'residual'
+
+    res_block_i = 0
+    for stack_i in range(geometry.num_stacks):
+        for dilation in geometry.dilations:
+            block_region = block_regions[res_block_i]
+            res_block_i += 1
+            group = 'res_%d' % res_block_i
+            name = 'res_%d_%%s_d%d_s%d' % (res_block_i, dilation, stack_i)
+            block_length = block_region[1] - block_region[0]
+            length = input_length if not cropped else block_length
+
+            if cropped:
+                conv_region = geometry.get_conv_input_region(block_region, geometry.res_length, dilation)
+                add_cropped_conv_input(name % 'dilated_conv', region, conv_region, block_region, geometry.res_length,
+                                       dilation, res_depth, group)
+            add_conv(name % 'dilated_conv', length, res_depth, 2 * res_depth, geometry.res_length, group=group)
+            add(name % 'dense_condition', 'Dense', (2 * res_depth,), condition_length * 2 * res_depth,
+                2 * condition_length * 2 * res_depth, group=group)
+
+            if memory_lean or cropped:
+                add(name % 'gated_activation', 'GatedActivation', (length, res_depth), group=group)
+            else:
+                for layer_name, layer, shape in [
+                        ('data_slice_1', 'Slice', (length, res_depth)), ('data_slice_2', 'Slice', (length, res_depth)),
+                        ('condition_reshape', 'Reshape', (res_depth, 2)),
+                        ('condition_slice_1', 'Slice', (res_depth,)), ('condition_slice_2', 'Slice', (res_depth,)),
+                        ('condition_repeat_1', 'RepeatVector', (length, res_depth)),
+                        ('condition_repeat_2', 'RepeatVector', (length, res_depth)),
+                        ('merge_1', 'Add', (length, res_depth)), ('merge_2', 'Add', (length, res_depth)),
+                        ('tanh', 'Activation', (length, res_depth)), ('sigmoid', 'Activation', (length, res_depth)),
+                        ('gated_activation', 'Multiply', (length, res_depth))]:
+                    add(name % layer_name, layer, shape, group=group)
+
+            add_conv(name % 'output_conv', length, res_depth, res_depth + skip_depth, 1, group=group)
+            add(name % 'skip_slice', 'Slice', (length, skip_depth), group=group)
+            if not cropped:
+                add(name % 'keep_samples_of_interest', 'Slice', (target_length, skip_depth), group=group)
+            elif block_region != geometry.target_region:
+                add(name % 'keep_samples_of_interest', 'Cropping1D', (target_length, skip_depth), group=group)
+            rows[-1]['lifetime'] = 'skip'
+            # The residual output of the last block is never read, Keras leaves it out of the model
+            if res_block_i < len(block_regions):
+                add(name % 'res_slice', 'Slice', (length, res_depth), group=group)
+                if cropped and block_region != region:
+                    add(name % 'residual_crop', 'Cropping1D', (length, res_depth), group=group)
+                add(name % 'residual_add', 'Add', (length, res_depth), lifetime='residual', group=group)
+            region = block_region
+
+    add('skip_connections_add', 'Add', (target_length, skip_depth))
+    add('skip_connections_relu', 'Activation', (target_length, skip_depth))
+    add_conv('penultimate_conv', target_length, skip_depth, geometry.final_depths[0], geometry.final_lengths[0])
+    add_condition('penultimate_conv_1d_condition', 'penultimate_conv_1d_condition_merge',
+                  'penultimate_conv_1d_condition_repeat', target_length, geometry.final_depths[0])
+    add('penultimate_relu', 'Activation', (target_length, geometry.final_depths[0]))
+    add_conv('final_conv', target_length, geometry.final_depths[0], geometry.final_depths[1],
+             geometry.final_lengths[1])
+    add_condition('final_conv_1d_condition', 'final_conv_1d_condition_merge', 'final_conv_1d_condition_repeat',
+                  target_length, geometry.final_depths[1])
+    add_conv('output_conv', target_length, geometry.final_depths[1], 1, 1, float32=True, use_bias=True)
+    add('subtract_layer', 'Subtract', (target_length, 1), float32=True)
+    add('data_output_1', 'Lambda', (target_length,), lifetime='model', float32=True)
+    add('data_output_2', 'Lambda', (target_length,), lifetime='model', float32=True)
+
+    return rows
+
+
+def get_peak_inference_activation_bytes(rows):
+
+    # Largest live set while the graph runs group by group: the group's own outputs, every earlier output that
+    # outlives its group, and the residual stream of the group just before
+    peak_bytes = 0
+    kept_bytes = 0
+    previous_residual_bytes = 0
+    groups = []
+    for row in rows:
+        if len(groups) == 0 or groups[-1][0] != row['group']:
+            groups.append((row['group'], []))
+        groups[-1][1].append(row)
+
+    for _, group_rows in groups:
+        group_bytes = sum(row['activation_bytes'] for row in group_rows)
+        peak_bytes = max(peak_bytes, kept_bytes + previous_residual_bytes + group_bytes)
+        kept_bytes += sum(row['activation_bytes'] for row in group_rows if row['lifetime'] in ['skip', 'model'])
+        previous_residual_bytes = sum(row['activation_bytes'] for row in group_rows if row['lifetime'] == 'residual')
+    return peak_bytes
+
+
+def get_profile(config, training_batch_size, inference_batch_size, target_field_length=None):
+
+    geometry = ModelGeometry(config, target_field_length)
+    inference_rows = get_layer_profiles(config, inference_batch_size, target_field_length)
+    training_rows = get_layer_profiles(config, training_batch_size, target_field_length)
+    num_params = sum(row['params'] for row in inference_rows)
+    param_bytes = num_params * FLOAT32_BYTES
+
+    batch_size = config['training']['batch_size']
+    gradient_accumulation_steps = config['training'].get('effective_batch_size', batch_size) // batch_size
+    optimizer_copies = ADAM_STATE_COPIES + (1 if gradient_accumulation_steps > 1 else 0)
+
+    inference_flops = sum(row['flops'] for row in inference_rows)
+    training_activation_bytes = sum(row['activation_bytes'] for row in training_rows)
+    return {
+        'num_params': num_params,
+        'receptive_field_length': geometry.receptive_field_length,
+        'input_length': geometry.input_length,
+        'target_field_length': geometry.target_field_length,
+        'inference_batch_size': inference_batch_size,
+        'inference_flops': inference_flops,
+        'inference_flops_per_output_sample': inference_flops / float(
+            inference_batch_size * geometry.target_field_length),
+        'inference_activation_bytes': sum(row['activation_bytes'] for row in inference_rows),
+        'inference_peak_activation_bytes': get_peak_inference_activation_bytes(inference_rows),
+        'inference_bytes': param_bytes + get_peak_inference_activation_bytes(inference_rows),
+        'training_batch_size': training_batch_size,
+        # Backpropagation costs about twice the forward pass
+        'training_flops': 3 * sum(row['flops'] for row in training_rows),
+        # Every forward output kept for the backward pass, which allocates gradients of the same sizes. An upper
+        # bound: TensorFlow frees and reuses many of these buffers
+        'training_activation_bytes': 2 * training_activation_bytes,
+        'training_bytes': optimizer_copies * param_bytes + 2 * training_activation_bytes
+    }
+
+
+def print_layer_table(rows):
+
+    print('%-48s %-18s %-14s %12s %14s %12s' % ('layer', 'type', 'output shape', 'params', 'MFLOPs', 'output MB'))
+    for row in rows:
+        print('%-48s %-18s %-14s %12d %14.2f %12.2f' % (
+            row['name'], row['layer'], 'x'.join(str(size) for size in row['shape']), row['params'],
+            row['flops'] / 1e6, row['activation_bytes'] / 2.0 ** 20))
+    print('%-48s %-18s %-14s %12d %14.2f %12.2f' % (
+        'total', '', '', sum(row['params'] for row in rows), sum(row['flops'] for row in rows) / 1e6,
+        sum(row['activation_bytes'] for row in rows) / 2.0 ** 20))
+
+
+def print_comparison_table(profiles):
+
+    print('%-24s %10s %9s %9s %13s %12s %13s %13s %12s' % (
+        'config', 'params', 'rec field', 'input', 'infer GFLOP', 'infer MB', 'FLOP/sample', 'train GFLOP',
+        'train MB'))
+    for name, profile in profiles:
+        print('%-24s %10d %9d %9d %13.2f %12.1f %13.0f %13.2f %12.1f' % (
+            name[-24:], profile['num_params'], profile['receptive_field_length'], profile['input_length'],
+            profile['inference_flops'] / 1e9, profile['inference_bytes'] / 2.0 ** 20,
+            profile['inference_flops_per_output_sample'], profile['training_flops'] / 1e9,
+            profile['training_bytes'] / 2.0 ** 20))
+
+
+def measure_profile(config, profile, num_batches):
+
+    # Builds the model in fresh processes: once to check the analytic parameter and FLOP counts, then an
+    # inference and a training run for step times and peak RSS. The RSS of a process that only imports the
+    # model code is subtracted, which leaves what the model itself allocated
+    import benchmark
+
+    with tempfile.TemporaryDirectory() as session_path:
+        measurement = {}
+        for name, batch_size in [('inference', profile['inference_batch_size']),
+                                 ('training', profile['training_batch_size'])]:
+            measured_config = json.loads(json.dumps(config))
+            measured_config['training']['path'] = os.path.join(session_path, name)
+            measured_config['training']['batch_size'] = batch_size
+            measured_config['training'].pop('effective_batch_size', None)
+            if name == 'training':
+                measured_config['training']['effective_batch_size'] = config['training'].get(
+                    'effective_batch_size', config['training']['batch_size']) * batch_size // config[
+                    'training']['batch_size']
+            config_path = os.path.join(session_path, name + '.json')
+            with open(config_path, 'w') as config_file:
+                json.dump(measured_config, config_file)
+
+            if name == 'inference':
+                measurement.update(benchmark.run_measurement_process(MODEL_MEASUREMENT_CODE % config_path))
+                result = benchmark.run_measurement_process(benchmark.SERVING_MEASUREMENT_CODE % (
+                    benchmark.KERAS_SERVING_SETUP_CODE % (config_path, None, profile['target_field_length']),
+                    num_batches, num_batches))
+                measurement['inference_step_ms'] = 1000.0 * batch_size * profile['target_field_length'] / \
+                    result['samples_per_s']
+            else:
+                result = benchmark.run_measurement_process(benchmark.TRAINING_MEASUREMENT_CODE % (
+                    config_path, None, num_batches, num_batches))
+                measurement['training_step_ms'] = result['step_ms']
+            measurement[name + '_peak_rss_mb'] = result['peak_rss_mb']
+
+    measurement['baseline_rss_mb'] = benchmark.run_measurement_process(BASELINE_MEASUREMENT_CODE)['peak_rss_mb']
+    return measurement
+
+
+def print_measurement_table(profiles, measurements):
+
+    # Analytic figures next to measured ones. Model RSS is peak RSS above the baseline process
+    print('%-24s %10s %12s %12s %14s %14s %13s %13s %11s %11s' % (
+        'config', 'params ok', 'FLOPs ok', 'infer ms', 'infer GFLOP/s', 'train GFLOP/s', 'infer MB', 'train MB',
+        'infer RSS', 'train RSS'))
+    for (name, profile), measurement in zip(profiles, measurements):
+        print('%-24s %10s %12s %12.2f %14.2f %14.2f %13.1f %13.1f %11.1f %11.1f' % (
+            name[-24:], 'yes' if measurement['num_params'] == profile['num_params'] else 'no (%d)' % (
+                measurement['num_params']),
+            'yes' if measurement['flops'] * profile['inference_batch_size'] == profile['inference_flops'] else 'no',
+            measurement['inference_step_ms'],
+            profile['inference_flops'] / measurement['inference_step_ms'] / 1e6,
+            profile['training_flops'] / measurement['training_step_ms'] / 1e6,
+            profile['inference_bytes'] / 2.0 ** 20, profile['training_bytes'] / 2.0 ** 20,
+            measurement['inference_peak_rss_mb'] - measurement['baseline_rss_mb'],
+            measurement['training_peak_rss_mb'] - measurement['baseline_rss_mb']))
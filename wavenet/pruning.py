@@ -0,0 +1,172 @@
+# Pruning.py
+# Structured channel pruning of a trained Denoising Wavenet. Residual, gate and skip channels are scored by their
+# mean activation magnitude on calibration batches times the norm of the weights that read them, and the lowest
+# scoring ones are removed from every layer that produces or consumes them
+
+import copy
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.models import Model
+
+
+def get_prunable_layers(model):
+
+    # The layers whose kernels change, by a name that is the same in every graph variant
+    keras_model = model.model
+    layer_names = [layer.name for layer in keras_model.layers]
+
+    def get_layer(prefix):
+        return keras_model.get_layer([name for name in layer_names if name.startswith(prefix)][0])
+
+    prunable_layers = {
+        'initial_causal_conv': keras_model.get_layer('initial_causal_conv'),
+        'initial_dense_condition': keras_model.get_layer('initial_dense_condition'),
+        'penultimate_conv': model.shared_inference_layers['penultimate_conv']
+    }
+    for res_block_i in range(1, model.num_residual_blocks + 1):
+        prunable_layers['res_%d_dilated_conv' % res_block_i] = get_layer('res_%d_dilated_conv_' % res_block_i)
+        prunable_layers['res_%d_dense_condition' % res_block_i] = get_layer('res_%d_dense_condition_' % res_block_i)
+        prunable_layers['res_%d_output_conv' % res_block_i] = \
+            model.shared_inference_layers['res_%d_output_conv' % res_block_i]
+    return prunable_layers
+
+
+def get_activation_magnitudes(model, batch_generator, num_batches):
+
+    # Mean absolute value per channel of every residual block input, every gated activation and the summed skip
+    # connections, reduced inside the graph so the full activations of all blocks are never held at once
+    prunable_layers = get_prunable_layers(model)
+    probe_tensors = [prunable_layers['res_%d_dilated_conv' % res_block_i].input
+                     for res_block_i in range(1, model.num_residual_blocks + 1)]
+    probe_tensors += [prunable_layers['res_%d_output_conv' % res_block_i].input
+                      for res_block_i in range(1, model.num_residual_blocks + 1)]
+    probe_tensors.append(prunable_layers['penultimate_conv'].input)
+    probe_model = Model(inputs=model.model.inputs, outputs=probe_tensors)
+
+    @tf.function
+    def get_batch_magnitudes(data_input, condition_input):
+        return [tf.reduce_mean(tf.abs(tf.cast(tensor, tf.float32)), axis=[0, 1])
+                for tensor in probe_model([data_input, condition_input], training=False)]
+
+    magnitudes = None
+    for _ in range(num_batches):
+        inputs, _ = next(batch_generator)
+        batch_magnitudes = [magnitude.numpy() for magnitude in get_batch_magnitudes(
+            tf.constant(inputs['data_input'], tf.float32), tf.constant(inputs['condition_input'], tf.float32))]
+        if magnitudes is None:
+            magnitudes = batch_magnitudes
+        else:
+            magnitudes = [magnitude + batch_magnitude for magnitude, batch_magnitude in
+                          zip(magnitudes, batch_magnitudes)]
+
+    num_blocks = model.num_residual_blocks
+    return {'residual': [magnitude / num_batches for magnitude in magnitudes[:num_blocks]],
+            'gate': [magnitude / num_batches for magnitude in magnitudes[num_blocks:2 * num_blocks]],
+            'skip': magnitudes[-1] / num_batches}
+
+
+def get_input_channel_norms(kernel):
+
+    # L2 norm of the weights reading each input channel of a (length, in, out) Conv1D kernel
+    return np.sqrt(np.sum(np.square(kernel), axis=(0, 2)))
+
+
+def get_channel_scores(model, batch_generator, num_batches):
+
+    magnitudes = get_activation_magnitudes(model, batch_generator, num_batches)
+    prunable_layers = get_prunable_layers(model)
+
+    # A residual channel is read by the dilated convolution of every block
+    residual_scores = 0
+    gate_scores = []
+    for res_block_i in range(1, model.num_residual_blocks + 1):
+        residual_scores = residual_scores + magnitudes['residual'][res_block_i - 1] * get_input_channel_norms(
+            prunable_layers['res_%d_dilated_conv' % res_block_i].get_weights()[0])
+        gate_scores.append(magnitudes['gate'][res_block_i - 1] * get_input_channel_norms(
+            prunable_layers['res_%d_output_conv' % res_block_i].get_weights()[0]))
+
+    skip_scores = magnitudes['skip'] * get_input_channel_norms(
+        prunable_layers['penultimate_conv'].get_weights()[0])
+
+    return {'residual': residual_scores, 'gate': gate_scores, 'skip': skip_scores}
+
+
+def get_kept_channels(scores, num_kept):
+
+    # Indices of the num_kept highest scores, in their original order
+    return np.sort(np.argsort(scores)[::-1][:num_kept])
+
+
+def select_channels(model, batch_generator, num_batches, pruning_fraction):
+
+    # Residual and skip channels are shared by all blocks, so one set is kept for the whole model. Gate channels
+    # are internal to a block, each block keeps its own highest scoring ones
+    scores = get_channel_scores(model, batch_generator, num_batches)
+    num_res = max(1, int(round(len(scores['residual']) * (1 - pruning_fraction))))
+    num_skip = max(1, int(round(len(scores['skip']) * (1 - pruning_fraction))))
+    return {'residual': get_kept_channels(scores['residual'], num_res),
+            'gate': [get_kept_channels(block_scores, num_res) for block_scores in scores['gate']],
+            'skip': get_kept_channels(scores['skip'], num_skip)}
+
+
+def get_pruned_config(config, channels, pruned_path):
+
+    pruned_config = copy.deepcopy(config)
+    pruned_config['model']['filters']['depths']['res'] = len(channels['residual'])
+    pruned_config['model']['filters']['depths']['skip'] = len(channels['skip'])
+    pruned_config['training']['path'] = pruned_path
+    return pruned_config
+
+
+def get_pruned_weights(model, channels):
+
+    # Kernels are (length, in, out) for Conv1D and (in, out) for Dense. The dilated convolution outputs the tanh
+    # half then the sigmoid half, the condition Dense interleaves them, the output convolution writes residual
+    # then skip channels
+    prunable_layers = get_prunable_layers(model)
+    res_depth = model.config['model']['filters']['depths']['res']
+    residual = channels['residual']
+
+    pruned_weights = {
+        'initial_causal_conv': [prunable_layers['initial_causal_conv'].get_weights()[0][:, :, residual]],
+        'initial_dense_condition': [prunable_layers['initial_dense_condition'].get_weights()[0][:, residual]],
+        'penultimate_conv': [prunable_layers['penultimate_conv'].get_weights()[0][:, channels['skip'], :]]
+    }
+    for res_block_i in range(1, model.num_residual_blocks + 1):
+        gate = channels['gate'][res_block_i - 1]
+
+        dilated_kernel = prunable_layers['res_%d_dilated_conv' % res_block_i].get_weights()[0]
+        pruned_weights['res_%d_dilated_conv' % res_block_i] = [
+            dilated_kernel[:, residual, :][:, :, np.concatenate([gate, res_depth + gate])]]
+
+        condition_kernel = prunable_layers['res_%d_dense_condition' % res_block_i].get_weights()[0]
+        pruned_weights['res_%d_dense_condition' % res_block_i] = [
+            condition_kernel[:, np.stack([2 * gate, 2 * gate + 1], axis=1).flatten()]]
+
+        output_kernel = prunable_layers['res_%d_output_conv' % res_block_i].get_weights()[0]
+        pruned_weights['res_%d_output_conv' % res_block_i] = [
+            output_kernel[:, gate, :][:, :, np.concatenate([residual, res_depth + channels['skip']])]]
+
+    return pruned_weights
+
+
+def get_unpruned_layers(model):
+
+    return {
+        'penultimate_conv_1d_condition': model.model.get_layer('penultimate_conv_1d_condition'),
+        'final_conv': model.shared_inference_layers['final_conv'],
+        'final_conv_1d_condition': model.model.get_layer('final_conv_1d_condition'),
+        'output_conv': model.shared_inference_layers['output_conv']
+    }
+
+
+def transfer_weights(model, pruned_model, channels):
+
+    # Pruned layers take their sliced kernels, the layers after the skip connections are copied unchanged
+    pruned_weights = get_pruned_weights(model, channels)
+    for name, layer in get_prunable_layers(pruned_model).items():
+        layer.set_weights(pruned_weights[name])
+
+    unpruned_layers = get_unpruned_layers(model)
+    for name, layer in get_unpruned_layers(pruned_model).items():
+        layer.set_weights(unpruned_layers[name].get_weights())
@@ -0,0 +1,244 @@
+# Server.py
+# Local HTTP denoising service. The model is loaded once; fragments of concurrent requests are merged into shared
+# batches, with a deadline on how long the first fragment of a batch may wait for others.
+
+import io
+import json
+import time
+import queue
+import threading
+import collections
+import urllib.parse
+import urllib.request
+import numpy as np
+import soundfile as sf
+import util
+import fragments
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ServerBusyError(Exception):
+    pass
+
+
+class DenoisingRequest():
+
+    def __init__(self, input_fragments, condition_input):
+
+        self.input_fragments = input_fragments
+        self.condition_input = condition_input
+        self.output_fragments = [[None] * len(input_fragments), [None] * len(input_fragments)]
+        self.num_remaining_fragments = len(input_fragments)
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher():
+
+    def __init__(self, model, batch_size, max_wait_ms=10, max_pending_fragments=1024, num_latencies_kept=1000):
+
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_pending_fragments = max_pending_fragments
+        self.fragment_queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.num_pending_fragments = 0
+
+        self.num_requests = 0
+        self.num_rejected_requests = 0
+        self.num_batches = 0
+        self.num_batched_fragments = 0
+        self.latencies = collections.deque(maxlen=num_latencies_kept)
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, input_fragments, condition_input):
+
+        # Backpressure: refuse a request outright rather than letting the fragment queue grow without bound.
+        # A request longer than the limit is still admitted when nothing else is pending.
+        with self.lock:
+            if self.num_pending_fragments > 0 and \
+                    self.num_pending_fragments + len(input_fragments) > self.max_pending_fragments:
+                self.num_rejected_requests += 1
+                raise ServerBusyError('%d fragments already pending' % self.num_pending_fragments)
+            self.num_pending_fragments += len(input_fragments)
+
+        request = DenoisingRequest(input_fragments, condition_input)
+        for fragment_i in range(len(input_fragments)):
+            self.fragment_queue.put((request, fragment_i))
+        return request
+
+    def run(self):
+
+        while True:
+            batch = [self.fragment_queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.fragment_queue.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            self.denoise_batch(batch)
+
+    def denoise_batch(self, batch):
+
+        inputs = {'data_input': np.array([request.input_fragments[fragment_i] for request, fragment_i in batch]),
+                  'condition_input': np.array([request.condition_input for request, _ in batch])}
+        try:
+            outputs = self.model.denoise_batch(inputs)
+        except Exception as error:
+            outputs = None
+            for request, _ in batch:
+                request.error = error
+
+        with self.lock:
+            self.num_pending_fragments -= len(batch)
+            self.num_batches += 1
+            self.num_batched_fragments += len(batch)
+
+        for batch_i, (request, fragment_i) in enumerate(batch):
+            if outputs is not None:
+                request.output_fragments[0][fragment_i] = outputs[0][batch_i]
+                request.output_fragments[1][fragment_i] = outputs[1][batch_i]
+            request.num_remaining_fragments -= 1
+            if request.num_remaining_fragments == 0:
+                request.done.set()
+
+    def record_latency(self, latency):
+        with self.lock:
+            self.num_requests += 1
+            self.latencies.append(latency)
+
+    def get_metrics(self):
+
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            return {
+                'num_requests': self.num_requests,
+                'num_rejected_requests': self.num_rejected_requests,
+                'num_pending_fragments': self.num_pending_fragments,
+                'num_batches': self.num_batches,
+                'mean_batch_fill': self.num_batched_fragments / float(max(self.num_batches, 1) * self.batch_size),
+                'latency_ms': {
+                    'p50': float(np.percentile(latencies, 50)) if len(latencies) > 0 else None,
+                    'p95': float(np.percentile(latencies, 95)) if len(latencies) > 0 else None,
+                    'p99': float(np.percentile(latencies, 99)) if len(latencies) > 0 else None
+                }
+            }
+
+
+class DenoisingRequestHandler(BaseHTTPRequestHandler):
+
+    # Set on the handler class by serve()
+    batcher = None
+    model = None
+    sample_rate = None
+    condition_encode_function = None
+
+    def do_GET(self):
+
+        if urllib.parse.urlparse(self.path).path != '/metrics':
+            self.send_error(404)
+            return
+        self.send_body(200, 'application/json', json.dumps(self.batcher.get_metrics()).encode())
+
+    def do_POST(self):
+
+        start_time = time.time()
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/denoise':
+            self.send_error(404)
+            return
+        parameters = urllib.parse.parse_qs(url.query)
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            noisy = self.read_audio(body, parameters)
+            condition_input = self.condition_encode_function(
+                int(parameters.get('condition_value', [0])[0]), self.model.num_condition_classes)[0]
+            input_fragments = fragments.split_into_fragments(self.model, noisy)
+        except (ValueError, RuntimeError) as error:
+            self.send_error(400, str(error))
+            return
+
+        try:
+            request = self.batcher.submit(input_fragments, condition_input)
+        except ServerBusyError as error:
+            self.send_response(503, str(error))
+            self.send_header('Retry-After', '1')
+            self.end_headers()
+            return
+
+        request.done.wait()
+        if request.error is not None:
+            self.send_error(500, str(request.error))
+            return
+
+        num_output_samples = fragments.get_num_output_samples(self.model, len(noisy))
+        denoised_output = fragments.join_fragments(self.model, np.array(request.output_fragments[0]),
+                                                   num_output_samples)
+
+        output = io.BytesIO()
+        sf.write(output, denoised_output, self.sample_rate, format='WAV')
+        latency = time.time() - start_time
+        self.batcher.record_latency(latency)
+        self.send_body(200, 'audio/wav', output.getvalue(), {'X-Denoise-Latency-Ms': '%.1f' % (1000 * latency)})
+
+    def read_audio(self, body, parameters):
+
+        # WAV uploads are resampled to the model rate; raw uploads are 16 bit mono PCM at the model rate
+        if parameters.get('format', ['wav'])[0] == 'pcm16':
+            return util.wav_to_float(np.frombuffer(body, dtype='<i2'))
+
+        audio_signal, sample_rate = sf.read(io.BytesIO(body))
+        if audio_signal.ndim > 1:
+            audio_signal = audio_signal[:, 0]
+        return util.ensure_sample_rate(audio_signal, self.sample_rate, sample_rate)
+
+    def send_body(self, code, content_type, body, headers=None):
+
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DenoisingHTTPServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve(model, batch_size, sample_rate, condition_encoding, host='127.0.0.1', port=8000, max_wait_ms=10,
+          max_pending_fragments=1024):
+
+    DenoisingRequestHandler.batcher = MicroBatcher(model, batch_size, max_wait_ms, max_pending_fragments)
+    DenoisingRequestHandler.model = model
+    DenoisingRequestHandler.sample_rate = sample_rate
+    DenoisingRequestHandler.condition_encode_function = staticmethod(
+        util.get_condition_input_encode_func(condition_encoding))
+
+    http_server = DenoisingHTTPServer((host, port), DenoisingRequestHandler)
+    print('Serving denoising requests on http://%s:%d/denoise' % (host, port))
+    try:
+        http_server.serve_forever()
+    finally:
+        http_server.server_close()
+
+
+def denoise_remote(url, wav_path, condition_value=0):
+
+    # Minimal client: uploads a wav file and returns the denoised signal and its sample rate
+    with open(wav_path, 'rb') as wav_file:
+        request = urllib.request.Request('%s?condition_value=%d' % (url, condition_value), data=wav_file.read(),
+                                         headers={'Content-Type': 'audio/wav'})
+    with urllib.request.urlopen(request) as response:
+        return sf.read(io.BytesIO(response.read()))
@@ -0,0 +1,132 @@
+# Sharding.py
+# Runs inference over many files in several worker processes, each pinned to its own subset of cores
+
+import os
+import sys
+import time
+import queue
+import logging
+import multiprocessing
+import numpy as np
+
+
+def get_available_cores():
+
+    # The cores this process may run on, which for a shard worker are the ones it is pinned to
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def get_core_subsets(num_shards):
+
+    cores = get_available_cores()
+
+    if num_shards > len(cores):
+        logging.warning('Running %d shards on %d cores, some shards will share a core' % (num_shards, len(cores)))
+        return [[cores[shard_i % len(cores)]] for shard_i in range(num_shards)]
+
+    return [[int(core) for core in subset] for subset in np.array_split(cores, num_shards)]
+
+
+def set_worker_resources(cores):
+
+    # Must run in the worker before TensorFlow executes its first op
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    os.environ['OMP_NUM_THREADS'] = str(len(cores))
+    # TensorFlow reads these when it initialises, so workers that never import it do not have to
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(len(cores))
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    if 'tensorflow' not in sys.modules:
+        return
+
+    import tensorflow as tf
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(len(cores))
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except RuntimeError:
+        logging.warning('TensorFlow was already initialised, thread settings of this worker are unchanged')
+
+
+def order_largest_first(filenames, directory_path):
+
+    # Handing out the longest files first keeps one large file from finishing last on an otherwise idle pool
+    return sorted(filenames, key=lambda filename: os.path.getsize(os.path.join(directory_path, filename)),
+                  reverse=True)
+
+
+def iterate_work_queue(work_queue):
+
+    while True:
+        work_item = work_queue.get()
+        if work_item is None:
+            return
+        yield work_item
+
+
+def log_progress(log_queue, shard_i, work_item, num_samples, duration, result=None):
+    log_queue.put((shard_i, work_item, num_samples, duration, result))
+
+
+def run_worker(worker_function, shard_i, cores, work_queue, log_queue, worker_args):
+
+    try:
+        worker_function(shard_i, cores, work_queue, log_queue, *worker_args)
+    finally:
+        log_queue.put((shard_i, None, 0, 0, None))
+
+
+def run_shards(worker_function, worker_args, work_items, num_shards, sample_rate, on_work_item_done=None):
+
+    # Spawned rather than forked workers, so no TensorFlow runtime state is shared with the parent
+    context = multiprocessing.get_context('spawn')
+    work_queue = context.Queue()
+    log_queue = context.Queue()
+
+    for work_item in work_items:
+        work_queue.put(work_item)
+    for _ in range(num_shards):
+        work_queue.put(None)
+
+    workers = []
+    for shard_i, cores in enumerate(get_core_subsets(num_shards)):
+        worker = context.Process(target=run_worker,
+                                 args=(worker_function, shard_i, cores, work_queue, log_queue, worker_args))
+        worker.start()
+        workers.append(worker)
+
+    start_time = time.time()
+    num_done = 0
+    num_finished_workers = 0
+    total_samples = 0
+    while num_finished_workers < num_shards:
+        try:
+            shard_i, work_item, num_samples, duration, result = log_queue.get(timeout=1)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers) and log_queue.empty():
+                break
+            continue
+
+        if work_item is None:
+            num_finished_workers += 1
+            continue
+
+        num_done += 1
+        total_samples += num_samples
+        if on_work_item_done is not None:
+            on_work_item_done(work_item, result)
+        print('[shard %d] %d/%d %s: %.1f s of audio in %.1f s' % (
+            shard_i, num_done, len(work_items), work_item, num_samples / float(sample_rate), duration))
+
+    for worker in workers:
+        worker.join()
+
+    elapsed_time = time.time() - start_time
+    print('Denoised %d/%d files, %.1f s of audio in %.1f s (%.1f s of audio per second)' % (
+        num_done, len(work_items), total_samples / float(sample_rate), elapsed_time,
+        total_samples / float(sample_rate) / elapsed_time))
+
+    if num_done < len(work_items):
+        raise RuntimeError('%d files were not denoised, see worker errors above' % (len(work_items) - num_done))
@@ -0,0 +1,198 @@
+# Telemetry.py
+# Inference instrumentation: per-file real-time factor, per-stage latency histograms, batch fill and peak memory,
+# exported as a JSON summary and in the Prometheus text format
+
+import os
+import json
+import time
+import resource
+import contextlib
+import numpy as np
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+REAL_TIME_FACTOR_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0]
+
+
+class Histogram():
+
+    def __init__(self, buckets):
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+
+        self.counts[int(np.searchsorted(self.buckets, value))] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, state):
+
+        self.counts = [count + other_count for count, other_count in zip(self.counts, state['counts'])]
+        self.sum += state['sum']
+        self.count += state['count']
+
+    def get_state(self):
+        return {'buckets': self.buckets, 'counts': self.counts, 'sum': self.sum, 'count': self.count}
+
+
+class InferenceTelemetry():
+
+    def __init__(self):
+
+        self.stage_histograms = {}
+        self.real_time_factors = Histogram(REAL_TIME_FACTOR_BUCKETS)
+        self.files = []
+        self.num_batches = 0
+        self.num_batch_fragments = 0
+        self.num_batch_slots = 0
+        self.merged_peak_rss_bytes = 0
+        # Wall-clock span of the run, from construction to the last file recorded here or merged from a worker
+        self.start_time = time.perf_counter()
+        self.end_time = self.start_time
+
+    @contextlib.contextmanager
+    def stage(self, name):
+
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(name, time.perf_counter() - start_time)
+
+    def observe_stage(self, name, duration):
+
+        if name not in self.stage_histograms:
+            self.stage_histograms[name] = Histogram(LATENCY_BUCKETS)
+        self.stage_histograms[name].observe(duration)
+
+    def record_batch(self, num_fragments, batch_size):
+
+        self.num_batches += 1
+        self.num_batch_fragments += num_fragments
+        self.num_batch_slots += batch_size
+
+    def record_file(self, filename, num_samples, sample_rate, duration):
+
+        # Real-time factor: seconds of compute per second of audio, below 1 is faster than real time
+        audio_duration = num_samples / float(sample_rate)
+        real_time_factor = duration / audio_duration
+        self.real_time_factors.observe(real_time_factor)
+        self.files.append({'filename': filename, 'audio_seconds': audio_duration, 'seconds': duration,
+                           'real_time_factor': real_time_factor})
+        self.end_time = time.perf_counter()
+
+    def get_state(self):
+
+        return {
+            'stages': dict((name, histogram.get_state()) for name, histogram in self.stage_histograms.items()),
+            'real_time_factors': self.real_time_factors.get_state(),
+            'files': self.files,
+            'num_batches': self.num_batches,
+            'num_batch_fragments': self.num_batch_fragments,
+            'num_batch_slots': self.num_batch_slots,
+            'peak_rss_bytes': self.get_peak_rss_bytes()
+        }
+
+    def merge(self, state):
+
+        # Combines the state of another process, e.g. a sharded inference worker
+        for name, histogram_state in state['stages'].items():
+            if name not in self.stage_histograms:
+                self.stage_histograms[name] = Histogram(LATENCY_BUCKETS)
+            self.stage_histograms[name].merge(histogram_state)
+        self.real_time_factors.merge(state['real_time_factors'])
+        self.files += state['files']
+        self.num_batches += state['num_batches']
+        self.num_batch_fragments += state['num_batch_fragments']
+        self.num_batch_slots += state['num_batch_slots']
+        self.merged_peak_rss_bytes = max(self.merged_peak_rss_bytes, state['peak_rss_bytes'])
+        self.end_time = time.perf_counter()
+
+    def get_peak_rss_bytes(self):
+        # The largest of this process and any merged process
+        return max(get_peak_rss_bytes(), self.merged_peak_rss_bytes)
+
+    def get_summary(self):
+
+        # Throughput is over the wall-clock span, so sharded runs report that of all workers together. seconds is the
+        # compute time summed over files, which counts workers running at once separately
+        audio_seconds = sum(file['audio_seconds'] for file in self.files)
+        seconds = sum(file['seconds'] for file in self.files)
+        wall_seconds = self.end_time - self.start_time
+        return {
+            'num_files': len(self.files),
+            'audio_seconds': audio_seconds,
+            'seconds': seconds,
+            'wall_seconds': wall_seconds,
+            'real_time_factor': wall_seconds / audio_seconds if audio_seconds > 0 else None,
+            'audio_seconds_per_second': audio_seconds / wall_seconds if wall_seconds > 0 else None,
+            'batch_fill_ratio': self.num_batch_fragments / float(self.num_batch_slots)
+            if self.num_batch_slots > 0 else None,
+            'num_batches': self.num_batches,
+            'peak_rss_bytes': self.get_peak_rss_bytes(),
+            'stages': dict((name, {'count': histogram.count, 'sum_seconds': histogram.sum,
+                                   'mean_seconds': histogram.sum / histogram.count})
+                           for name, histogram in self.stage_histograms.items()),
+            'files': self.files
+        }
+
+    def write_json(self, file_path):
+        write_atomically(file_path, json.dumps(self.get_summary(), sort_keys=True, indent=4,
+                                               separators=(',', ': ')))
+
+    def write_prometheus(self, file_path):
+
+        summary = self.get_summary()
+        lines = []
+        lines += get_prometheus_histogram_lines(
+            'wavenet_inference_stage_seconds', 'Time spent per inference stage.',
+            dict(('stage="%s"' % name, histogram) for name, histogram in self.stage_histograms.items()))
+        lines += get_prometheus_histogram_lines(
+            'wavenet_inference_file_real_time_factor', 'Seconds of compute per second of audio, per file.',
+            {'': self.real_time_factors})
+        for name, metric_type, help, value in [
+                ('wavenet_inference_files_total', 'counter', 'Files denoised.', summary['num_files']),
+                ('wavenet_inference_audio_seconds_total', 'counter', 'Seconds of audio denoised.',
+                 summary['audio_seconds']),
+                ('wavenet_inference_batches_total', 'counter', 'Model batches run.', summary['num_batches']),
+                ('wavenet_inference_batch_fill_ratio', 'gauge', 'Share of batch slots holding a real fragment.',
+                 summary['batch_fill_ratio']),
+                ('wavenet_inference_peak_rss_bytes', 'gauge', 'Peak resident memory of any inference process.',
+                 summary['peak_rss_bytes'])]:
+            if value is None:
+                continue
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, metric_type), '%s %s' % (name, value)]
+
+        # Written to a temporary file and renamed, so the node exporter never scrapes a partial file
+        write_atomically(file_path, '\n'.join(lines) + '\n')
+
+
+def get_prometheus_histogram_lines(name, help, labelled_histograms):
+
+    lines = ['# HELP %s %s' % (name, help), '# TYPE %s histogram' % name]
+    for labels, histogram in labelled_histograms.items():
+        label_prefix = labels + ',' if labels != '' else ''
+        cumulative_count = 0
+        for bucket, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+            cumulative_count += count
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, label_prefix, bucket, cumulative_count))
+        label_suffix = '{%s}' % labels if labels != '' else ''
+        lines.append('%s_sum%s %s' % (name, label_suffix, histogram.sum))
+        lines.append('%s_count%s %d' % (name, label_suffix, histogram.count))
+    return lines
+
+
+def get_peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def write_atomically(file_path, content):
+
+    temporary_file_path = file_path + '.tmp'
+    with open(temporary_file_path, 'w') as output_file:
+        output_file.write(content)
+    os.replace(temporary_file_path, file_path)
@@ -0,0 +1,141 @@
+# Tflite_runner.py
+# Minimal Denoising Wavenet inference on an exported TFLite flatbuffer. Only needs numpy, scipy, soundfile and a
+# TFLite interpreter, none of the TensorFlow/Keras training stack.
+
+import os
+import sys
+import json
+import optparse
+import numpy as np
+import soundfile as sf
+import fragments
+
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+
+
+class TFLiteModel():
+    # Exposes the attributes and denoise_batch of DenoisingWavenet that the inference loops rely on
+
+    def __init__(self, tflite_path, num_threads=None):
+
+        with open(os.path.join(os.path.dirname(tflite_path), 'metadata.json'), 'r') as metadata_file:
+            self.metadata = json.load(metadata_file)
+
+        self.batch_size = self.metadata['batch_size']
+        self.input_length = self.metadata['input_length']
+        self.target_field_length = self.metadata['target_field_length']
+        self.target_padding = self.metadata['target_padding']
+        self.receptive_field_length = self.metadata['receptive_field_length']
+        self.half_receptive_field_length = self.receptive_field_length // 2
+        self.condition_input_length = self.metadata['condition_input_length']
+        self.num_condition_classes = self.metadata['num_condition_classes']
+        self.sample_rate = self.metadata['sample_rate']
+
+        self.interpreter = Interpreter(model_path=tflite_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.runner = self.interpreter.get_signature_runner()
+
+    def encode_condition(self, condition_value):
+
+        if self.metadata['condition_encoding'] == 'binary':
+            return ((condition_value & (1 << np.arange(self.condition_input_length))) > 0).astype('float32')
+        return np.eye(self.num_condition_classes, dtype='float32')[condition_value]
+
+    def denoise_batch(self, inputs):
+
+        num_fragments = inputs['data_input'].shape[0]
+        outputs = [[], []]
+        for batch_start in range(0, num_fragments, self.batch_size):
+            batch_end = min(batch_start + self.batch_size, num_fragments)
+
+            data_input = np.zeros((self.batch_size, self.input_length), dtype='float32')
+            condition_input = np.zeros((self.batch_size, self.condition_input_length), dtype='float32')
+            data_input[:batch_end - batch_start] = inputs['data_input'][batch_start:batch_end]
+            condition_input[:batch_end - batch_start] = inputs['condition_input'][batch_start:batch_end]
+
+            batch_outputs = self.runner(data_input=data_input, condition_input=condition_input)
+            outputs[0].append(batch_outputs['data_output_1'][:batch_end - batch_start])
+            outputs[1].append(batch_outputs['data_output_2'][:batch_end - batch_start])
+
+        return [np.concatenate(output, axis=0) for output in outputs]
+
+
+def denoise_signal(model, noisy, condition_input):
+
+    input_fragments = fragments.split_into_fragments(model, noisy)
+    outputs = model.denoise_batch({'data_input': input_fragments,
+                                   'condition_input': np.tile(condition_input, (len(input_fragments), 1))})
+    num_output_samples = fragments.get_num_output_samples(model, len(noisy))
+
+    return (fragments.join_fragments(model, outputs[0], num_output_samples),
+            fragments.join_fragments(model, outputs[1], num_output_samples))
+
+
+def read_wav(wav_path, sample_rate):
+
+    sequence, file_sample_rate = sf.read(wav_path, dtype='float32')
+    if sequence.ndim > 1:
+        sequence = sequence[:, 0]
+    if file_sample_rate != sample_rate:
+        import scipy.signal
+        sequence = scipy.signal.resample_poly(sequence, sample_rate, file_sample_rate)
+    return sequence
+
+
+def get_command_line_arguments():
+    parser = optparse.OptionParser()
+    parser.set_defaults(model_path=None)
+    parser.set_defaults(noisy_input_path=None)
+    parser.set_defaults(output_path='.')
+    parser.set_defaults(condition_value=0)
+    parser.set_defaults(num_threads=None)
+
+    parser.add_option('--model_path', dest='model_path')
+    parser.add_option('--noisy_input_path', dest='noisy_input_path')
+    parser.add_option('--output_path', dest='output_path')
+    parser.add_option('--condition_value', dest='condition_value')
+    parser.add_option('--num_threads', dest='num_threads')
+
+    (options, args) = parser.parse_args()
+
+    return options
+
+
+def main():
+
+    cla = get_command_line_arguments()
+    if cla.model_path is None or cla.noisy_input_path is None:
+        print('Usage: tflite_runner.py --model_path <model.tflite> --noisy_input_path <wav file or folder>')
+        sys.exit(1)
+
+    model = TFLiteModel(cla.model_path, None if cla.num_threads is None else int(cla.num_threads))
+    condition_input = model.encode_condition(int(cla.condition_value))
+
+    if cla.noisy_input_path.endswith('.wav'):
+        wav_paths = [cla.noisy_input_path]
+    else:
+        wav_paths = [os.path.join(cla.noisy_input_path, filename)
+                     for filename in sorted(os.listdir(cla.noisy_input_path)) if filename.endswith('.wav')]
+
+    if not os.path.exists(cla.output_path):
+        os.makedirs(cla.output_path)
+
+    for wav_path in wav_paths:
+        print('Denoising: ' + wav_path)
+        denoised_output, noise_output = denoise_signal(model, read_wav(wav_path, model.sample_rate), condition_input)
+
+        output_filename_prefix = os.path.basename(wav_path)[0:-4] + '_'
+        sf.write(os.path.join(cla.output_path, output_filename_prefix + 'denoised.wav'), denoised_output,
+                 model.sample_rate)
+        sf.write(os.path.join(cla.output_path, output_filename_prefix + 'noise.wav'), noise_output, model.sample_rate)
+
+
+if __name__ == "__main__":
+    main()
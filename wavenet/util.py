@@ -5,14 +5,21 @@ import os
 import numpy as np
 import json
 import warnings
-import scipy.signal
-import scipy.stats
 import soundfile as sf
-import tensorflow as tf
-from tensorflow.keras.losses import MeanAbsoluteError, MeanSquaredError
 
-mae = MeanAbsoluteError()
-mse = MeanSquaredError()
+# TensorFlow and SciPy are imported by the functions that need them, so inference without a Keras model
+# starts without loading either
+loss_functions = {}
+
+
+def get_loss_function(name):
+
+    # The Keras loss objects are created on first use
+    if len(loss_functions) == 0:
+        from tensorflow.keras.losses import MeanAbsoluteError, MeanSquaredError
+        loss_functions['mae'] = MeanAbsoluteError()
+        loss_functions['mse'] = MeanSquaredError()
+    return loss_functions[name]
 
 
 def l1_l2_loss(y_true, y_pred, l1_weight, l2_weight):
@@ -20,10 +27,10 @@ def l1_l2_loss(y_true, y_pred, l1_weight, l2_weight):
     loss = 0
 
     if l1_weight != 0:
-        loss += l1_weight * mae(y_true, y_pred)
+        loss += l1_weight * get_loss_function('mae')(y_true, y_pred)
 
     if l2_weight != 0:
-        loss += l2_weight * mse(y_true, y_pred)
+        loss += l2_weight * get_loss_function('mse')(y_true, y_pred)
 
     return loss
 
@@ -81,6 +88,7 @@ def linear_to_ulaw(x, u=255):
 
 
 def keras_linear_to_ulaw(x, u=255.0):
+    import tensorflow as tf
     x = tf.sign(x) * (tf.math.log(1 + u * tf.abs(x)) / tf.math.log(1 + u))
     return x
 
@@ -110,6 +118,7 @@ def ulaw_to_linear(x, u=255.0):
 
 
 def keras_ulaw_to_linear(x, u=255.0):
+    import tensorflow as tf
     y = tf.sign(x) * (1 / u) * (((1 + u) ** tf.abs(x)) - 1)
     return y
 
@@ -201,10 +210,25 @@ def write_wav(x, filename, sample_rate):
 
 def ensure_sample_rate(x, desired_sample_rate, file_sample_rate):
     if file_sample_rate != desired_sample_rate:
+        import scipy.signal
         return scipy.signal.resample_poly(x, desired_sample_rate, file_sample_rate)
     return x
 
 
+def wiener_filter(noisy_signal, noise_estimate, frame_size=1024, overlap=512):
+
+    # Same as wiener_filter in the repository's methods.py, kept here so the wavenet package does not import from
+    # outside its folder
+    import scipy.signal
+    _, _, noisy_spectrogram = scipy.signal.stft(noisy_signal, nperseg=frame_size, noverlap=overlap)
+    _, _, noise_spectrogram = scipy.signal.stft(noise_estimate, nperseg=frame_size, noverlap=overlap)
+    noise_psd = np.mean(np.abs(noise_spectrogram) ** 2, axis=1, keepdims=True)
+    signal_psd = np.abs(noisy_spectrogram) ** 2
+    gain = signal_psd / (signal_psd + noise_psd)
+    _, enhanced_signal = scipy.signal.istft(gain * noisy_spectrogram, nperseg=frame_size, noverlap=overlap)
+    return np.real(enhanced_signal[:len(noisy_signal)])
+
+
 def rms(x):
     return np.sqrt(np.mean(np.square(x), axis=-1))
 
@@ -214,14 +238,19 @@ def normalize(x):
     return x / max_peak
 
 
-def get_subsequence_with_speech_indices(full_sequence):
+def get_chunk_energies(full_sequence, chunk_length=800):
+    # Mean magnitude per chunk, the last chunk may be shorter
     signal_magnitude = np.abs(full_sequence)
+    chunk_starts = np.arange(0, len(signal_magnitude), chunk_length)
+    chunk_lengths = np.minimum(chunk_length, len(signal_magnitude) - chunk_starts)
+    return np.add.reduceat(signal_magnitude, chunk_starts) / chunk_lengths
+
+
+def get_subsequence_with_speech_indices(full_sequence):
 
     chunk_length = 800
 
-    chunks_energies = []
-    for i in range(0, len(signal_magnitude), chunk_length):
-        chunks_energies.append(np.mean(signal_magnitude[i:i + chunk_length]))
+    chunks_energies = get_chunk_energies(full_sequence, chunk_length)
 
     threshold = np.max(chunks_energies) * .1
 
@@ -245,6 +274,20 @@ def get_subsequence_with_speech_indices(full_sequence):
     return [onset_chunk_i*chunk_length, (termination_chunk_i+1)*chunk_length]
 
 
+def get_speech_mask(full_sequence, chunk_length=800, num_pad_chunks=4):
+    # Per-sample speech activity from chunk energies, with the same threshold and padding as
+    # get_subsequence_with_speech_indices, but keeping every active region instead of one onset-offset span
+    chunks_energies = get_chunk_energies(full_sequence, chunk_length)
+    speech_chunks = chunks_energies >= np.max(chunks_energies) * .1
+
+    speech_chunks_before = np.concatenate(([0], np.cumsum(speech_chunks)))
+    chunk_indices = np.arange(len(speech_chunks))
+    padded_speech_chunks = speech_chunks_before[np.minimum(chunk_indices + num_pad_chunks + 1, len(speech_chunks))] - \
+        speech_chunks_before[np.maximum(chunk_indices - num_pad_chunks, 0)] > 0
+
+    return np.repeat(padded_speech_chunks, chunk_length)[:len(full_sequence)]
+
+
 def extract_subsequence_with_speech(full_sequence):
 
     indices = get_subsequence_with_speech_indices(full_sequence)